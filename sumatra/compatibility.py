@@ -20,8 +20,8 @@ except ImportError:
 try:
     from urllib2 import urlopen, URLError
     from urllib import urlretrieve
-    from urlparse import urlparse
+    from urlparse import urlparse, parse_qsl
 except ImportError:
     from urllib.request import urlopen, urlretrieve
     from urllib.error import URLError
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, parse_qsl
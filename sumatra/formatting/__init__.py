@@ -40,9 +40,12 @@ class Formatter(object):
         return getattr(self, mode)()
 
 
-def record2json(record, indent=None):
-    """Encode a Sumatra record as JSON."""
-    data = {
+def record2dict(record):
+    """
+    Return a nested dictionary, containing only JSON-compatible values, which
+    represents a Sumatra record.
+    """
+    return {
         "label": record.label,  # 0.1: 'group'
         "timestamp": record.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
         "reason": record.reason,
@@ -114,7 +117,11 @@ def record2json(record, indent=None):
         } for p in record.platforms],
         "repeats": record.repeats,  # added in 0.6
     }
-    return json.dumps(data, indent=indent)
+
+
+def record2json(record, indent=None):
+    """Encode a Sumatra record as JSON."""
+    return json.dumps(record2dict(record), indent=indent)
 
 
 class JSONFormatter(Formatter):
@@ -497,6 +504,48 @@ class TextDiffFormatter(Formatter):
         return output
 
 
+class TextDiffMatrixFormatter(Formatter):
+    """
+    Format the differences between each pair of a list of Sumatra records
+    (a :class:`sumatra.records.DifferenceMatrix`) in text format.
+    """
+    name = "textdiffmatrix"
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def short(self):
+        """
+        Return a table with one row and one column per record, giving the
+        ways in which the record in each row differs from that in each column.
+        """
+        M = self.matrix
+        cells = [[M.differences(label1, label2) or "-" for label2 in M.labels]
+                 for label1 in M.labels]
+        label_width = max([len(label) for label in M.labels] + [0])
+        widths = [max([len(label)] + [len(row[j]) for row in cells])
+                  for j, label in enumerate(M.labels)]
+        format = "%%-%ds | " % label_width + " ".join("%%-%ds" % w for w in widths) + "\n"
+        output = format % tuple([""] + M.labels)
+        for label, row in zip(M.labels, cells):
+            output += format % tuple([label] + row)
+        output += "\n" + ", ".join("%s: %s" % flag for flag in M.FLAGS) + " differ\n"
+        return output
+
+    def long(self):
+        """
+        Return the table given by :meth:`short`, followed by the groups of
+        records which do not differ from each other.
+        """
+        classes = self.matrix.classes
+        output = self.short()
+        output += "\n%d records in %d groups of identical records:\n" % (len(self.matrix),
+                                                                        len(classes))
+        for i, labels in enumerate(classes):
+            output += "  %d: %s\n" % (i + 1, " ".join(labels))
+        return output
+
+
 registry.add_component_type(Formatter)
 
 registry.register(TextFormatter)
@@ -505,6 +554,7 @@ registry.register(LaTeXFormatter)
 registry.register(ShellFormatter)
 registry.register(JSONFormatter)
 registry.register(TextDiffFormatter)
+registry.register(TextDiffMatrixFormatter)
 
 
 def get_formatter(format):
@@ -523,6 +573,14 @@ def get_diff_formatter():
     return TextDiffFormatter
 
 
+def get_diff_matrix_formatter():
+    """
+    Return a :class:`DiffMatrixFormatter` object of the appropriate type. Only
+    text format is currently available.
+    """
+    return TextDiffMatrixFormatter
+
+
 def _quotient_remainder(dividend, divisor):
     q = dividend // divisor
     r = dividend - q * divisor
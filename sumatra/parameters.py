@@ -469,3 +469,21 @@ def build_parameters(filename):
             except (SyntaxError, NameError, UnicodeDecodeError):
                 pass
     return parameters
+
+
+def flatten(parameters, prefix=""):
+    """
+    Return a list of (name, value) pairs for the parameters in a parameter set
+    (or dict), sorted by name, with the names of nested parameters joined by
+    dots, e.g. ("sim.dt", 0.1).
+    """
+    if hasattr(parameters, "as_dict"):
+        parameters = parameters.as_dict()
+    items = []
+    for name in sorted(parameters):
+        value = parameters[name]
+        if hasattr(value, "as_dict") or isinstance(value, dict):
+            items.extend(flatten(value, prefix + name + "."))
+        else:
+            items.append((prefix + name, value))
+    return items
@@ -33,12 +33,17 @@ import sumatra
 import django
 import sqlite3
 import time
+import random
 import shutil
 from datetime import datetime
-from sumatra.records import Record
+from sumatra.records import Record, compare_many
 from sumatra import programs, datastore
-from sumatra.formatting import get_formatter, get_diff_formatter
+from sumatra.formatting import get_formatter, get_diff_formatter, get_diff_matrix_formatter
 from sumatra.recordstore import DefaultRecordStore
+from sumatra.recordstore.base import RecordStoreAccessError, filter_records, has_tags
+from sumatra.recordstore.serialization import open_json_lines
+from sumatra.recordstore import search
+from sumatra.recordstore.spool import RecordSpool
 from sumatra.versioncontrol import UncommittedModificationsError, get_working_copy, VersionControlError
 from sumatra.core import TIMESTAMP_FORMAT
 import mimetypes
@@ -52,6 +57,14 @@ logger = logging.getLogger("Sumatra")
 
 DEFAULT_PROJECT_FILE = "project"
 
+# Saving a record is retried with exponential backoff (with random jitter, so
+# that jobs which finish at the same time do not retry in lock-step) if the
+# record store is locked by another process. If it is still locked after
+# MAX_SAVE_ATTEMPTS, the record is put in the project's spool directory.
+MAX_SAVE_ATTEMPTS = 6
+RETRY_BASE_DELAY = 0.1  # seconds
+RETRY_MAX_DELAY = 10.0
+
 LABEL_GENERATORS = {
     'timestamp': lambda: None,  # this is the default, implemented in the Record class
     'uuid': lambda: str(uuid.uuid4()).split('-')[-1]
@@ -63,6 +76,19 @@ def _remove_left_margin(s):  # replace this by textwrap.dedent?
     return "\n".join(line.strip() for line in lines)
 
 
+def store_unavailable_errors():
+    """
+    Return the exceptions which indicate that the record store is busy or
+    cannot be reached, so that saving a record should be tried again later.
+    Other database errors (e.g. integrity errors) would not go away by
+    waiting, so they are not included.
+    """
+    # django.db is imported here, rather than at the top of the module, so
+    # that it is not loaded before a record store has configured Django
+    import django.db.utils
+    return (RecordStoreAccessError, django.db.utils.OperationalError, sqlite3.OperationalError)
+
+
 def _get_project_file(path):
     return os.path.join(path, ".smt", DEFAULT_PROJECT_FILE)
 
@@ -229,27 +255,74 @@ class Project(object):
         return version, diff
 
     def add_record(self, record):
-        """Add a simulation or analysis record."""
-        success = False
-        cnt = 0
-        max_tries = 200
-        sleep_seconds = 5
-        while not success and cnt < max_tries:
+        """
+        Add a simulation or analysis record.
+
+        If the record store is busy (e.g. because many jobs have finished at
+        the same time), saving is retried a few times. If that does not
+        succeed, or the record store cannot be reached at all (e.g. a remote
+        store, from a compute node without network access), the record is put
+        in a spool directory, from which it is added to the store the next time
+        a record is saved successfully or by :meth:`flush`. Until then, it is
+        included in the records returned by :meth:`get_record` and
+        :meth:`find_records`, and the records in the spool directory are
+        read only once.
+        """
+        for attempt in range(MAX_SAVE_ATTEMPTS):
             try:
                 self.record_store.save(self.name, record)
-                success = True
+            except RecordStoreAccessError as err:
+                logger.debug("Unable to access the record store: %s", err)
+                break
+            except store_unavailable_errors() as err:
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                logger.debug("Failed to save record due to database error (%s). "
+                             "Trying again in %.1f seconds.", err, delay)
+                time.sleep(delay)
+            else:
                 self._most_recent = record.label
-            except (django.db.utils.DatabaseError, sqlite3.OperationalError):
-                print "Failed to save record due to database error. Trying again in {} seconds. (Attempt {}/{})".format(sleep_seconds, cnt, max_tries)
-                time.sleep(sleep_seconds)
-                cnt += 1
-        if cnt == max_tries:
-            print "Reached maximum number of attempts to save record. Aborting."
+                try:
+                    self.flush()
+                except store_unavailable_errors() as err:
+                    logger.debug("Unable to add spooled records to the record store: %s", err)
+                return
+        path = self.spool.put(self.name, record)
+        self._most_recent = record.label
+        print("Record store is unavailable. Record %s has been saved to %s and will be added "
+              "to the record store later (or run 'smt flush')." % (record.label, path))
+
+    @property
+    def spool(self):
+        """Directory of records waiting to be added to the record store."""
+        if getattr(self, "_spool", None) is None:
+            self._spool = RecordSpool(os.path.join(self.path, ".smt", "spool"))
+        return self._spool
+
+    def flush(self):
+        """
+        Add any spooled records to the record store. Return the number of
+        records added.
+        """
+        n = self.spool.ingest(self.name, self.record_store)
+        if n > 0:
+            logger.info("Added %d spooled record(s) to the record store", n)
+        return n
+
+    def _spooled_records(self):
+        """Return a dict containing the records waiting in the spool, by label."""
+        return dict((record.label, record) for record in self.spool.records(self.name))
 
     def get_record(self, label):
         """Search for a record with the supplied label and return it if found.
            Otherwise return None."""
-        return self.record_store.get(self.name, label)
+        try:
+            return self.record_store.get(self.name, label)
+        except Exception:
+            # the spool is only looked at if the record is not in the store
+            spooled = self._spooled_records()
+            if label in spooled:
+                return spooled[label]
+            raise
 
     def delete_record(self, label, delete_data=False):
         """Delete a record. Return 1 if the record is found.
@@ -257,28 +330,119 @@ class Project(object):
         if delete_data:
             self.get_record(label).delete_data()
         self.record_store.delete(self.name, label)
-        self._most_recent = self.record_store.most_recent(self.name)
+        if label == self._most_recent:
+            self._most_recent = self.record_store.most_recent(self.name)
+
+    def delete_records(self, labels, delete_data=False):
+        """
+        Delete several records at once. Labels of records which do not exist
+        are ignored. Return the number of records deleted.
+        """
+        labels = list(labels)
+        if delete_data:
+            self._delete_output_data(labels)
+        n = self.record_store.delete_many(self.name, labels)
+        if self._most_recent in labels:
+            self._most_recent = self.record_store.most_recent(self.name)
+        return n
+
+    def _delete_output_data(self, labels):
+        """Delete the output data of several records, in one batch per data store."""
+        for datastore, keys in self.record_store.output_data(self.name, labels):
+            if keys:
+                datastore.delete(*keys)
 
     def delete_by_tag(self, tag, delete_data=False):
         """Delete all records with a given tag. Return the number of records deleted."""
         if delete_data:
-            for record in self.record_store.list(self.name, tag):
-                record.delete_data()
+            self._delete_output_data(row["label"] for row in
+                                     self.record_store.list(self.name, tag, fields=["label"]))
         n = self.record_store.delete_by_tag(self.name, tag)
         self._most_recent = self.record_store.most_recent(self.name)
         return n
 
-    def find_records(self, tags=None, reverse=False):
-        records = self.record_store.list(self.name, tags)
+    def find_records(self, tags=None, reverse=False, since=None, until=None,
+                     limit=None, offset=None, where=None, all_tags=None,
+                     not_tags=None):
+        """
+        Return the project's records, newest first (oldest first if *reverse*
+        is True). *where* selects records by parameter value, e.g.
+        "sim.dt<0.1, n_cells>=1000". Records are selected by tag if they have
+        any of *tags*, all of *all_tags* and none of *not_tags*. See
+        :meth:`RecordStore.list` for the other arguments.
+        """
+        spooled = self._spooled_records()
+        tag_query = dict(tags=tags, all_tags=all_tags, not_tags=not_tags)
+        if spooled and (tags or all_tags or not_tags):
+            spooled = dict((label, record) for label, record in spooled.items()
+                           if has_tags(set(record.tags), **tag_query))
+        if spooled:
+            # the paging has to be applied after merging with the spooled records
+            stored_limit = limit and limit + (offset or 0)
+            records = self.record_store.list(self.name, since=since,
+                                             until=until, limit=stored_limit,
+                                             order_by="-timestamp", where=where,
+                                             **tag_query)
+            records = [record for record in records if record.label not in spooled]
+            records = filter_records(records + spooled.values(), since=since, until=until,
+                                     order_by="-timestamp", limit=limit, offset=offset,
+                                     where=where)
+        else:
+            records = self.record_store.list(self.name, since=since,
+                                             until=until, limit=limit,
+                                             offset=offset, order_by="-timestamp",
+                                             where=where, **tag_query)
         if reverse:
             records.reverse()
         return records
 
 
+    def search_records(self, query, limit=None):
+        """
+        Return the project's records which match a full-text search query
+        (see :mod:`sumatra.recordstore.search`), newest first.
+        """
+        spooled = self._spooled_records()
+        records = self.record_store.search(self.name, query, limit=limit)
+        if spooled:
+            records = [record for record in records if record.label not in spooled]
+            records += [record for record in spooled.values() if search.matches(record, query)]
+            records = filter_records(records, order_by="-timestamp", limit=limit)
+        return records
+
+    @property
+    def snapshot_file(self):
+        """File containing a read-only snapshot of the project's records."""
+        return os.path.join(self.path, ".smt", "snapshot.npy")
+
+    def snapshot(self, rebuild=False):
+        """
+        Create or update the snapshot of the project's records (see
+        :mod:`sumatra.snapshot`). Return the number of records read from the
+        record store.
+        """
+        from sumatra.snapshot import Snapshot
+        return Snapshot(self.snapshot_file).update(self.record_store, self.name, rebuild=rebuild)
+
+    def record_table(self, update=True):
+        """
+        Return a :class:`~sumatra.snapshot.RecordTable` of the project's
+        records, bringing the snapshot up to date first unless *update* is
+        False.
+        """
+        from sumatra.snapshot import RecordTable
+        if update or not os.path.exists(self.snapshot_file):
+            self.snapshot()
+        return RecordTable.load(self.snapshot_file)
+
     # def find_data() here?
 
-    def format_records(self, format='text', mode='short', tags=None, reverse=False):
-        records = self.find_records(tags=tags, reverse=reverse)
+    def format_records(self, format='text', mode='short', tags=None, reverse=False,
+                       since=None, until=None, limit=None, where=None,
+                       all_tags=None, not_tags=None):
+        records = self.find_records(tags=tags, reverse=reverse, since=since,
+                                    until=until, limit=limit, where=where,
+                                    all_tags=all_tags, not_tags=not_tags)
         formatter = get_formatter(format)(records, project=self, tags=tags)
         return formatter.format(mode)
 
@@ -320,13 +484,69 @@ class Project(object):
         formatter = get_diff_formatter()(diff)
         return formatter.format(mode)
 
-    def export(self):
+    def compare_many(self, labels=None, tags=None, ignore_mimetypes=[], ignore_filenames=[]):
+        """
+        Return a :class:`~sumatra.records.DifferenceMatrix` giving the
+        differences between each pair of the records with the given labels
+        or, if *labels* is not given, of the records with any of *tags* (by
+        default, all the project's records, oldest first).
+        """
+        if labels is None:
+            records = self.find_records(tags=tags, reverse=True)
+        else:
+            records = [self.get_record(label) for label in labels]
+        return compare_many(records, ignore_mimetypes, ignore_filenames)
+
+    def show_diff_matrix(self, labels=None, tags=None, mode='short', ignore_mimetypes=[],
+                         ignore_filenames=[]):
+        matrix = self.compare_many(labels, tags, ignore_mimetypes, ignore_filenames)
+        formatter = get_diff_matrix_formatter()(matrix)
+        return formatter.format(mode)
+
+    def export(self, compress=False, progress=None):
+        """
+        Export the project data, and the records in JSON Lines format
+        (compressed with gzip if *compress* is True), to the .smt directory.
+        Returns the name of the records file.
+        """
         # copy the project data
         shutil.copy(".smt/project", ".smt/project_export.json")
         # export the record data
-        f = open(".smt/records_export.json", 'w')
-        f.write(self.record_store.export(self.name))
-        f.close()
+        filename = ".smt/records_export.jsonl"
+        if compress:
+            filename += ".gz"
+        with open_json_lines(filename, 'w') as f:
+            self.record_store.export_stream(self.name, f, progress)
+        return filename
+
+    def to_dataframe(self, columns=None, tags=None):
+        """
+        Return a pandas DataFrame containing the project's records (with at
+        least one of *tags*, if given), with one column for each of *columns*
+        (see :func:`sumatra.tables.table_columns`).
+        """
+        from sumatra import tables
+        return tables.to_dataframe(self.record_store, self.name, columns=columns, tags=tags)
+
+    def export_table(self, format="csv", filename=None, columns=None, tags=None, progress=None):
+        """
+        Export the project's records as a table, in CSV or Parquet format, to
+        *filename* (by default, in the .smt directory). Returns the name of
+        the file.
+        """
+        from sumatra import tables
+        if format not in tables.EXPORT_FORMATS:
+            raise ValueError("Unsupported table format '%s'. Formats: %s"
+                             % (format, ", ".join(tables.EXPORT_FORMATS)))
+        filename = filename or ".smt/records_export.%s" % format
+        if format == "csv":
+            with open(filename, "wb") as f:
+                tables.write_csv(f, self.record_store, self.name, columns=columns, tags=tags,
+                                 progress=progress)
+        else:
+            tables.write_parquet(filename, self.record_store, self.name, columns=columns,
+                                 tags=tags, progress=progress)
+        return filename
 
     def repeat(self, original_label, new_label=None):
         if original_label == 'last':
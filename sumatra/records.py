@@ -20,9 +20,16 @@ import time
 import os
 from os.path import relpath, normpath, join, basename, exists
 import re
+import hashlib
 import getpass
+import numbers
 from operator import or_
 from functools import reduce
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
 from .formatting import get_formatter
 from . import dependency_finder
 from sumatra.core import TIMESTAMP_FORMAT
@@ -50,6 +57,136 @@ def check_file_under_version_control(file_path, working_copy):
             raise VersionControlError("File %s is not under version control" % file_path)
 
 
+def filter_datakeys(keys, ignore_mimetypes=(), ignore_filenames=()):
+    """
+    Return a dict containing the data keys in *keys*, indexed by digest,
+    leaving out those whose mimetype matches one of the regular expressions
+    in *ignore_mimetypes* or whose file name matches one of those in
+    *ignore_filenames*.
+    """
+    ignore_mimetypes = [re.compile(pattern) for pattern in ignore_mimetypes]
+    ignore_filenames = [re.compile(pattern) for pattern in ignore_filenames]
+    filtered = {}
+    for key in keys:
+        name = basename(key.path)  # not sure this makes sense for archive data store
+        mimetype = key.metadata['mimetype']
+        if mimetype and any(pattern.match(mimetype) for pattern in ignore_mimetypes):
+            continue
+        if any(pattern.search(name) for pattern in ignore_filenames):
+            continue
+        filtered[key.digest] = key
+    return filtered
+
+
+# incremented whenever the way record_fingerprint() encodes a record changes,
+# so that record stores can tell which stored fingerprints are out of date
+FINGERPRINT_VERSION = 2
+
+
+def canonical_encoding(value):
+    """
+    Encode *value* as a unicode string which depends on the types as well as
+    the contents of *value* and the items it contains, so that, e.g., 1, 1.0,
+    True and "1", or a tuple and a list of the same items, are encoded
+    differently. Dictionary items and set members are sorted, so that equal
+    dictionaries and sets are encoded in the same way. Each part of the
+    encoding is prefixed by its length, so no two values have the same
+    encoding unless they are equal.
+    """
+    def tagged(tag, text):
+        return u"%s%d:%s" % (tag, len(text), text)
+
+    def container(tag, items):
+        return u"%s%d:%s" % (tag, len(items), u"".join(items))
+
+    if value is None:
+        return u"N"
+    if isinstance(value, bool):
+        return u"B1" if value else u"B0"
+    if isinstance(value, numbers.Integral):
+        return tagged(u"I", u"%d" % value)
+    if isinstance(value, float):
+        return tagged(u"F", u"%r" % value)
+    if isinstance(value, bytes) and not isinstance(value, type(u"")):
+        try:
+            value = value.decode('ascii')  # equal to the unicode string
+        except UnicodeDecodeError:
+            return tagged(u"Y", value.decode('latin-1'))
+    if isinstance(value, string_type):
+        return tagged(u"S", value)
+    if isinstance(value, list):
+        return container(u"L", [canonical_encoding(item) for item in value])
+    if isinstance(value, tuple):
+        return container(u"T", [canonical_encoding(item) for item in value])
+    if isinstance(value, (set, frozenset)):
+        return container(u"E", sorted(canonical_encoding(item) for item in value))
+    if isinstance(value, dict):
+        return container(u"D", sorted(canonical_encoding(key) + canonical_encoding(item)
+                                      for key, item in value.items()))
+    cls = value.__class__
+    return tagged(u"O", u"%s.%s:%r" % (cls.__module__, cls.__name__, value))
+
+
+def record_fingerprint(record):
+    """
+    Return a SHA1 hash of the parts of a record which are compared by
+    :class:`RecordDifference` to decide whether two records differ: the
+    executable, code, dependencies, parameters, script arguments and input and
+    output data (less the data which are ignored by default). Records with the
+    same fingerprint are equal. Records with different fingerprints may still
+    be equal, e.g. if one has more output data than the other.
+
+    Unlike :func:`sumatra.recordstore.serialization.content_hash`, the
+    fingerprint does not depend on the label, timestamp, tags, outcome, etc.
+    """
+    parameters = record.parameters
+    values = parameters.as_dict() if hasattr(parameters, "as_dict") else (parameters or {})
+    values = dict((name, value) for name, value in values.items() if name != "sumatra_label")
+    types = getattr(parameters, "types", {})
+    content = {
+        "executable": [record.executable.__class__.__name__, record.executable.path,
+                       record.executable.name, record.executable.version,
+                       record.executable.options],
+        "repository": [record.repository.__class__.__name__, record.repository.url],
+        "main_file": record.main_file,
+        "version": record.version,
+        "diff": record.diff,
+        "dependencies": sorted([dep.name, dep.path, dep.version, dep.diff]
+                               for dep in record.dependencies),
+        "parameters": [parameters.__class__.__name__, values,
+                       dict((name, t.__name__) for name, t in types.items() if name in values)],
+        "script_arguments": record.script_arguments,
+    }
+    for direction in ("input_data", "output_data"):
+        content[direction] = sorted(filter_datakeys(getattr(record, direction),
+                                                    RecordDifference.ignore_mimetypes,
+                                                    RecordDifference.ignore_filenames))
+    encoded = canonical_encoding(content)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class LazyAttribute(object):
+    """
+    Descriptor for a Record attribute whose value a record store may load only
+    when it is first accessed (see :meth:`Record.set_loader`). As this is a
+    non-data descriptor, once the attribute has been set or loaded it is an
+    ordinary instance attribute.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        try:
+            loader = record.__dict__["_loaders"].pop(self.name)
+        except KeyError:
+            raise AttributeError(self.name)
+        value = record.__dict__[self.name] = loader()
+        return value
+
+
 class Record(object):
     """
     The :class:`Record` class has two main roles: capturing information about
@@ -57,6 +194,9 @@ class Record(object):
     retrieval.
     """
     valid_name_pattern = r'(?P<label>\w+[\w|\-\.:/\s]*)'
+    # potentially large text fields, which record stores may load lazily
+    diff = LazyAttribute("diff")
+    stdout_stderr = LazyAttribute("stdout_stderr")
 
     def __init__(self, executable, repository, main_file, version, launch_mode,
                  datastore, parameters={}, input_data=[], script_arguments='',
@@ -91,6 +231,7 @@ class Record(object):
         self.on_changed = on_changed
         self.stdout_stderr = stdout_stderr
         self.repeats = None
+        self.fingerprint = None
 
     def register(self, working_copy):
         """Record information about the environment."""
@@ -170,6 +311,7 @@ class Record(object):
         # pass # skip this if there is an error
         # Search for newly-created datafiles
         self.output_data = self.datastore.find_new_data(self.timestamp)
+        self.fingerprint = None  # recalculated when next needed
         print("Record label for this run: '%s'" % self.label)
         if self.output_data:
             print("Data keys are %s" % self.output_data)
@@ -182,6 +324,26 @@ class Record(object):
     def __repr__(self):
         return "Record #%s" % self.label
 
+    def __getstate__(self):
+        """For pickling: any lazily-loaded attributes are loaded first."""
+        for name in list(self.__dict__.get("_loaders", ())):
+            getattr(self, name)
+        state = self.__dict__.copy()
+        state.pop("_loaders", None)
+        return state
+
+    def set_loader(self, name, loader):
+        """
+        Arrange for the attribute *name* (e.g. "diff") to be obtained by
+        calling *loader()* when it is first accessed.
+        """
+        self.__dict__.pop(name, None)
+        self.__dict__.setdefault("_loaders", {})[name] = loader
+
+    def get_loader(self, name):
+        """Return the loader for attribute *name*, or None if it has been loaded."""
+        return self.__dict__.get("_loaders", {}).get(name)
+
     def describe(self, format='text', mode='long'):
         """
         Return a description of the record.
@@ -194,7 +356,24 @@ class Record(object):
         formatter = get_formatter(format)([self])
         return formatter.format(mode)
 
+    @property
+    def fingerprint(self):
+        """
+        The :func:`record_fingerprint` of this record, calculated when first
+        needed, unless it was stored with the record.
+        """
+        if self.__dict__.get("_fingerprint") is None:
+            self._fingerprint = record_fingerprint(self)
+        return self._fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, value):
+        self._fingerprint = value
+
     def __ne__(self, other):
+        # records with the same fingerprint are equal, so they need not be compared in detail
+        if self.fingerprint == getattr(other, "fingerprint", None):
+            return False
         return bool(self.difference(other))
 
     def __eq__(self, other):
@@ -238,8 +417,9 @@ class RecordDifference(object):
         self.recordB = recordB
         assert not isinstance(ignore_mimetypes, string_type) # catch a
         assert not isinstance(ignore_filenames, string_type) # common error
-        self.ignore_mimetypes += ignore_mimetypes
-        self.ignore_filenames += ignore_filenames
+        # not +=, which would add to the lists shared by all instances
+        self.ignore_mimetypes = self.ignore_mimetypes + list(ignore_mimetypes)
+        self.ignore_filenames = self.ignore_filenames + list(ignore_filenames)
         self.executable_differs = recordA.executable != recordB.executable
         self.repository_differs = recordA.repository != recordB.repository
         self.main_file_differs = recordA.main_file != recordB.main_file
@@ -251,6 +431,7 @@ class RecordDifference(object):
         self.script_arguments_differ = recordA.script_arguments != recordB.script_arguments
         self.launch_mode_differs = recordA.launch_mode != recordB.launch_mode
         self.diff_differs = recordA.diff != recordB.diff
+        self._datakeys = {}  # filtered data keys, by direction
 
     def __nonzero__(self):
         """
@@ -312,25 +493,14 @@ class RecordDifference(object):
         return diffs
 
     def _list_datakeys(self, direction):
-        keys = {self.recordA.label: {}, self.recordB.label: {}}
         assert direction in ('input_data', 'output_data')
-        for rec in self.recordA, self.recordB:
-            dataset = getattr(rec, direction)
-            for key in dataset:
-                ignore = False
-                name = basename(key.path) # not sure this makes sense for archive data store
-                if key.metadata['mimetype']:
-                    for pattern in self.ignore_mimetypes:
-                        if re.match(pattern, key.metadata['mimetype']):
-                            ignore = True
-                            break
-                for pattern in self.ignore_filenames:
-                    if re.search(pattern, name):
-                        ignore = True
-                        break
-                if not ignore:
-                    keys[rec.label][key.digest] = key
-        return keys
+        if direction not in self._datakeys:
+            keys = {}
+            for rec in self.recordA, self.recordB:
+                keys[rec.label] = filter_datakeys(getattr(rec, direction),
+                                                  self.ignore_mimetypes, self.ignore_filenames)
+            self._datakeys[direction] = keys
+        return self._datakeys[direction]
 
     def _data_differ(self, direction):
         keys = self._list_datakeys(direction)
@@ -372,3 +542,149 @@ class RecordDifference(object):
             return self.recordA.launch_mode, self.recordB.launch_mode
         else:
             return None
+
+
+def _value_codes(values):
+    """
+    Number the distinct values in *values* in order of first appearance, and
+    return the list of the numbers of the values. Values are compared with ==,
+    as by :class:`RecordDifference`, so they need not be hashable.
+    """
+    representatives = []
+    codes = []
+    for value in values:
+        for code, representative in enumerate(representatives):
+            if representative == value:
+                break
+        else:
+            code = len(representatives)
+            representatives.append(value)
+        codes.append(code)
+    return codes
+
+
+def _hashed_codes(values):
+    """As :func:`_value_codes`, for hashable values."""
+    numbers = {}
+    return [numbers.setdefault(value, len(numbers)) for value in values]
+
+
+def _differ(codes):
+    """Return a square matrix (a list of lists) which is True where codes[i] != codes[j]."""
+    if have_numpy:
+        codes = numpy.array(codes)
+        return (codes[:, numpy.newaxis] != codes[numpy.newaxis, :]).tolist()
+    return [[a != b for b in codes] for a in codes]
+
+
+def _parameter_values(record):
+    parameters = record.parameters
+    values = parameters.as_dict() if hasattr(parameters, "as_dict") else (parameters or {})
+    values = dict((name, value) for name, value in values.items() if name != "sumatra_label")
+    types = dict((name, t) for name, t in getattr(parameters, "types", {}).items()
+                 if name in values)
+    return values, types
+
+
+class DifferenceMatrix(object):
+    """
+    Represents the differences between each pair of a list of Record objects,
+    as given by :class:`RecordDifference`, without comparing each pair in
+    turn.
+
+    Each part of a record which RecordDifference compares (the executable,
+    code, parameters, etc.) is looked at once per record, and given a number
+    which is the same for records for which that part is equal. The
+    differences between all pairs of records are then found by comparing
+    these numbers, using numpy when it is available. Only the data keys of
+    pairs of records with different data are compared.
+
+    ``matrices`` maps each of the letters used by ``repr(RecordDifference)``
+    (see ``FLAGS``) to a square matrix of booleans, in which element [i][j]
+    is True if records i and j differ in that respect. As for
+    RecordDifference, the matrices for input and output data are not
+    symmetric: element [i][j] is True if record i has data which record j
+    does not.
+    """
+    FLAGS = (("X", "executable"), ("C", "code"), ("P", "parameters"),
+             ("D", "output data"), ("I", "input data"), ("S", "script arguments"))
+
+    def __init__(self, records, ignore_mimetypes=[], ignore_filenames=[]):
+        assert not isinstance(ignore_mimetypes, string_type)
+        assert not isinstance(ignore_filenames, string_type)
+        self.records = list(records)
+        self.labels = [record.label for record in self.records]
+        self.ignore_mimetypes = RecordDifference.ignore_mimetypes + list(ignore_mimetypes)
+        self.ignore_filenames = RecordDifference.ignore_filenames + list(ignore_filenames)
+        records = self.records
+        dependencies = _hashed_codes(frozenset(record.dependencies) for record in records)
+        repositories = _value_codes(record.repository for record in records)
+        codes = {
+            "X": _value_codes(record.executable for record in records),
+            "C": _hashed_codes(zip(repositories,
+                                   [record.main_file for record in records],
+                                   [record.version for record in records],
+                                   [record.diff for record in records],
+                                   dependencies)),
+            "P": _value_codes(_parameter_values(record) for record in records),
+            "S": _value_codes(record.script_arguments for record in records),
+        }
+        self.matrices = {}
+        for flag, direction in (("D", "output_data"), ("I", "input_data")):
+            digests = [frozenset(filter_datakeys(getattr(record, direction),
+                                                 self.ignore_mimetypes, self.ignore_filenames))
+                       for record in records]
+            codes[flag] = _hashed_codes(digests)
+            matrix = _differ(codes[flag])
+            for i, row in enumerate(matrix):
+                for j, differs in enumerate(row):
+                    if differs:
+                        row[j] = bool(digests[i].difference(digests[j]))
+            self.matrices[flag] = matrix
+        for flag in "XCPS":
+            self.matrices[flag] = _differ(codes[flag])
+        self._codes = list(zip(*[codes[flag] for flag, name in self.FLAGS]))
+
+    def __len__(self):
+        return len(self.records)
+
+    def _index(self, label):
+        return self.labels.index(label)
+
+    def differences(self, label1, label2):
+        """
+        Return the letters (see ``FLAGS``) of the ways in which two records
+        differ, in the same order as ``repr(RecordDifference)``, or an empty
+        string if they do not differ.
+        """
+        i, j = self._index(label1), self._index(label2)
+        return "".join(flag for flag, name in self.FLAGS if self.matrices[flag][i][j])
+
+    def difference(self, label1, label2):
+        """Return the :class:`RecordDifference` between two of the records."""
+        return RecordDifference(self.records[self._index(label1)],
+                                self.records[self._index(label2)],
+                                self.ignore_mimetypes, self.ignore_filenames)
+
+    @property
+    def classes(self):
+        """
+        Return a list of lists of labels of records which do not differ from
+        each other in any respect, in order of the first record of each class.
+        """
+        classes = {}
+        order = []
+        for label, codes in zip(self.labels, self._codes):
+            if codes not in classes:
+                classes[codes] = []
+                order.append(codes)
+            classes[codes].append(label)
+        return [classes[codes] for codes in order]
+
+
+def compare_many(records, ignore_mimetypes=[], ignore_filenames=[]):
+    """
+    Return a :class:`DifferenceMatrix` giving the differences between each
+    pair of *records*.
+    """
+    return DifferenceMatrix(records, ignore_mimetypes, ignore_filenames)
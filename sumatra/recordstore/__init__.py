@@ -9,6 +9,10 @@ Sub-packages/modules
 shelve_store - provides the ShelveRecordStore class
 django_store - provides the DjangoRecordStore class (if Django is installed)
 http_store   - provides the HttpRecordStore class
+routed_store - provides the RoutedRecordStore class, which writes records to
+               one store and reads them from a replica
+sharded_store - provides the ShardedRecordStore class, which distributes
+                records between several stores
 
 
 :copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
@@ -18,6 +22,8 @@ http_store   - provides the HttpRecordStore class
 from . import serialization
 from .base import RecordStore
 from .shelve_store import ShelveRecordStore
+from .routed_store import RoutedRecordStore
+from .sharded_store import ShardedRecordStore
 try:
     from .django_store import DjangoRecordStore
     have_django = True
@@ -40,6 +46,8 @@ def get_record_store(uri):
     Return the :class:`RecordStore` object found at the given URI (which may be
     a URL or filesystem path).
     """
+    if ShardedRecordStore.accepts_uri(uri):  # before the stores whose URIs it contains
+        return ShardedRecordStore(uri)
     for record_store_class in registry.components[RecordStore].values():
         if record_store_class.accepts_uri(uri):
             store = record_store_class(uri)
@@ -6,9 +6,189 @@ Provides base RecordStore class.
 :license: CeCILL, see LICENSE for details.
 """
 
-from sumatra.recordstore import serialization
+from itertools import islice
+from importlib import import_module
+from sumatra.recordstore import serialization, search, query
 from sumatra.formatting import get_formatter
 from ..core import registry
+from ..compatibility import StringIO, string_type
+
+BATCH_SIZE = 100
+# the fields of a record included in tables of records (see RecordStore.iter_rows)
+TABLE_FIELDS = ("label", "timestamp", "reason", "outcome", "duration", "main_file",
+                "version", "script_arguments", "user", "tags")
+PARAMETER_PREFIX = "parameters."
+
+
+def tag_list(tags):
+    """Return *tags*, which may be None, a single tag or a sequence of tags, as a list."""
+    if not tags:
+        return []
+    if not hasattr(tags, "__iter__"):
+        return [tags]
+    return list(tags)
+
+
+def has_tags(record_tags, tags=None, all_tags=None, not_tags=None):
+    """
+    Return True if a set of tags contains at least one of *tags* (if given),
+    all of *all_tags* and none of *not_tags*.
+    """
+    tags, all_tags, not_tags = tag_list(tags), tag_list(all_tags), tag_list(not_tags)
+    return ((not tags or not record_tags.isdisjoint(tags))
+            and record_tags.issuperset(all_tags)
+            and record_tags.isdisjoint(not_tags))
+
+
+def filter_records(records, since=None, until=None, order_by=None,
+                   limit=None, offset=None, where=None, tags=None,
+                   all_tags=None, not_tags=None):
+    """
+    Apply the tag queries, time window, parameter conditions, ordering and
+    paging arguments of :meth:`RecordStore.list` to a sequence of records, for
+    record stores which cannot push these operations down to the storage
+    layer.
+    """
+    if tags or all_tags or not_tags:
+        records = [record for record in records
+                   if has_tags(set(record.tags), tags, all_tags, not_tags)]
+    if where:
+        conditions = query.parse_where(where)
+        records = [record for record in records if query.matches(record, conditions)]
+    if since is not None:
+        records = [record for record in records if record.timestamp >= since]
+    if until is not None:
+        records = [record for record in records if record.timestamp <= until]
+    records = list(records)
+    if order_by:
+        attr = order_by.lstrip("-")
+        records.sort(key=lambda record: getattr(record, attr),
+                     reverse=order_by.startswith("-"))
+    if offset:
+        records = records[offset:]
+    if limit is not None:
+        records = records[:limit]
+    return records
+
+
+def select_fields(records, fields):
+    """
+    Return a list of dicts containing only the given attributes of each
+    record.
+    """
+    return [dict((name, getattr(record, name)) for name in fields)
+            for record in records]
+
+
+def get_field(record, field):
+    """
+    Return the value of a record attribute given by a dotted name, e.g.
+    "datastore.root", or None if it does not exist.
+    """
+    obj = record
+    for part in field.split("."):
+        obj = getattr(obj, part, None)
+    return obj
+
+
+def set_field(record, field, value):
+    """Set the value of a record attribute given by a dotted name."""
+    parts = field.split(".")
+    obj = record
+    for part in parts[:-1]:
+        obj = getattr(obj, part)
+    setattr(obj, parts[-1], value)
+
+
+def update_report(old_values):
+    """
+    Count the number of records modified by :meth:`RecordStore.update` for
+    each previous value of the modified attribute.
+    """
+    report = {}
+    for old_value in old_values:
+        report[old_value] = report.get(old_value, 0) + 1
+    return report
+
+
+def group_by_datastore(output_data):
+    """
+    Merge (datastore, keys) pairs which refer to the same data store, so that
+    the data of many records can be deleted with one call per data store.
+    Return a list of (datastore, keys) pairs.
+    """
+    groups = []
+    positions = {}
+    for datastore, keys in output_data:
+        identity = (datastore.__class__, repr(sorted(datastore.__getstate__().items())))
+        if identity in positions:
+            groups[positions[identity]][1].extend(keys)
+        else:
+            positions[identity] = len(groups)
+            groups.append((datastore, list(keys)))
+    return groups
+
+
+def table_value(value):
+    """
+    Return a parameter value as it appears in a table of records: as a float
+    if it is a number, otherwise as text.
+    """
+    number = query.as_number(value)
+    if number is None:
+        return "%s" % value
+    return number
+
+
+def table_row(record):
+    """
+    Return a dict containing the TABLE_FIELDS of a record, with its tags
+    joined by commas, and its flattened parameters, named "parameters.<name>".
+    """
+    row = dict((field, getattr(record, field)) for field in TABLE_FIELDS)
+    row["tags"] = ",".join(sorted(record.tags))
+    for name, value in query.parameter_values(record.parameters).items():
+        row[PARAMETER_PREFIX + name] = table_value(value)
+    return row
+
+
+def record_store_state(store):
+    """
+    Return the state of a record store, including its type, in the form used
+    in project files, so that it can be re-created by
+    :func:`record_store_from_state`.
+    """
+    state = {'type': store.__class__.__module__ + "." + store.__class__.__name__}
+    state.update(store.__getstate__())
+    return state
+
+
+def record_store_from_state(state):
+    """
+    Return a record store given its state (see :func:`record_store_state`)
+    or its URI. Record stores are returned unchanged. This allows stores
+    which are made up of other stores to be saved in project files.
+    """
+    if isinstance(state, dict):
+        state = dict(state)
+        module_name, class_name = str(state.pop('type')).rsplit(".", 1)
+        cls = getattr(import_module(module_name), class_name)
+        return cls(**dict((str(key), value) for key, value in state.items()))
+    elif isinstance(state, string_type):
+        from sumatra.recordstore import get_record_store
+        return get_record_store(state)
+    return state
+
+
+def latest_modification(hashes, since=None):
+    """
+    Return the most recent modification time in a dict returned by
+    :meth:`RecordStore.content_hashes`, or *since* if that is more recent.
+    """
+    times = [modified for content_hash, modified in hashes.values() if modified is not None]
+    if since is not None:
+        times.append(since)
+    return max(times) if times else None
 
 
 class RecordStore(object):
@@ -30,12 +210,31 @@ class RecordStore(object):
         """Retrieve the record with the given label from the given project."""
         raise NotImplementedError
 
-    def list(self, project_name, tags=None):
+    def list(self, project_name, tags=None, since=None, until=None,
+             limit=None, offset=None, order_by=None, fields=None, where=None,
+             all_tags=None, not_tags=None):
         """
         Return a list of records for the given project.
 
         If *tags* is not provided, list all records, otherwise list only records
         that have been tagged with one or more of the tags.
+
+        *all_tags*: if given, list only records that have all of these tags.
+        *not_tags*: if given, list only records that have none of these tags.
+
+        *since*, *until*: datetimes; if given, list only records whose
+                          timestamp lies within this (inclusive) window.
+        *where*: conditions on parameter values, e.g. "sim.dt<0.1" (see
+                 :mod:`sumatra.recordstore.query`); if given, list only
+                 records whose parameters satisfy them.
+        *order_by*: the name of a record attribute, e.g. "timestamp", by which
+                    the records should be sorted. Prefix the name with "-" for
+                    descending order.
+        *offset*, *limit*: return at most *limit* records, starting after the
+                           first *offset* (applied after ordering).
+        *fields*: a list of attribute names. If given, a list of dicts
+                  containing only these attributes is returned instead of a
+                  list of :class:`Record` objects.
         """
         raise NotImplementedError
 
@@ -43,16 +242,93 @@ class RecordStore(object):
         """Return the labels of all records in the given project."""
         raise NotImplementedError
 
+    def get_many(self, project_name, labels, batch_size=BATCH_SIZE):
+        """
+        Iterate over the records of a project with the given labels,
+        retrieving *batch_size* records at a time. Labels of records which do
+        not exist are skipped. Subclasses should override this to retrieve
+        each batch at once, rather than calling :meth:`get` for each record.
+        """
+        for label in labels:
+            try:
+                yield self.get(project_name, label)
+            except KeyError:
+                pass
+
+    def reindex(self):
+        """
+        Rebuild any indexes the record store keeps of its records, e.g. for
+        records saved by older versions of Sumatra. Return the number of
+        records indexed. Record stores without indexes return 0.
+        """
+        return 0
+
+    def upgrade(self, progress=None):
+        """
+        Upgrade the record store in place to the format used by this version
+        of Sumatra, calling *progress* (if given) with a description of each
+        step. Return a list of the descriptions of the steps taken, or None if
+        the record store cannot be upgraded in place, in which case its
+        records must be exported and re-imported (see "smt upgrade").
+        """
+        return None
+
+    def search(self, project_name, query, limit=None):
+        """
+        Return the records of the given project which match a full-text
+        search query (see :mod:`sumatra.recordstore.search`), newest first.
+
+        This implementation scans all the records. Subclasses may override it
+        to use an index.
+        """
+        found = (record for record in self.iter_records(project_name)
+                 if search.matches(record, query))
+        return filter_records(found, order_by="-timestamp", limit=limit)
+
     def delete(self, project_name, label):
         """Delete the record with the given label from the given project."""
         raise NotImplementedError
 
+    def delete_many(self, project_name, labels):
+        """
+        Delete the records with the given labels from the given project.
+        Labels of records which do not exist are ignored. Return the number of
+        records deleted.
+
+        This implementation deletes the records one at a time. Subclasses
+        should override it to delete them together.
+        """
+        existing = set(self.labels(project_name))
+        n = 0
+        for label in set(labels).intersection(existing):
+            self.delete(project_name, label)
+            n += 1
+        return n
+
+    def output_data(self, project_name, labels):
+        """
+        Return the keys of the output data of the records with the given
+        labels, as a list of (datastore, keys) pairs, one for each data store.
+        Labels of records which do not exist are ignored.
+        """
+        output_data = []
+        for label in labels:
+            try:
+                record = self.get(project_name, label)
+            except KeyError:
+                continue
+            output_data.append((record.datastore, record.output_data))
+        return group_by_datastore(output_data)
+
     def delete_all(self):
         """Delete all records from the store."""
         raise NotImplementedError
 
     def delete_by_tag(self, project_name, tag):
-        """Delete all records from the given project that have been tagged with the given tag."""
+        """
+        Delete all records from the given project that have been tagged with
+        the given tag. Return the number of records deleted.
+        """
         raise NotImplementedError
 
     def most_recent(self, project_name):
@@ -71,11 +347,135 @@ class RecordStore(object):
 
     def import_(self, project_name, content):
         """Import records in JSON format."""
-        records = serialization.decode_records(content)
-        for record in records:
+        return self.import_stream(project_name, StringIO(content))
+
+    def iter_records(self, project_name, batch_size=BATCH_SIZE, tags=None):
+        """
+        Iterate over the records of a project (with at least one of *tags*,
+        if given), in order of label, retrieving *batch_size* records at a
+        time.
+        """
+        offset = 0
+        while True:
+            records = self.list(project_name, tags=tags, order_by="label", offset=offset,
+                                limit=batch_size)
+            for record in records:
+                yield record
+            if len(records) < batch_size:
+                break
+            offset += batch_size
+
+    def iter_rows(self, project_name, tags=None, batch_size=BATCH_SIZE):
+        """
+        Iterate over the records of a project (with at least one of *tags*,
+        if given) as a table, yielding lists of at most *batch_size* rows. Each
+        row is a dict returned by :func:`table_row`.
+
+        Subclasses may override this to build the rows without retrieving
+        whole records.
+        """
+        records = self.iter_records(project_name, batch_size=batch_size, tags=tags)
+        while True:
+            batch = [table_row(record) for record in islice(records, batch_size)]
+            if not batch:
+                break
+            yield batch
+
+    def parameter_columns(self, project_name, tags=None):
+        """
+        Return a dict mapping the names of the parameter columns in a table of
+        the records of a project (see :meth:`iter_rows`) to True if all their
+        values are numbers and False otherwise.
+        """
+        columns = {}
+        for batch in self.iter_rows(project_name, tags=tags):
+            for row in batch:
+                for name, value in row.items():
+                    if name.startswith(PARAMETER_PREFIX):
+                        columns[name] = columns.get(name, True) and isinstance(value, float)
+        return columns
+
+    def export_stream(self, project_name, fileobj, progress=None):
+        """
+        Write the records of a project to a file-like object in JSON Lines
+        format (one JSON-encoded record per line), without holding all of the
+        records in memory at once.
+
+        If given, *progress* is called with the number of records written so
+        far. Returns the number of records written.
+        """
+        n = 0
+        for record in self.iter_records(project_name):
+            fileobj.write(serialization.encode_record(record) + "\n")
+            n += 1
+            if progress:
+                progress(n)
+        return n
+
+    def import_stream(self, project_name, fileobj, batch_size=BATCH_SIZE, progress=None):
+        """
+        Import records from a file-like object in JSON Lines format (or in the
+        JSON format produced by :meth:`export`), saving them in batches of
+        *batch_size* records.
+
+        If given, *progress* is called with the number of records imported so
+        far. Returns the number of records imported.
+        """
+        records = serialization.read_records(fileobj)
+        n = 0
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
             # need to check for duplicate record labels?
+            self.save_batch(project_name, batch)
+            n += len(batch)
+            if progress:
+                progress(n)
+        return n
+
+    def save_batch(self, project_name, records):
+        """
+        Store several records under the given project. Subclasses may
+        override this to store them more efficiently than by calling
+        :meth:`save` for each one.
+        """
+        for record in records:
             self.save(project_name, record)
 
+    def content_hashes(self, project_name, labels=None, since=None):
+        """
+        Return a dict mapping record labels to (content hash, modification
+        time) tuples, where the modification time is when the record was last
+        saved in this store (according to the store's own clock) or None if
+        not known.
+
+        Arguments:
+          *labels*: restrict the result to records with the given labels.
+          *since*: restrict the result to records modified after this datetime.
+                   Stores which do not track modification times may return
+                   additional records.
+        """
+        # Note: this default implementation loads every record. Subclasses
+        #       should store the hashes when records are saved.
+        if labels is None:
+            records = self.list(project_name)
+        else:
+            labels = set(labels).intersection(self.labels(project_name))
+            records = [self.get(project_name, label) for label in labels]
+        return dict((record.label, (serialization.content_hash(record), None))
+                    for record in records)
+
+    def _get_sync_watermark(self, project_name, other):
+        """
+        Return the modification times (in this store and in *other*) up to
+        which the given project was known to be in sync with *other*, or None.
+        """
+        return None
+
+    def _set_sync_watermark(self, project_name, other, watermark):
+        pass
+
     def sync(self, other, project_name):
         """
         Synchronize two record stores so that they contain the same records for
@@ -85,22 +485,47 @@ class RecordStore(object):
         different records, those records will not be synced. The method
         returns a list of non-synchronizable records (empty if the sync worked
         perfectly).
+
+        Records are compared by their content hashes, and only loaded if the
+        hashes differ. After a successful sync, a watermark is stored so that
+        subsequent syncs need only consider records modified since then, and
+        records missing from one store or the other, e.g. because they have
+        been deleted since then, which are copied back.
         """
         # what to do about syncing different Sumatra versions? Need to think about
         # schema versioning
-        self_labels = set(self.labels(project_name))
-        other_labels = set(other.labels(project_name))
-        only_in_self = self_labels.difference(other_labels)
-        only_in_other = other_labels.difference(self_labels)
-        in_both = self_labels.intersection(other_labels)
+        watermark = self._get_sync_watermark(project_name, other)
+        self_since, other_since = watermark or (None, None)
+        self_hashes = self.content_hashes(project_name, since=self_since)
+        other_hashes = other.content_hashes(project_name, since=other_since)
+        new_watermark = (latest_modification(self_hashes, self_since),
+                         latest_modification(other_hashes, other_since))
+        if watermark:
+            # a record modified in one store may exist, unmodified, in the other,
+            # and comparing the labels catches records deleted from one store
+            self_labels = set(self.labels(project_name))
+            other_labels = set(other.labels(project_name))
+            wanted = set(self_hashes).union(other_hashes, self_labels.symmetric_difference(other_labels))
+            missing = wanted.intersection(self_labels).difference(self_hashes)
+            if missing:
+                self_hashes.update(self.content_hashes(project_name, labels=missing))
+            missing = wanted.intersection(other_labels).difference(other_hashes)
+            if missing:
+                other_hashes.update(other.content_hashes(project_name, labels=missing))
+        only_in_self = set(self_hashes).difference(other_hashes)
+        only_in_other = set(other_hashes).difference(self_hashes)
+        in_both = set(self_hashes).intersection(other_hashes)
         non_synchronizable = []
         for label in in_both:
-            if self.get(project_name, label) != other.get(project_name, label):
-                non_synchronizable.append(label)
+            if self_hashes[label][0] != other_hashes[label][0]:
+                if self.get(project_name, label) != other.get(project_name, label):
+                    non_synchronizable.append(label)
         for label in only_in_self:
             other.save(project_name, self.get(project_name, label))
         for label in only_in_other:
             self.save(project_name, other.get(project_name, label))
+        if not non_synchronizable:
+            self._set_sync_watermark(project_name, other, new_watermark)
         return non_synchronizable
 
     def sync_all(self, other):
@@ -113,13 +538,19 @@ class RecordStore(object):
         """Does the store contain any records for the given project?"""
         raise NotImplementedError
 
-    def update(self, project_name, field, value, tags=None):
+    def update(self, project_name, field, value, tags=None, dry_run=False):
         """
         Modify the records for a given project.
 
         Arguments:
           *field*: the name of a record attribute, e.g. "datastore.root"
-          *value*: 
+          *value*: the new value of the attribute
+          *tags*: if given, only records with one of these tags are modified
+          *dry_run*: if True, report which records would be modified, but do
+                     not modify them
+
+        Returns a dict mapping the previous values of the attribute to the
+        number of records which had that value.
         """
         # there is only a limited number of attributes that should be
         # modifiable, otherwise the whole point of using Sumatra for
@@ -127,13 +558,14 @@ class RecordStore(object):
         # attributes as modifiable?
         # Note: this default implementation is likely to be slow. For most
         #       subclasses it would be best to override this method.
-        for record in self.list(project_name, tags):
-            parts = field.split(".")
-            obj = record
-            for part in parts[:-1]:
-                obj = getattr(obj, part)
-            setattr(obj, parts[-1], value)
-            self.save(project_name, record)
+        changes = [(record, get_field(record, field))
+                   for record in self.list(project_name, tags)]
+        changes = [(record, old_value) for record, old_value in changes if old_value != value]
+        if not dry_run:
+            for record, old_value in changes:
+                set_field(record, field, value)
+                self.save(project_name, record)
+        return update_report(old_value for record, old_value in changes)
 
 
 registry.add_component_type(RecordStore)
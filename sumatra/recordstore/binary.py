@@ -0,0 +1,232 @@
+"""
+A compact binary encoding of JSON-compatible data, using the MessagePack format
+(http://msgpack.org/). Strings longer than COMPRESSION_THRESHOLD bytes are
+compressed with zlib and stored as a MessagePack extension type, so that large
+text fields such as stdout_stderr and diff take up less space.
+
+If the msgpack package is installed, it is used for packing and unpacking.
+Otherwise a pure Python implementation of the parts of the format which are
+needed for Sumatra records is used. Both produce the same data: byte strings
+(str in Python 2) are decoded as UTF-8 before packing, so that all strings are
+packed as MessagePack str, never as bin, and are unpacked as unicode.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+from __future__ import absolute_import
+import struct
+import zlib
+from collections import namedtuple
+try:
+    import msgpack
+    have_msgpack = True
+except ImportError:
+    have_msgpack = False
+
+try:
+    text_type = unicode  # Python 2
+    integer_types = (int, long)
+except NameError:
+    text_type = str  # Python 3
+    integer_types = (int,)
+
+COMPRESSED_TEXT = 1  # extension type code for zlib-compressed, UTF-8 encoded text
+COMPRESSION_THRESHOLD = 256  # bytes
+
+if have_msgpack:
+    ExtType = msgpack.ExtType
+else:
+    ExtType = namedtuple("ExtType", "code data")
+
+
+def _text(obj):
+    """Decode a byte string (str in Python 2) as UTF-8. Leave anything else as it is."""
+    if isinstance(obj, str) and not isinstance(obj, text_type):
+        return obj.decode("utf-8")
+    return obj
+
+
+def _compress_strings(obj):
+    """
+    Return a copy of `obj` in which all strings are unicode and long strings
+    are replaced by compressed extension objects, if that makes them smaller.
+    """
+    if isinstance(obj, (text_type, str)):
+        obj = _text(obj)
+        data = obj.encode("utf-8")
+        if len(data) >= COMPRESSION_THRESHOLD:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                return ExtType(COMPRESSED_TEXT, compressed)
+        return obj
+    elif isinstance(obj, dict):
+        return dict((_text(key), _compress_strings(value)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return [_compress_strings(item) for item in obj]
+    return obj
+
+
+def _decompress(code, data):
+    if code == COMPRESSED_TEXT:
+        return zlib.decompress(bytes(data)).decode("utf-8")
+    raise ValueError("Unknown MessagePack extension type %d" % code)
+
+
+def packb(obj):
+    """Encode a JSON-compatible object as MessagePack, compressing long strings."""
+    obj = _compress_strings(obj)
+    if have_msgpack:
+        return msgpack.packb(obj, use_bin_type=True)
+    chunks = []
+    _pack(obj, chunks)
+    return b"".join(chunks)
+
+
+def unpackb(data):
+    """Decode MessagePack data produced by packb()."""
+    if have_msgpack:
+        return msgpack.unpackb(data, raw=False, ext_hook=_decompress)
+    obj, position = _unpack(bytearray(data), 0)
+    if position != len(data):
+        raise ValueError("Extra data after MessagePack object")
+    return obj
+
+
+def _pack_header(n, chunks, fix_code, fix_limit, codes):
+    if n < fix_limit:
+        chunks.append(struct.pack(">B", fix_code | n))
+    elif n < 0x10000:
+        chunks.append(struct.pack(">BH", codes[0], n))
+    else:
+        chunks.append(struct.pack(">BI", codes[1], n))
+
+
+def _pack(obj, chunks):
+    if obj is None:
+        chunks.append(b"\xc0")
+    elif obj is True:
+        chunks.append(b"\xc3")
+    elif obj is False:
+        chunks.append(b"\xc2")
+    elif isinstance(obj, integer_types):
+        if 0 <= obj < 0x80:
+            chunks.append(struct.pack(">B", obj))
+        elif -0x20 <= obj < 0:
+            chunks.append(struct.pack(">b", obj))
+        elif 0 <= obj < 0x100:
+            chunks.append(struct.pack(">BB", 0xcc, obj))
+        elif 0 <= obj < 0x10000:
+            chunks.append(struct.pack(">BH", 0xcd, obj))
+        elif 0 <= obj < 0x100000000:
+            chunks.append(struct.pack(">BI", 0xce, obj))
+        elif 0 <= obj < 0x10000000000000000:
+            chunks.append(struct.pack(">BQ", 0xcf, obj))
+        elif -0x80 <= obj < 0:
+            chunks.append(struct.pack(">Bb", 0xd0, obj))
+        elif -0x8000 <= obj < 0:
+            chunks.append(struct.pack(">Bh", 0xd1, obj))
+        elif -0x80000000 <= obj < 0:
+            chunks.append(struct.pack(">Bi", 0xd2, obj))
+        elif -0x8000000000000000 <= obj < 0:
+            chunks.append(struct.pack(">Bq", 0xd3, obj))
+        else:
+            raise ValueError("Integer %d is too large to encode" % obj)
+    elif isinstance(obj, float):
+        chunks.append(struct.pack(">Bd", 0xcb, obj))
+    elif isinstance(obj, (text_type, str)):
+        data = obj.encode("utf-8") if isinstance(obj, text_type) else obj
+        n = len(data)
+        if n < 0x20:
+            chunks.append(struct.pack(">B", 0xa0 | n))
+        elif n < 0x100:
+            chunks.append(struct.pack(">BB", 0xd9, n))
+        else:
+            _pack_header(n, chunks, 0, 0, (0xda, 0xdb))
+        chunks.append(data)
+    elif isinstance(obj, ExtType):  # must come before tuple, as ExtType is a namedtuple
+        n = len(obj.data)
+        if n < 0x100:
+            chunks.append(struct.pack(">BBb", 0xc7, n, obj.code))
+        elif n < 0x10000:
+            chunks.append(struct.pack(">BHb", 0xc8, n, obj.code))
+        else:
+            chunks.append(struct.pack(">BIb", 0xc9, n, obj.code))
+        chunks.append(obj.data)
+    elif isinstance(obj, (list, tuple)):
+        _pack_header(len(obj), chunks, 0x90, 0x10, (0xdc, 0xdd))
+        for item in obj:
+            _pack(item, chunks)
+    elif isinstance(obj, dict):
+        _pack_header(len(obj), chunks, 0x80, 0x10, (0xde, 0xdf))
+        for key, value in obj.items():
+            _pack(key, chunks)
+            _pack(value, chunks)
+    else:
+        raise TypeError("Cannot encode object of type %s" % type(obj).__name__)
+
+
+# type code -> (struct format, size) for fixed-size values
+_FIXED = {
+    0xca: (">f", 4), 0xcb: (">d", 8),
+    0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+    0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8),
+}
+# type code -> struct format of the length field, for variable-size values
+_LENGTH = {
+    0xc4: ">B", 0xc5: ">H", 0xc6: ">I",  # bin
+    0xc7: ">B", 0xc8: ">H", 0xc9: ">I",  # ext
+    0xd9: ">B", 0xda: ">H", 0xdb: ">I",  # str
+    0xdc: ">H", 0xdd: ">I",  # array
+    0xde: ">H", 0xdf: ">I",  # map
+}
+_FIXEXT = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+
+
+def _unpack(data, position):
+    """Decode the object starting at `position`. Return it and the next position."""
+    code = data[position]
+    position += 1
+    if code < 0x80:
+        return code, position
+    elif code >= 0xe0:
+        return code - 0x100, position
+    elif code == 0xc0:
+        return None, position
+    elif code == 0xc2:
+        return False, position
+    elif code == 0xc3:
+        return True, position
+    elif code in _FIXED:
+        format, size = _FIXED[code]
+        return struct.unpack_from(format, data, position)[0], position + size
+    if code in _LENGTH:
+        format = _LENGTH[code]
+        n = struct.unpack_from(format, data, position)[0]
+        position += struct.calcsize(format)
+    elif code in _FIXEXT:
+        n = _FIXEXT[code]
+    else:
+        n = code & 0x1f if 0xa0 <= code < 0xc0 else code & 0x0f
+    if 0xa0 <= code < 0xc0 or code in (0xd9, 0xda, 0xdb):
+        return bytes(data[position:position + n]).decode("utf-8"), position + n
+    elif code in (0xc4, 0xc5, 0xc6):
+        return bytes(data[position:position + n]), position + n
+    elif code in (0xc7, 0xc8, 0xc9) or code in _FIXEXT:
+        ext_code = struct.unpack_from(">b", data, position)[0]
+        position += 1
+        return _decompress(ext_code, data[position:position + n]), position + n
+    elif 0x90 <= code < 0xa0 or code in (0xdc, 0xdd):
+        items = []
+        for i in range(n):
+            item, position = _unpack(data, position)
+            items.append(item)
+        return items, position
+    elif 0x80 <= code < 0x90 or code in (0xde, 0xdf):
+        obj = {}
+        for i in range(n):
+            key, position = _unpack(data, position)
+            obj[key], position = _unpack(data, position)
+        return obj, position
+    raise ValueError("Invalid MessagePack type code 0x%x" % code)
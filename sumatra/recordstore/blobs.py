@@ -0,0 +1,71 @@
+"""
+Helpers for storing large text fields of records (stdout_stderr, diff and the
+diffs of dependencies) as content-addressed "blobs": each distinct text is
+stored once, identified by its SHA1 hash, optionally compressed with zlib, and
+shared between all the records which contain it.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import hashlib
+import zlib
+
+BLOB_FIELDS = ("stdout_stderr", "diff")
+BLOB_THRESHOLD = 256  # texts shorter than this (in bytes) are stored with the record
+
+
+def encode_text(text):
+    """
+    Return the UTF-8 encoding of `text`, or None if it is too short to be
+    worth storing as a blob or (for byte strings) is not valid UTF-8.
+    """
+    if not text or len(text) < BLOB_THRESHOLD:
+        return None
+    if isinstance(text, bytes):
+        try:
+            text.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+        return text
+    return text.encode("utf-8")
+
+
+def blob_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def pack(data, compress=True):
+    """
+    Return a tuple (content, compressed) for UTF-8 encoded text, compressing it
+    if requested and if that makes it smaller.
+    """
+    if compress:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return compressed, True
+    return data, False
+
+
+def unpack(content, compressed):
+    """Return the text stored in a blob."""
+    content = bytes(content)
+    if compressed:
+        content = zlib.decompress(content)
+    return content.decode("utf-8")
+
+
+class BlobLoader(object):
+    """
+    Loads the text of a blob from a record store when called. Used with
+    Record.set_loader(), so that records can be retrieved without their large
+    text fields.
+    """
+
+    def __init__(self, load, blob_hash):
+        self.load = load
+        self.hash = blob_hash
+
+    def __call__(self):
+        return self.load(self.hash)
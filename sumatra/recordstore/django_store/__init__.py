@@ -11,25 +11,55 @@ SQLite or PostgreSQL.
 
 
 import os
+import hashlib
+import threading
+from datetime import datetime
 from textwrap import dedent
 import imp
 import django.conf as django_conf
 from django.core import management
-from sumatra.recordstore.base import RecordStore
+from sumatra.recordstore.base import (RecordStore, select_fields, tag_list, group_by_datastore,
+                                      BATCH_SIZE, TABLE_FIELDS, PARAMETER_PREFIX)
+from sumatra.recordstore.serialization import content_hash
+from sumatra.records import record_fingerprint
+from sumatra.recordstore import blobs
+from sumatra.recordstore.search import SearchIndex
+from .schema import SCHEMA_VERSION, schema_version, migrate
+from sumatra.recordstore.query import parse_where, parameter_values, as_number
 from ...core import registry
-from ...compatibility import StringIO, urlparse
+from ...compatibility import StringIO, urlparse, parse_qsl
 
 # Check that django-tagging is available. It would be better to try importing
 # it, but that seems to mess with Django's internals.
 imp.find_module("tagging")
 
 
+# How long (in seconds) to keep a connection to a database server open for
+# re-use. Django closes connections older than this at the end of each
+# request (e.g. in smtweb); 0 closes them every time, None never.
+DEFAULT_CONN_MAX_AGE = 600
+# How long (in seconds) to wait for a lock on an SQLite database held by
+# another process (e.g. another job saving its record) before giving up.
+DEFAULT_SQLITE_TIMEOUT = 10
+
+
 class DjangoConfiguration(object):
     """
     To allow multiple DjangoRecordStore instances to exist at the same
     time, this class allows the database configuration to be built up in several
     steps, only actually doing the Django configuration step at the last
     possible moment.
+
+    Connection options can be given as query parameters of the database URI:
+    "conn_max_age" (seconds, or "none" for no limit) and, for PostgreSQL, any
+    libpq connection parameter (e.g. "sslmode" or "connect_timeout"). To share
+    a pool of connections between many processes, point the URI at a
+    connection pooler such as PgBouncer.
+
+    For SQLite, "timeout" sets how long to wait for a lock held by another
+    process, and "journal_mode=wal" switches the database to write-ahead
+    logging, so that reading does not block writing. WAL needs shared memory,
+    so it must not be used for databases on network file systems.
     """
 
     def __init__(self):
@@ -42,20 +72,34 @@ class DjangoConfiguration(object):
         }
         self._n_databases = 0
         self.configured = False
+        self.applied_migrations = {}  # by database label
+        self._lock = threading.Lock()  # stores may be used from several threads (see ShardedRecordStore)
 
     def uri_to_db(self, uri):
         parse_result = urlparse(uri)
         db = {}
         if 'postgres' in parse_result.scheme:
+            options = dict(parse_qsl(parse_result.query))
+            conn_max_age = options.pop('conn_max_age', DEFAULT_CONN_MAX_AGE)
             db['ENGINE'] = 'django.db.backends.postgresql_psycopg2'
             db['NAME'] = os.path.split(parse_result.path)[-1]
             db['HOST'] = parse_result.hostname
             db['USER'] = parse_result.username
             db['PASSWORD'] = parse_result.password
             db['PORT'] = parse_result.port or ''
+            if str(conn_max_age).lower() == 'none':
+                db['CONN_MAX_AGE'] = None
+            else:
+                db['CONN_MAX_AGE'] = int(conn_max_age)
+            db['OPTIONS'] = options
         else:
+            options = dict(parse_qsl(parse_result.query))
             db['ENGINE'] = 'django.db.backends.sqlite3'
             db['NAME'] = os.path.abspath(parse_result.path)
+            db['CONN_MAX_AGE'] = None  # a local file, so the connection can always be re-used
+            db['OPTIONS'] = {'timeout': float(options.get('timeout', DEFAULT_SQLITE_TIMEOUT))}
+            if 'journal_mode' in options:
+                db['JOURNAL_MODE'] = options['journal_mode'].upper()
         return db
 
     def add_database(self, uri):
@@ -90,17 +134,125 @@ class DjangoConfiguration(object):
                 db_file = db['NAME']
                 if not os.path.exists(os.path.dirname(db_file)):
                     os.makedirs(os.path.dirname(db_file))
+            if not self._schema_is_current(label):
                 management.call_command('syncdb', database=label, verbosity=0)
-            else:
-                management.call_command('syncdb', database=label, verbosity=0)
+                self.applied_migrations[label] = migrate(label)
+
+    def _schema_is_current(self, label):
+        """
+        Check whether the database schema is at the version used by this
+        version of Sumatra, so that we can skip the (relatively slow) syncdb
+        and migrations.
+        """
+        return schema_version(label) >= SCHEMA_VERSION
 
     def configure(self):
         settings = django_conf.settings
-        if not settings.configured:
-            settings.configure(**self._settings)
-            if not self.configured:
-                self._create_databases()
-            self.configured = True
+        with self._lock:
+            if not settings.configured:
+                settings.configure(**self._settings)
+                from django.db.backends.signals import connection_created
+                connection_created.connect(_set_journal_mode)
+                if not self.configured:
+                    self._create_databases()
+                self.configured = True
+
+
+def save_parameter_values(db_record, parameters, db_label, replace=True):
+    """Store the flattened parameters of a record in the ParameterValue table."""
+    from . import models
+    values = models.ParameterValue.objects.using(db_label)
+    if replace:
+        values.filter(record=db_record).delete()
+    values.bulk_create(models.ParameterValue(record=db_record, name=name,
+                                             numeric=as_number(value), text="%s" % value)
+                       for name, value in sorted(parameter_values(parameters).items()))
+
+
+def delete_records(db_records, db_label):
+    """
+    Delete a queryset of records in a single transaction, letting the
+    database cascade the deletion to the rows which belong to them (output
+    data keys, index entries, etc.) and removing their full-text search
+    entries in the same transaction. Return the number of records deleted.
+    """
+    from django.db import transaction
+    with transaction.atomic(using=db_label):
+        record_ids = list(db_records.values_list('pk', flat=True))
+        if record_ids:
+            SearchIndex(db_label).remove(record_ids)
+            db_records.delete()
+    return len(record_ids)
+
+
+def output_data(db_records):
+    """
+    Return the keys of the output data of a queryset of records, as a list
+    of (datastore, keys) pairs, one for each data store, using one query.
+    """
+    from . import models
+    db_keys = models.DataKey.objects.using(db_records.db).filter(
+        output_from_record__in=db_records.values('pk')).select_related('output_from_record__datastore')
+    db_datastores = {}
+    keys = {}
+    for db_key in db_keys:
+        db_datastore = db_key.output_from_record.datastore
+        db_datastores[db_datastore.pk] = db_datastore
+        keys.setdefault(db_datastore.pk, []).append(db_key.to_sumatra())
+    return group_by_datastore((db_datastores[pk].to_sumatra(), keys[pk]) for pk in sorted(keys))
+
+
+def index_tags(db_records, db_label):
+    """
+    Re-create the RecordTag entries for a queryset of records from their tags
+    field, in a single transaction. Return the number of records indexed.
+    """
+    from django.db import transaction
+    from tagging.utils import parse_tag_input
+    from . import models
+    tag_index = models.RecordTag.objects.using(db_label)
+    n = 0
+    with transaction.atomic(using=db_label):
+        tag_index.filter(record__in=db_records.values('pk')).delete()
+        entries = []
+        for pk, tags in db_records.values_list('pk', 'tags').iterator():
+            entries.extend(models.RecordTag(record_id=pk, name=name)
+                           for name in set(parse_tag_input(tags or "")))
+            n += 1
+        tag_index.bulk_create(entries, batch_size=BATCH_SIZE)
+    return n
+
+
+def index_parameters(db_records, db_label):
+    """
+    Re-create the ParameterValue entries for a queryset of records, in
+    batches of BATCH_SIZE records, each in a single transaction. Return the
+    number of records indexed.
+    """
+    from django.db import transaction
+    from . import models
+    db_records = db_records.select_related('parameters').order_by('pk')
+    n = 0
+    last_pk = None
+    while True:
+        batch = db_records if last_pk is None else db_records.filter(pk__gt=last_pk)
+        batch = list(batch[:BATCH_SIZE])
+        with transaction.atomic(using=db_label):
+            models.ParameterValue.objects.using(db_label).filter(
+                record__in=[db_record.pk for db_record in batch]).delete()
+            for db_record in batch:
+                save_parameter_values(db_record, db_record.parameters.to_sumatra(), db_label,
+                                      replace=False)
+        n += len(batch)
+        if len(batch) < BATCH_SIZE:
+            return n
+        last_pk = batch[-1].pk
+
+
+def _set_journal_mode(sender, connection, **kwargs):
+    journal_mode = connection.settings_dict.get('JOURNAL_MODE')
+    if journal_mode:
+        connection.connection.execute('PRAGMA journal_mode=%s' % journal_mode)
 
 db_config = DjangoConfiguration()
 
@@ -113,20 +265,41 @@ class DjangoRecordStore(RecordStore):
     SQLite or PostgreSQL.
 
     This record store is needed for the *smtweb* interface.
+
+    Long text fields (stdout_stderr, diff and the diffs of dependencies) are
+    stored once in a table of blobs shared between records, compressed with
+    zlib unless *compress_blobs* is False.
+
+    With SQLite, records are indexed for full-text search (see :meth:`search`)
+    as they are saved. Parameter values and tags are stored in tables of their
+    own, so that records can be selected by them (see the *where* and tag
+    arguments of :meth:`list`).
     """
 
-    def __init__(self, db_file='.smt/records'):
+    _column_fields = ('label', 'timestamp', 'reason', 'duration', 'outcome',
+                      'main_file', 'version', 'user', 'script_arguments',
+                      'repeats', 'tags')
+
+    def __init__(self, db_file='.smt/records', compress_blobs=True):
         self._db_label = db_config.add_database(db_file)
         self._db_file = db_file
+        self.compress_blobs = compress_blobs
+        self._identity_cache = {}
+
+    @property
+    def _search_index(self):
+        return SearchIndex(self._db_label)
 
     def __str__(self):
         return "Django (%s)" % self._db_file
 
     def __getstate__(self):
-        return {'db_file': self._db_file}
+        return {'db_file': self._db_file, 'compress_blobs': self.compress_blobs}
 
     def __setstate__(self, state):
         self._db_file = state['db_file']
+        self.compress_blobs = state.get('compress_blobs', True)
+        self._identity_cache = {}
         try:
             self._db_label = db_config.add_database(self._db_file)
         except:
@@ -146,7 +319,7 @@ class DjangoRecordStore(RecordStore):
         assert settings.configured is False
         db_config = DjangoConfiguration()
         if db_file:
-            self.__init__(db_file)
+            self.__init__(db_file, self.compress_blobs)
 
     @property
     def _manager(self):
@@ -165,21 +338,171 @@ class DjangoRecordStore(RecordStore):
 
     def _get_db_project(self, project_name):
         models = self._get_models()
+        key = ('Project', project_name)
+        if key in self._identity_cache:
+            return self._cached_instance(models.Project, key, {})
         try:
             db_project = models.Project.objects.using(self._db_label).get(id=project_name)
         except models.Project.DoesNotExist:
             db_project = models.Project(id=project_name)
             db_project.save(using=self._db_label)
+        self._identity_cache[key] = db_project.pk
         return db_project
 
+    def _cached_instance(self, cls, key, attributes):
+        """
+        Return an instance of *cls* for a row whose id is in the identity
+        cache, without querying the database.
+        """
+        db_obj = cls(pk=self._identity_cache[key], **attributes)
+        db_obj._state.db = self._db_label
+        db_obj._state.adding = False
+        return db_obj
+
     def _get_db_obj(self, db_class, obj):
+        """
+        Return the row which stores a Sumatra object, e.g. an Executable,
+        creating it if necessary.
+
+        These rows are shared between records and never deleted (except by
+        :meth:`delete_all`), so their ids are memoized in an identity cache,
+        keyed by the values of their fields, and repeated saves of records
+        with the same executable, repository, etc. need no queries for them.
+        """
         models = self._get_models()
         cls = getattr(models, db_class)
-        db_obj, created = cls.objects.get_or_create_from_sumatra_object(obj, using=self._db_label)
-        if created:
-            db_obj.save(using=self._db_label)
+        attributes = cls.objects.sumatra_attributes(obj)
+        key = (db_class, repr(sorted(attributes.items())))
+        if key in self._identity_cache:
+            return self._cached_instance(cls, key, attributes)
+        db_obj, created = cls.objects.using(self._db_label).get_or_create(**attributes)
+        self._identity_cache[key] = db_obj.pk
         return db_obj
 
+    def _get_db_data_keys(self, keys):
+        """
+        Return the rows storing the given DataKeys which already exist, using
+        one query, and unsaved rows for the others.
+
+        DataKey rows are deleted together with the record they are the output
+        of, so unlike the other shared rows they are not memoized.
+        """
+        models = self._get_models()
+        manager = models.DataKey.objects
+        fields = [models.DataKey._meta.get_field(name) for name in ('path', 'digest', 'metadata')]
+        wanted = []
+        for key in keys:
+            attributes = manager.sumatra_attributes(key)
+            identity = tuple(field.get_prep_value(attributes[field.name]) for field in fields)
+            wanted.append((identity, attributes))
+        existing = {}
+        for db_key in manager.using(self._db_label).filter(path__in=set(w[0][0] for w in wanted)):
+            existing.setdefault((db_key.path, db_key.digest, db_key.metadata), db_key)
+        found = []
+        missing = {}
+        for identity, attributes in wanted:
+            if identity in existing:
+                found.append(existing[identity])
+            elif identity not in missing:
+                missing[identity] = models.DataKey(**attributes)
+        return found, missing.values()
+
+    def _save_data_keys(self, db_record, record):
+        """
+        Link a record to its input and output data, creating the DataKey rows
+        which do not exist yet with bulk inserts.
+        """
+        models = self._get_models()
+        data_keys = models.DataKey.objects.using(self._db_label)
+        chunk_size = 900  # SQLite has problems with inserts >= ca. 1000, so for safety we split it into chunks
+        for i in xrange(0, len(record.input_data), chunk_size):
+            chunk = record.input_data[i:i + chunk_size]
+            db_keys, missing = self._get_db_data_keys(chunk)
+            if missing:
+                data_keys.bulk_create(missing)
+                db_keys, missing = self._get_db_data_keys(chunk)  # bulk_create does not set the ids
+            db_record.input_data.add(*db_keys)
+        for i in xrange(0, len(record.output_data), chunk_size):
+            db_keys, missing = self._get_db_data_keys(record.output_data[i:i + chunk_size])
+            if db_keys:
+                data_keys.filter(pk__in=[db_key.pk for db_key in db_keys]).update(output_from_record=db_record)
+            for db_key in missing:
+                db_key.output_from_record = db_record
+            data_keys.bulk_create(missing)
+
+    def _get_blob(self, text):
+        """
+        Return the Blob holding *text*, creating it if necessary, or None if the
+        text should be stored directly in the record.
+        """
+        data = blobs.encode_text(text)
+        if data is None:
+            return None
+        models = self._get_models()
+        h = blobs.blob_hash(data)
+        blob_objects = models.Blob.objects.using(self._db_label)
+        try:
+            return blob_objects.get(hash=h)
+        except models.Blob.DoesNotExist:
+            content, compressed = blobs.pack(data, self.compress_blobs)
+            blob, created = blob_objects.get_or_create(hash=h, defaults={"content": content,
+                                                                         "compressed": compressed})
+            return blob
+
+    def _get_db_dependency(self, dep):
+        models = self._get_models()
+        attributes = dict(name=dep.name, path=dep.path, version=dep.version,
+                          source=dep.source, module=dep.module)
+        diff = dep.diff or b""
+        if not isinstance(diff, bytes):
+            diff = diff.encode("utf-8")
+        key = ('Dependency', repr(sorted(attributes.items())), hashlib.sha1(diff).hexdigest())
+        if key in self._identity_cache:
+            return self._cached_instance(models.Dependency, key, attributes)
+        db_dep = self._get_uncached_db_dependency(dep, attributes)
+        self._identity_cache[key] = db_dep.pk
+        return db_dep
+
+    def _get_uncached_db_dependency(self, dep, attributes):
+        models = self._get_models()
+        blob = self._get_blob(dep.diff)
+        dependencies = models.Dependency.objects.using(self._db_label)
+        if blob is None:
+            db_dep, created = dependencies.get_or_create(diff=dep.diff, blobs__isnull=True, **attributes)
+        else:
+            try:
+                db_dep = dependencies.filter(diff="", blobs__diff=blob, **attributes)[0]
+            except IndexError:
+                db_dep = models.Dependency(diff="", **attributes)
+                db_dep.save(using=self._db_label)
+                models.DependencyBlobs(dependency=db_dep, diff=blob).save(using=self._db_label)
+        return db_dep
+
+    def _save_blobs(self, db_record, record):
+        """
+        Store the long text fields of a record as blobs, and the short ones
+        directly in the record table.
+        """
+        models = self._get_models()
+        record_blobs = {}
+        for name in blobs.BLOB_FIELDS:
+            text = getattr(record, name)
+            blob = self._get_blob(text)
+            if blob is None:
+                setattr(db_record, name, text)
+            else:
+                setattr(db_record, name, "")
+                record_blobs[name] = blob
+        if record_blobs:
+            models.RecordBlobs(record=db_record, **record_blobs).save(using=self._db_label)
+        else:
+            models.RecordBlobs.objects.using(self._db_label).filter(record=db_record).delete()
+
+    def _delete_orphan_blobs(self):
+        models = self._get_models()
+        models.Blob.objects.using(self._db_label).filter(stdout_stderr_of=None, diff_of=None,
+                                                         dependency_diff_of=None).delete()
+
     def list_projects(self):
         models = self._get_models()
         return [project.id for project in models.Project.objects.using(self._db_label).all()]
@@ -199,27 +522,107 @@ class DjangoRecordStore(RecordStore):
         db_record.script_arguments = record.script_arguments
         db_record.user = record.user
         db_record.tags = ",".join(record.tags)
-        db_record.stdout_stderr = record.stdout_stderr
         # should perhaps check here for any orphan Tags, i.e., those that are no longer associated with any records, and delete them
         db_record.save(using=self._db_label)  # need to save before using many-to-many relationship
-        chunk_size = 900  # SQLite has problems with inserts >= ca. 1000, so for safety we split it into chunks
-        for i in xrange(0, len(record.input_data), chunk_size):
-            db_keys = (self._get_db_obj('DataKey', key) for key in record.input_data[i:i + chunk_size])
-            db_record.input_data.add(*db_keys)
-        for i in xrange(0, len(record.output_data), chunk_size):
-            db_keys = (self._get_db_obj('DataKey', key) for key in record.output_data[i:i + chunk_size])
-            for key in db_keys:
-                key.output_from_record = db_record
-                key.save()
+        self._save_data_keys(db_record, record)
         if record.dependencies:
-            for dep in record.dependencies:
-                # print "Adding dependency %s to db_record" % dep
-                db_record.dependencies.add(self._get_db_obj('Dependency', dep))
-        for pi in record.platforms:
-            db_record.platforms.add(self._get_db_obj('PlatformInformation', pi))
-        db_record.diff = record.diff
+            db_record.dependencies.add(*[self._get_db_dependency(dep) for dep in record.dependencies])
+        if record.platforms:
+            db_record.platforms.add(*[self._get_db_obj('PlatformInformation', pi) for pi in record.platforms])
+        self._save_blobs(db_record, record)
+        save_parameter_values(db_record, record.parameters, self._db_label)
         db_record.repeats = record.repeats
+        db_record.fingerprint = record_fingerprint(record)
         db_record.save(using=self._db_label)
+        self._save_state(db_record, content_hash(record), datetime.now())
+        self._search_index.add(db_record.pk, record)
+
+    def save_batch(self, project_name, records):
+        """Store several records in a single transaction."""
+        from django.db import transaction
+        try:
+            with transaction.atomic(using=self._db_label):
+                for record in records:
+                    self.save(project_name, record)
+        except Exception:
+            # rows created in the transaction have been rolled back
+            self._identity_cache.clear()
+            raise
+
+    def iter_records(self, project_name, batch_size=BATCH_SIZE, tags=None):
+        """
+        Iterate over the records of a project (with at least one of *tags*,
+        if given), in order of label, retrieving *batch_size* records at a
+        time.
+        """
+        models = self._get_models()
+        db_records = self._filter(project_name, tags).order_by('label')
+        last_label = None
+        while True:
+            batch = db_records
+            if last_label is not None:
+                batch = batch.filter(label__gt=last_label)
+            batch = list(batch.select_related()[:batch_size])
+            for record in models.to_sumatra_batch(batch):
+                yield record
+            if len(batch) < batch_size:
+                break
+            last_label = batch[-1].label
+
+    def iter_rows(self, project_name, tags=None, batch_size=BATCH_SIZE):
+        """
+        Iterate over the records of a project as a table (see
+        :meth:`RecordStore.iter_rows`). The rows are built from the record
+        fields, the tag index and the parameter index, with three queries per
+        batch, without retrieving whole records.
+        """
+        models = self._get_models()
+        fields = [field for field in TABLE_FIELDS if field != "tags"]
+        db_records = self._filter(project_name, tags).order_by('label').values('pk', *fields)
+        tag_index = models.RecordTag.objects.using(self._db_label)
+        values = models.ParameterValue.objects.using(self._db_label)
+        last_label = None
+        while True:
+            batch = db_records
+            if last_label is not None:
+                batch = batch.filter(label__gt=last_label)
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            rows = {}
+            for row in batch:
+                rows[row.pop('pk')] = row
+                row["tags"] = []
+            for pk, name in tag_index.filter(record__in=list(rows)).values_list('record', 'name'):
+                rows[pk]["tags"].append(name)
+            for row in rows.values():
+                row["tags"] = ",".join(sorted(row["tags"]))
+            for pk, name, numeric, text in values.filter(record__in=list(rows)).values_list(
+                    'record', 'name', 'numeric', 'text'):
+                rows[pk][PARAMETER_PREFIX + name] = text if numeric is None else numeric
+            yield batch
+            if len(batch) < batch_size:
+                break
+            last_label = batch[-1]["label"]
+
+    def parameter_columns(self, project_name, tags=None):
+        """
+        Return the names of the parameter columns in a table of the records of
+        a project (see :meth:`RecordStore.parameter_columns`), using the
+        parameter index.
+        """
+        from django.db.models import Count
+        models = self._get_models()
+        values = models.ParameterValue.objects.using(self._db_label).filter(
+            record__in=self._filter(project_name, tags))
+        counts = values.values('name').annotate(n=Count('pk'), n_numeric=Count('numeric'))
+        return dict((PARAMETER_PREFIX + count['name'], count['n'] == count['n_numeric'])
+                    for count in counts)
+
+    def _save_state(self, db_record, record_hash, modified):
+        models = self._get_models()
+        state = models.RecordState(record=db_record, content_hash=record_hash, modified=modified)
+        state.save(using=self._db_label)
 
     def get(self, project_name, label):
         models = self._get_models()
@@ -229,15 +632,76 @@ class DjangoRecordStore(RecordStore):
             raise KeyError(label)
         return db_record.to_sumatra()
 
-    def list(self, project_name, tags=None):
-        db_records = self._manager.filter(project__id=project_name).select_related()
+    def get_many(self, project_name, labels, batch_size=BATCH_SIZE):
+        """
+        Iterate over the records with the given labels, retrieving
+        *batch_size* records with each query.
+        """
+        models = self._get_models()
+        labels = list(labels)
+        db_records = self._manager.filter(project__id=project_name)
+        for start in range(0, len(labels), batch_size):
+            batch = db_records.filter(label__in=labels[start:start + batch_size])
+            for record in models.to_sumatra_batch(batch.select_related()):
+                yield record
+
+    def _filter(self, project_name, tags=None, all_tags=None, not_tags=None):
+        """
+        Select the records of a project, optionally by tag (see
+        :meth:`RecordStore.list`), using the tag index.
+        """
+        models = self._get_models()
+        db_records = self._manager.filter(project__id=project_name)
+        tag_index = models.RecordTag.objects.using(self._db_label)
         if tags:
-            if not hasattr(tags, "__len__"):
-                tags = [tags]
-            for tag in tags:
-                db_records = db_records.filter(tags__contains=tag)
+            db_records = db_records.filter(
+                pk__in=tag_index.filter(name__in=tag_list(tags)).values('record'))
+        for tag in tag_list(all_tags):
+            db_records = db_records.filter(pk__in=tag_index.filter(name=tag).values('record'))
+        if not_tags:
+            db_records = db_records.exclude(
+                pk__in=tag_index.filter(name__in=tag_list(not_tags)).values('record'))
+        return db_records
+
+    def _where(self, db_records, where):
+        """
+        Select the records whose parameter values satisfy the conditions of
+        a "where" clause.
+        """
+        models = self._get_models()
+        values = models.ParameterValue.objects.using(self._db_label)
+        lookups = {"=": "exact", "==": "exact", "<": "lt", "<=": "lte", ">": "gt", ">=": "gte"}
+        for name, op, value in parse_where(where):
+            field = "numeric" if isinstance(value, float) else "text"
+            matching = values.filter(name=name)
+            if op == "!=":
+                matching = matching.filter(**{"%s__isnull" % field: False}).exclude(**{field: value})
+            else:
+                matching = matching.filter(**{"%s__%s" % (field, lookups[op]): value})
+            db_records = db_records.filter(pk__in=matching.values('record'))
+        return db_records
+
+    def list(self, project_name, tags=None, since=None, until=None,
+             limit=None, offset=None, order_by=None, fields=None, where=None,
+             all_tags=None, not_tags=None):
+        db_records = self._filter(project_name, tags, all_tags, not_tags)
+        if where:
+            db_records = self._where(db_records, where)
+        if since is not None:
+            db_records = db_records.filter(timestamp__gte=since)
+        if until is not None:
+            db_records = db_records.filter(timestamp__lte=until)
+        if order_by:
+            db_records = db_records.order_by(order_by)
+        if offset or limit is not None:
+            start = offset or 0
+            stop = None if limit is None else start + limit
+            db_records = db_records[start:stop]
+        if fields:
+            return self._list_fields(db_records, fields)
+        models = self._get_models()
         try:
-            records = [db_record.to_sumatra() for db_record in db_records]
+            records = models.to_sumatra_batch(db_records.select_related())
         except Exception as err:
             errmsg = dedent("""\
                 Sumatra could not retrieve the record from the record store.
@@ -247,28 +711,198 @@ class DjangoRecordStore(RecordStore):
             raise Exception(errmsg)
         return records
 
+    def _list_fields(self, db_records, fields):
+        """
+        Retrieve only the requested fields, without building full Record
+        objects if all of them are stored as simple columns.
+        """
+        if set(fields).issubset(self._column_fields):
+            rows = list(db_records.values(*fields))
+            if "tags" in fields:
+                for row in rows:
+                    row["tags"] = set(tag for tag in row["tags"].split(",") if tag)
+            return rows
+        models = self._get_models()
+        return select_fields(models.to_sumatra_batch(db_records.select_related()), fields)
+
     def labels(self, project_name):
-        return [record.label for record in self._manager.filter(project__id=project_name)]
+        return list(self._manager.filter(project__id=project_name).values_list('label', flat=True))
+
+    def search(self, project_name, query, limit=None):
+        """
+        Return the records of the given project which match a full-text
+        search query, newest first, using the search index if there is one.
+        """
+        self._get_models()
+        index = self._search_index
+        if not index.supported:
+            return super(DjangoRecordStore, self).search(project_name, query, limit)
+        db_records = index.filter(self._manager.filter(project__id=project_name), query)
+        db_records = db_records.order_by('-timestamp')[:limit]
+        return self._get_models().to_sumatra_batch(db_records.select_related())
+
+    def update(self, project_name, field, value, tags=None, dry_run=False):
+        """
+        Modify the records for a given project. See :meth:`RecordStore.update`.
+
+        Data store attributes (e.g. "datastore.root") are modified in the
+        database, by pointing the records at a data store entry with the new
+        parameters, without loading the records. Other attributes are
+        modified record by record.
+        """
+        parts = field.split(".")
+        if len(parts) != 2 or parts[0] not in ("datastore", "input_datastore"):
+            return super(DjangoRecordStore, self).update(project_name, field, value, tags, dry_run)
+        relation, key = parts
+        models = self._get_models()
+        from django.db import transaction
+        from django.db.models import Count
+        db_records = self._filter(project_name, tags)
+        datastores = models.Datastore.objects.using(self._db_label)
+        counts = db_records.order_by().values(relation).annotate(n=Count('pk'))
+        report = {}
+        with transaction.atomic(using=self._db_label):
+            for row in counts:
+                db_datastore = datastores.get(pk=row[relation])
+                parameters = db_datastore.access_parameters()
+                old_value = parameters.get(key)
+                if old_value == value:
+                    continue
+                report[old_value] = report.get(old_value, 0) + row['n']
+                if not dry_run:
+                    parameters[key] = value
+                    new_datastore, created = datastores.get_or_create(type=db_datastore.type,
+                                                                      parameters=str(parameters))
+                    changed = db_records.filter(**{relation: db_datastore})
+                    models.RecordState.objects.using(self._db_label).filter(
+                        record__in=changed.values('pk')).update(content_hash=None, modified=datetime.now())
+                    changed.update(**{relation: new_datastore})
+        return report
+
+    def content_hashes(self, project_name, labels=None, since=None):
+        db_records = self._manager.filter(project__id=project_name)
+        if since is not None:
+            db_records = db_records.filter(state__modified__gt=since)
+        if labels is None:
+            rows = list(db_records.values_list('label', 'state__content_hash', 'state__modified'))
+        else:
+            labels = list(labels)
+            rows = []
+            chunk_size = 900  # SQLite limits the number of query parameters
+            for i in xrange(0, len(labels), chunk_size):
+                rows.extend(db_records.filter(label__in=labels[i:i + chunk_size])
+                                      .values_list('label', 'state__content_hash', 'state__modified'))
+        hashes = {}
+        for label, record_hash, modified in rows:
+            if record_hash is None:  # saved by an older version of Sumatra, or updated
+                db_record = db_records.get(label=label)
+                record_hash = content_hash(db_record.to_sumatra())
+                self._save_state(db_record, record_hash, modified)
+            hashes[label] = (record_hash, modified)
+        return hashes
+
+    def _get_sync_watermark(self, project_name, other):
+        models = self._get_models()
+        try:
+            mark = models.SyncWatermark.objects.using(self._db_label).get(project__id=project_name,
+                                                                          peer=str(other))
+        except models.SyncWatermark.DoesNotExist:
+            return None
+        return mark.local, mark.remote
+
+    def _set_sync_watermark(self, project_name, other, watermark):
+        models = self._get_models()
+        db_project = self._get_db_project(project_name)
+        mark, created = models.SyncWatermark.objects.using(self._db_label).get_or_create(project=db_project,
+                                                                                         peer=str(other))
+        mark.local, mark.remote = watermark
+        mark.save(using=self._db_label)
+
+    def reindex(self):
+        """
+        Rebuild the parameter and tag indexes and the full-text search index
+        from the records in the database. Return the number of records.
+        """
+        models = self._get_models()
+        db_records = models.Record.objects.using(self._db_label)
+        n = index_parameters(db_records, self._db_label)
+        index_tags(db_records, self._db_label)
+        index = self._search_index
+        if index.supported:
+            index.create()
+            index.rebuild(db_records)
+        return n
+
+    def upgrade(self, progress=None):
+        """
+        Apply any schema migrations the database needs (see
+        :mod:`sumatra.recordstore.django_store.schema`). These are normally
+        applied as soon as the record store is opened, so this also reports
+        those.
+        """
+        self._get_models()  # configures Django, which migrates the database if needed
+        applied = db_config.applied_migrations.pop(self._db_label, [])
+        if progress:
+            for m in applied:
+                progress(m.description)
+        applied += migrate(self._db_label, progress=progress and (lambda m: progress(m.description)))
+        return [m.description for m in applied]
 
     def delete(self, project_name, label):
-        db_record = self._manager.get(label=label, project__id=project_name)
-        db_record.delete()
+        from django.db import transaction
+        with transaction.atomic(using=self._db_label):
+            db_record = self._manager.get(label=label, project__id=project_name)
+            delete_records(self._manager.filter(pk=db_record.pk), self._db_label)
+            self._delete_orphan_blobs()
+
+    def _select(self, project_name, labels):
+        """
+        Yield querysets selecting the records with the given labels, in chunks
+        small enough for SQLite's limit on the number of query parameters.
+        """
+        labels = list(labels)
+        chunk_size = 900
+        for i in xrange(0, len(labels), chunk_size):
+            yield self._manager.filter(project__id=project_name, label__in=labels[i:i + chunk_size])
+
+    def delete_many(self, project_name, labels):
+        """Delete several records in a single transaction."""
+        from django.db import transaction
+        n = 0
+        with transaction.atomic(using=self._db_label):
+            for db_records in self._select(project_name, labels):
+                n += delete_records(db_records, self._db_label)
+            self._delete_orphan_blobs()
+        return n
+
+    def output_data(self, project_name, labels):
+        return group_by_datastore(item for db_records in self._select(project_name, labels)
+                                  for item in output_data(db_records))
 
     def delete_by_tag(self, project_name, tag):
-        db_records = self._manager.filter(project__id=project_name, tags__contains=tag)
-        n = db_records.count()
-        for db_record in db_records:
-            db_record.delete()
+        """
+        Delete the records with the given tag, selected using the tag index,
+        in a single transaction.
+        """
+        from django.db import transaction
+        with transaction.atomic(using=self._db_label):
+            n = delete_records(self._filter(project_name, tags=[tag]), self._db_label)
+            self._delete_orphan_blobs()
         return n
 
     def most_recent(self, project_name):
         models = self._get_models()
-        return self._manager.filter(project__id=project_name).latest('timestamp').label
+        labels = self._manager.filter(project__id=project_name).order_by('-timestamp').values_list('label', flat=True)[:1]
+        if not labels:
+            raise models.Record.DoesNotExist("Project %s contains no records" % project_name)
+        return labels[0]
 
     def delete_all(self):
         """Delete everything from the database."""
         management.call_command('flush', database=self._db_label,
                                 interactive=False, verbosity=0)
+        self._search_index.clear()
+        self._identity_cache.clear()
 
     def clear(self):
         """
@@ -279,14 +913,15 @@ class DjangoRecordStore(RecordStore):
         if not db_config.configured:
             db_config.configure()
         #management.call_command('sqlclear', 'django_store', database=self._db_label)  # this produces coloured output, need no_color option from Django 1.7
-        cmds = ["BEGIN;"] + ['DROP TABLE "django_store_{}";'.format(x)
-                             for x in ("record", "record_output_data", "record_input_data", "record_dependencies",
+        cmds = ["BEGIN;", 'DROP TABLE IF EXISTS "django_store_recordsearch";'] + ['DROP TABLE "django_store_{}";'.format(x)
+                             for x in ("schemaversion", "recordtag", "parametervalue", "recordstate", "syncwatermark", "recordblobs", "dependencyblobs", "blob", "record", "record_output_data", "record_input_data", "record_dependencies",
                                        "record_platforms", "platforminformation", "datakey", "datastore", "launchmode",
                                        "parameterset", "repository", "dependency", "executable", "project")] + ["COMMIT;"]
         from django.db import connection
         cur = connection.cursor()
         for cmd in cmds:
             cur.execute(cmd)
+        self._identity_cache.clear()
         db_config._create_databases()
 
     def _dump(self, indent=2):
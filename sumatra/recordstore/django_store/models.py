@@ -7,19 +7,28 @@ Definition of database tables and object retrieval for the DjangoRecordStore.
 """
 
 from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from sumatra import programs, launch, datastore, records, versioncontrol, parameters, dependency_finder
 import tagging.fields
 from tagging.models import Tag
+from tagging.utils import parse_tag_input
 import datetime
+from functools import partial
 import django
 from distutils.version import LooseVersion
 from sumatra.core import registry
+from sumatra.recordstore import blobs
 
 
 class SumatraObjectsManager(models.Manager):
 
-    def get_or_create_from_sumatra_object(self, obj, using='default'):
+    def sumatra_attributes(self, obj):
+        """
+        Return the field values of the row which stores a Sumatra object, e.g.
+        an Executable or a DataKey.
+        """
         # automatically retrieving the field names is nice, but leads
         # to all the special cases below when we have subclasses that we
         # want to store in a single table in the database.
@@ -40,8 +49,10 @@ class SumatraObjectsManager(models.Manager):
                     attributes[name] = str(obj)  # ParameterSet, DataKey
                 else:
                     raise
+        return attributes
 
-        return self.using(using).get_or_create(**attributes)
+    def get_or_create_from_sumatra_object(self, obj, using='default'):
+        return self.using(using).get_or_create(**self.sumatra_attributes(obj))
 
 
 class BaseModel(models.Model):
@@ -102,9 +113,18 @@ class Dependency(BaseModel):
     def __unicode__(self):
         return "%s (%s) version=%s" % (self.name, self.path, self.version)
 
+    def get_diff(self):
+        """Return the diff, which may be stored in a Blob."""
+        if self.diff:
+            return self.diff
+        try:
+            return self.blobs.diff.text()
+        except DependencyBlobs.DoesNotExist:
+            return self.diff
+
     def to_sumatra(self):
         return getattr(dependency_finder, self.module).Dependency(
-            self.name, self.path, self.version, self.diff, self.source)
+            self.name, self.path, self.version, self.get_diff(), self.source)
 
     class Meta:
         ordering = ['name']
@@ -218,7 +238,7 @@ class PlatformInformation(BaseModel):
 
 
 class Record(BaseModel):
-    label = models.CharField(max_length=100, unique=False)  # make this a SlugField? samarkanov changed unique to False for the search form.
+    label = models.CharField(max_length=100, unique=False, db_index=True)  # make this a SlugField? samarkanov changed unique to False for the search form.
     db_id = models.AutoField(primary_key=True)  # django-tagging needs an integer as primary key - see http://code.google.com/p/django-tagging/issues/detail?id=15
     reason = models.TextField(blank=True)
     duration = models.FloatField(null=True)
@@ -232,7 +252,7 @@ class Record(BaseModel):
     datastore = models.ForeignKey(Datastore)
     input_datastore = models.ForeignKey(Datastore, related_name="input_to_records")
     outcome = models.TextField(blank=True)
-    timestamp = models.DateTimeField()
+    timestamp = models.DateTimeField(db_index=True)
     tags = tagging.fields.TagField()
     dependencies = models.ManyToManyField(Dependency)
     platforms = models.ManyToManyField(PlatformInformation)
@@ -242,6 +262,7 @@ class Record(BaseModel):
     script_arguments = models.TextField(blank=True)
     stdout_stderr = models.TextField(blank=True)
     repeats = models.CharField(max_length=100, null=True, blank=True)
+    fingerprint = models.CharField(max_length=40, null=True, blank=True)  # see records.record_fingerprint
 
     # parameters which will be used in the fulltext search (see sumatra.web.services fulltext_search)
     params_search = ('label', 'reason', 'duration', 'main_file', 'outcome', 'user', 'tags')
@@ -249,7 +270,13 @@ class Record(BaseModel):
     class Meta:
         ordering = ('-timestamp',)
 
-    def to_sumatra(self):
+    def to_sumatra(self, record_blobs=None):
+        """
+        Return the Sumatra record. Text fields stored in blobs are loaded when
+        they are first used, unless *record_blobs* is given: a dict containing
+        the RecordBlobs of this and other records, by record primary key, with
+        their blobs, as retrieved by :func:`to_sumatra_batch`.
+        """
         record = records.Record(
             self.executable.to_sumatra(),
             self.repository.to_sumatra(),
@@ -266,19 +293,54 @@ class Record(BaseModel):
             self.user,
             input_datastore=self.input_datastore.to_sumatra(),
             timestamp=self.timestamp)
-        record.stdout_stderr = self.stdout_stderr
+        for name in blobs.BLOB_FIELDS:
+            if getattr(self, name):
+                setattr(record, name, getattr(self, name))
+            elif record_blobs is not None:
+                blob = getattr(record_blobs.get(self.pk), name, None)
+                setattr(record, name, blob.text() if blob else getattr(self, name))
+            else:  # empty, or stored in a Blob
+                record.set_loader(name, partial(self._get_text, name))
         record.duration = self.duration
         record.outcome = self.outcome
-        record.tags = set(tag.name for tag in Tag.objects.get_for_object(self))
+        record.tags = set(self.tag_index.values_list('name', flat=True))
         record.output_data = [key.to_sumatra() for key in self.output_data.all()]
-        record.dependencies = [dep.to_sumatra() for dep in self.dependencies.all()]
+        record.dependencies = [dep.to_sumatra() for dep in self.dependencies.select_related("blobs__diff")]
         record.platforms = [pi.to_sumatra() for pi in self.platforms.all()]
         record.repeats = self.repeats
+        record.fingerprint = self.fingerprint  # if None, calculated when needed
         return record
 
     def __unicode__(self):
         return self.label
 
+    def _get_text(self, name):
+        """Return the text field *name*, which may be stored in a Blob."""
+        text = getattr(self, name)
+        if not text:
+            try:
+                blob = getattr(self.blobs, name)
+            except RecordBlobs.DoesNotExist:
+                blob = None
+            if blob is not None:
+                text = blob.text()
+        return text
+
+    def get_diff(self):
+        return self._get_text("diff")
+
+    def get_stdout_stderr(self):
+        return self._get_text("stdout_stderr")
+
+    def has_diff(self):
+        """Is there a diff? (checking this does not load the diff)"""
+        if self.diff:
+            return True
+        try:
+            return self.blobs.diff_id is not None
+        except RecordBlobs.DoesNotExist:
+            return False
+
     def tag_objects(self):
         return Tag.objects.get_for_object(self)
 
@@ -287,3 +349,126 @@ class Record(BaseModel):
 
     def working_directory(self):
         return self.launch_mode.get_parameters().get('working_directory', None)
+
+
+class RecordState(models.Model):
+    """
+    Content hash of a record and the time it was last saved, used to
+    synchronize record stores incrementally. Kept in a separate table so that
+    record stores created by older versions of Sumatra gain it on upgrade.
+    """
+    record = models.OneToOneField(Record, primary_key=True, related_name="state")
+    content_hash = models.CharField(max_length=40, null=True)  # null if not yet calculated
+    modified = models.DateTimeField(null=True, db_index=True)
+
+
+class SyncWatermark(models.Model):
+    """
+    Modification times, in this and in another record store, up to which a
+    project is known to be in sync with the other store.
+    """
+    project = models.ForeignKey(Project)
+    peer = models.CharField(max_length=255)
+    local = models.DateTimeField(null=True)
+    remote = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = ('project', 'peer')
+
+
+class Blob(models.Model):
+    """
+    Text (e.g. a diff or the output of a run) which may be shared between many
+    records, and so is stored once, identified by its SHA1 hash and optionally
+    compressed with zlib.
+    """
+    hash = models.CharField(max_length=40, primary_key=True)
+    compressed = models.BooleanField(default=False)
+    content = models.BinaryField()
+
+    def text(self):
+        return blobs.unpack(self.content, self.compressed)
+
+
+class RecordBlobs(models.Model):
+    """
+    The blobs holding a record's stdout_stderr and diff, if these are too long
+    to be stored in the record table. Kept in a separate table so that record
+    stores created by older versions of Sumatra gain it on upgrade.
+    """
+    record = models.OneToOneField(Record, primary_key=True, related_name="blobs")
+    stdout_stderr = models.ForeignKey(Blob, null=True, related_name="stdout_stderr_of")
+    diff = models.ForeignKey(Blob, null=True, related_name="diff_of")
+
+
+def to_sumatra_batch(db_records):
+    """
+    Return the Sumatra records for a list of Record objects, retrieving the
+    blobs of all of them at once, rather than one record at a time.
+    """
+    db_records = list(db_records)
+    if not db_records:
+        return []
+    pks = [db_record.pk for db_record in db_records]
+    all_blobs = RecordBlobs.objects.using(db_records[0]._state.db).select_related('stdout_stderr', 'diff')
+    record_blobs = {}
+    chunk_size = 900  # SQLite limits the number of query parameters
+    for i in range(0, len(pks), chunk_size):
+        for rb in all_blobs.filter(record__in=pks[i:i + chunk_size]):
+            record_blobs[rb.record_id] = rb
+    return [db_record.to_sumatra(record_blobs) for db_record in db_records]
+
+
+class DependencyBlobs(models.Model):
+    """The blob holding a dependency's diff, if this is long."""
+    dependency = models.OneToOneField(Dependency, primary_key=True, related_name="blobs")
+    diff = models.ForeignKey(Blob, related_name="dependency_diff_of")
+
+
+class ParameterValue(models.Model):
+    """
+    One of the (flattened) parameters of a record, so that records can be
+    selected by parameter value. The value is stored as text and, if it is a
+    number, also as a number.
+    """
+    record = models.ForeignKey(Record, related_name="parameter_values")
+    name = models.CharField(max_length=200, db_index=True)
+    numeric = models.FloatField(null=True, db_index=True)
+    text = models.TextField()
+
+
+class RecordTag(models.Model):
+    """
+    One of the tags of a record, so that records can be selected by tag using
+    an index. Unlike the tables of django-tagging, this works with any of the
+    databases used by DjangoRecordStores, not only the default one.
+    """
+    record = models.ForeignKey(Record, related_name="tag_index")
+    name = models.CharField(max_length=100, db_index=True)
+
+    class Meta:
+        unique_together = ('record', 'name')
+
+
+class SchemaVersion(models.Model):
+    """
+    The versions of the database schema, one for each migration applied (see
+    :mod:`sumatra.recordstore.django_store.schema`), so that syncdb and the
+    migrations need only be run when the schema has changed.
+    """
+    version = models.IntegerField()
+
+
+@receiver(post_save, sender=Record)
+def update_tag_index(sender, instance, using, **kwargs):
+    """
+    Keep the tag index in step with the tags field, however the record is
+    saved (e.g. when the tags are edited in smtweb).
+    """
+    tags = set(parse_tag_input(instance.tags or ""))
+    tag_index = RecordTag.objects.using(using).filter(record=instance)
+    indexed = set(tag_index.values_list('name', flat=True))
+    if indexed != tags:
+        tag_index.exclude(name__in=tags).delete()
+        RecordTag.objects.using(using).bulk_create(RecordTag(record=instance, name=name)
+                                                   for name in sorted(tags - indexed))
@@ -0,0 +1,215 @@
+"""
+Versioned, in-place migrations of the database schema of DjangoRecordStore.
+
+The version of the schema is recorded in the database itself (in the
+SchemaVersion table), so checking whether a database is up to date is a
+single query. When it is not, syncdb creates any tables which are missing
+and then each migration with a higher version than that of the database is
+applied, in order, in its own transaction, together with the record of the
+new version. If a migration fails, the database is left at the previous
+version, and the migration is tried again next time.
+
+Migrations alter existing tables in place (syncdb only creates new tables)
+and backfill new tables and columns from the existing records, in batches,
+so that upgrading a record store does not require exporting, clearing and
+re-importing its records.
+
+To change the schema, add a migration function at the end of this module,
+decorated with :func:`migration` and the next version number.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+from collections import namedtuple
+
+Migration = namedtuple("Migration", "version description apply")
+MIGRATIONS = []
+
+# indexes which syncdb creates for new tables, but not for existing ones
+INDEXED_COLUMNS = {"django_store_record": ("label", "timestamp")}
+
+
+def migration(version, description):
+    """Register a function which migrates the schema of a database to *version*."""
+    def register(apply):
+        assert not MIGRATIONS or version == MIGRATIONS[-1].version + 1
+        MIGRATIONS.append(Migration(version, description, apply))
+        return apply
+    return register
+
+
+def schema_version(label):
+    """
+    Return the version of the schema of the database identified by *label*,
+    or 0 if it was created by a version of Sumatra which did not record it.
+    """
+    from django.db import connections, DatabaseError, transaction
+    cursor = connections[label].cursor()
+    try:
+        with transaction.atomic(using=label):  # so that the error does not abort a transaction
+            cursor.execute('SELECT MAX("version") FROM "django_store_schemaversion"')
+            row = cursor.fetchone()
+    except DatabaseError:  # table does not exist
+        return 0
+    return row[0] if row is not None and row[0] is not None else 0
+
+
+def migrate(label, progress=None):
+    """
+    Apply any migrations which the database identified by *label* needs. The
+    database tables must already have been created with syncdb. If given,
+    *progress* is called with each migration before it is applied. Return
+    the list of migrations applied.
+    """
+    from django.db import transaction
+    from . import models
+    current = schema_version(label)
+    applied = []
+    for m in MIGRATIONS:
+        if m.version <= current:
+            continue
+        if progress:
+            progress(m)
+        with transaction.atomic(using=label):
+            m.apply(label)
+            models.SchemaVersion.objects.using(label).create(version=m.version)
+        applied.append(m)
+    return applied
+
+
+def _column_definition(field, connection):
+    """
+    Return the SQL definition of a column to be added to a table which may
+    already contain rows. Since existing rows have no value for the column,
+    it can only be NOT NULL if it has a default.
+    """
+    from django.db import models
+    definition = field.db_type(connection)
+    default = field.get_default() if field.has_default() else None
+    if field.null:
+        return definition + " NULL"
+    elif isinstance(field, (models.CharField, models.TextField)):
+        return definition + " NOT NULL DEFAULT '%s'" % (default or "").replace("'", "''")
+    elif isinstance(default, bool):
+        return definition + " NOT NULL DEFAULT %s" % ("TRUE" if default else "FALSE")
+    elif isinstance(default, (int, float)):
+        return definition + " NOT NULL DEFAULT %r" % default
+    return definition + " NULL"
+
+
+def add_missing_columns(label):
+    """
+    Add the columns of the record store's models which are missing from
+    existing tables. Return a list of the columns added, as "table.column".
+    """
+    from django.db import connections
+    from django.db.models import Model
+    from . import models
+    connection = connections[label]
+    quote_name = connection.ops.quote_name
+    cursor = connection.cursor()
+    tables = connection.introspection.table_names(cursor)
+    added = []
+    for model in vars(models).values():
+        if not (isinstance(model, type) and issubclass(model, Model)
+                and model._meta.app_label == "django_store"):
+            continue
+        table = model._meta.db_table
+        if table not in tables:
+            continue
+        columns = set(column[0] for column in
+                      connection.introspection.get_table_description(cursor, table))
+        for field in model._meta.local_fields:
+            if field.column is not None and field.column not in columns:
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    quote_name(table), quote_name(field.column), _column_definition(field, connection)))
+                added.append("%s.%s" % (table, field.column))
+    return added
+
+
+def create_indexes(label):
+    """Create any of the INDEXED_COLUMNS indexes which are missing."""
+    from django.db import connections
+    connection = connections[label]
+    cursor = connection.cursor()
+    for table, columns in INDEXED_COLUMNS.items():
+        existing = connection.introspection.get_indexes(cursor, table)
+        for column in columns:
+            if column not in existing:
+                cursor.execute('CREATE INDEX "%s_%s_idx" ON "%s" ("%s")' % (table, column, table, column))
+
+
+def create_search_index(label):
+    """
+    Create the full-text search index, if the database supports it, and fill
+    it with any existing records.
+    """
+    from sumatra.recordstore.search import SearchIndex
+    from . import models
+    index = SearchIndex(label)
+    if index.create():
+        index.rebuild(models.Record.objects.using(label).all())
+
+
+@migration(1, "Add the columns and indexes missing from record stores created by older versions of Sumatra")
+def upgrade_legacy_tables(label):
+    from django.db.models import F
+    from . import models
+    added = add_missing_columns(label)
+    if "django_store_record.input_datastore_id" in added:
+        # records from before input and output data stores were distinguished
+        db_records = models.Record.objects.using(label).filter(input_datastore__isnull=True)
+        db_records.update(input_datastore=F('datastore'))
+    create_indexes(label)
+
+
+@migration(2, "Add a full-text search index of records")
+def add_search_index(label):
+    create_search_index(label)
+
+
+@migration(3, "Index the parameters of existing records")
+def fill_parameter_index(label):
+    from . import models, index_parameters
+    db_records = models.Record.objects.using(label).exclude(
+        pk__in=models.ParameterValue.objects.using(label).values('record'))
+    index_parameters(db_records, label)
+
+
+@migration(4, "Index the tags of existing records")
+def fill_tag_index(label):
+    from . import models, index_tags
+    db_records = models.Record.objects.using(label).exclude(tags="").exclude(
+        pk__in=models.RecordTag.objects.using(label).values('record'))
+    index_tags(db_records, label)
+
+
+@migration(5, "Store the fingerprints of existing records")
+def fill_fingerprints(label):
+    from sumatra.records import record_fingerprint
+    from sumatra.recordstore.base import BATCH_SIZE
+    from . import models
+    add_missing_columns(label)
+    db_records = models.Record.objects.using(label).filter(fingerprint__isnull=True).order_by('pk')
+    last_pk = None
+    while True:
+        batch = db_records if last_pk is None else db_records.filter(pk__gt=last_pk)
+        batch = list(batch.select_related()[:BATCH_SIZE])
+        for db_record, record in zip(batch, models.to_sumatra_batch(batch)):
+            models.Record.objects.using(label).filter(pk=db_record.pk).update(
+                fingerprint=record_fingerprint(record))
+        if len(batch) < BATCH_SIZE:
+            return
+        last_pk = batch[-1].pk
+
+
+@migration(6, "Recalculate the fingerprints of existing records, which did not distinguish values of different types")
+def recalculate_fingerprints(label):
+    from . import models
+    models.Record.objects.using(label).update(fingerprint=None)
+    fill_fingerprints(label)
+
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
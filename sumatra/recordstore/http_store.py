@@ -5,12 +5,39 @@ The server should support the following URL structure and HTTP methods:
 
 /                                            GET
 /<project_name>/[?tags=<tag1>,<tag2>,...]    GET
+/<project_name>/labels/                      GET
+/<project_name>/hashes/[?since=<timestamp>]  GET
 /<project_name>/tag/<tag>/                   GET, DELETE
 /<project_name>/<record_label>/              GET, PUT, DELETE
 
 and should both accept and return JSON-encoded data when the Accept header is
 "application/json".
 
+Clients also request records (and pages of records, see below) in a compact
+binary format, by giving "application/vnd.sumatra.record-v<API_VERSION>+msgpack"
+(or "record-list" for pages) the highest priority in the Accept header. Servers
+which support this should respond with that Content-Type; others will return
+JSON. The binary format is described in recordstore.serialization.
+
+The project URL may also accept the query parameters "since", "until"
+(timestamps in the format "%Y-%m-%d %H:%M:%S"), "order_by", "offset" and
+"limit". A server which applies these parameters should include them, as given,
+under the key "query" in the returned project data; otherwise they are applied
+by the client.
+
+If the project URL is given the additional parameter "expand=records", a server
+may return, instead of the project data, a JSON array containing the full
+records (honouring all of the above parameters). The client requests the
+records in pages of at most "limit" records. If the server does not support
+this, the records are fetched individually, over several concurrent
+connections.
+
+The "hashes" URL, which is optional and used to speed up synchronization,
+should return a JSON object mapping record labels to [content hash,
+modification time] pairs, where the content hash is calculated by
+recordstore.serialization.content_hash() and the modification time is when the
+record was last saved on the server (in the format "%Y-%m-%d %H:%M:%S.%f").
+
 The required JSON structure can be seen in recordstore.serialization.
 
 
@@ -19,18 +46,39 @@ The required JSON structure can be seen in recordstore.serialization.
 """
 
 from warnings import warn
+import os
+import errno
+import hashlib
+import tempfile
+import socket
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import threading
+from multiprocessing.pool import ThreadPool
+import _strptime  # datetime.strptime is not thread-safe until this has been imported, see http://bugs.python.org/issue7980
 from urlparse import urlparse, urlunparse
+from urllib import urlencode, unquote
 try:
     import httplib2
     have_http = True
 except ImportError:
     have_http = False
-from sumatra.recordstore.base import RecordStore, RecordStoreAccessError
+from sumatra.recordstore.base import (RecordStore, RecordStoreAccessError, filter_records,
+                                      select_fields, tag_list, BATCH_SIZE)
 from sumatra.recordstore import serialization
 from ..core import registry
 
 
 API_VERSION = 3
+MAX_CONNECTIONS = 8
+PAGE_SIZE = 100
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".smt", "http_cache")
+DEFAULT_CACHE_SIZE = 100 * 1024 * 1024  # bytes
+DEFAULT_TIMEOUT = 60  # seconds
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+BINARY_MEDIA_TYPES = ('record', 'record-list')  # may be returned in binary format
 
 
 def domain(url):
@@ -52,36 +100,184 @@ def process_url(url):
     return url, username, password
 
 
+class HttpCache(object):
+    """
+    A client-side cache of HTTP response bodies, stored as one file per URL
+    along with the ETag and Last-Modified headers needed to revalidate them
+    with a conditional request.
+
+    When the total size of the cache exceeds *max_size* bytes, the least
+    recently used entries are removed.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """
+        Return a tuple (etag, last_modified, content) for the given URL, or
+        None if it is not in the cache.
+        """
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as fp:
+                entry = pickle.load(fp)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def put(self, url, etag, last_modified, content):
+        """Store a response body, together with its validators."""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump((etag, last_modified, content), fp, pickle.HIGHEST_PROTOCOL)
+        path = self._path(url)
+        with self._lock:
+            size = self._total_size()
+            if os.path.exists(path):
+                size -= os.path.getsize(path)
+            os.rename(tmp_path, path)
+            self._size = size + os.path.getsize(path)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".tmp"):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:  # removed by another process
+                    continue
+                entries.append((st.st_atime, st.st_size, name))
+        return entries
+
+    def _total_size(self):
+        if self._size is None:
+            self._size = sum(size for atime, size, name in self._entries())
+        return self._size
+
+    def _evict(self):
+        """Remove least recently used entries until the cache is 10% below its maximum size."""
+        target = 0.9 * self.max_size
+        for atime, size, name in sorted(self._entries()):
+            if self._size <= target:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self._size -= size
+
+
 class HttpRecordStore(RecordStore):
     """
     Handles storage of simulation/analysis records on a remote server using HTTP.
 
     The server should support the following URL structure and HTTP methods:
 
-    =========================================    ================
+    ===========================================  ================
     /                                            GET
     /<project_name>/[?tags=<tag1>,<tag2>,...]    GET
+    /<project_name>/labels/                      GET
+    /<project_name>/hashes/[?since=<timestamp>]  GET
     /<project_name>/tag/<tag>/                   GET, DELETE
     /<project_name>/<record_label>/              GET, PUT, DELETE
-    =========================================    ================
+    ===========================================  ================
 
     and should both accept and return JSON-encoded data when the Accept header is
     "application/json".
 
+    The project URL may also accept the query parameters "since", "until",
+    "order_by", "offset" and "limit" (see :meth:`list`), and "expand=records"
+    to return pages of full records rather than a list of record URLs.
+
+    Records are retrieved using up to *max_connections* concurrent
+    (persistent) connections, or in pages of *page_size* records if the server
+    supports it.
+
+    Records are requested in a compact binary format, falling back to JSON
+    if the server does not support it, unless *binary* is False.
+
+    Records are cached in the directory *cache_dir* (up to *cache_size*
+    bytes), and revalidated using conditional requests, if the server provides
+    ETag or Last-Modified headers. Set *cache_dir* to None to disable caching.
+
+    Requests which get no response within *timeout* seconds fail with a
+    :class:`RecordStoreAccessError`, as do requests to an unreachable server.
+
     The required JSON structure can be seen in :mod:`recordstore.serialization`.
     """
 
     def __init__(self, server_url, username=None, password=None,
-                 disable_ssl_certificate_validation=True):
+                 disable_ssl_certificate_validation=True,
+                 max_connections=MAX_CONNECTIONS, page_size=PAGE_SIZE,
+                 cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE,
+                 binary=True, timeout=DEFAULT_TIMEOUT):
         self.server_url, _username, _password = process_url(server_url)
         username = username or _username
         password = password or _password
         if self.server_url[-1] != "/":
             self.server_url += "/"
-        self.client = httplib2.Http('.cache',
-                                    disable_ssl_certificate_validation=disable_ssl_certificate_validation)
+        self._credentials = (username, password)
+        self._disable_ssl_certificate_validation = disable_ssl_certificate_validation
+        self.max_connections = max_connections
+        self.page_size = page_size
+        self.binary = binary
+        self.timeout = timeout
+        if cache_dir:
+            self.cache = HttpCache(cache_dir, cache_size)
+        else:
+            self.cache = None
+        self._known_projects = set()
+        self.client = self._new_client()
+        self._client_thread = threading.current_thread()
+        self._local = threading.local()
+        self._pool = None
+        self._expand_supported = None  # not known until the server has been asked
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Stop the threads used for concurrent requests, if any."""
+        if getattr(self, "_pool", None) is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _new_client(self):
+        client = httplib2.Http(timeout=self.timeout,
+                               disable_ssl_certificate_validation=self._disable_ssl_certificate_validation)
+        username, password = self._credentials
         if username:
-            self.client.add_credentials(username, password, domain(self.server_url))
+            client.add_credentials(username, password, domain(self.server_url))
+        return client
+
+    def _client(self):
+        """
+        Return the HTTP client for the current thread (httplib2.Http objects
+        cannot be shared between threads). Each client keeps its connections
+        alive between requests.
+        """
+        if threading.current_thread() is self._client_thread:
+            return self.client
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._new_client()
+        return client
 
     def __str__(self):
         return "Interface to remote record store at %s using HTTP" % self.server_url
@@ -91,20 +287,67 @@ class HttpRecordStore(RecordStore):
         if self.client.credentials.credentials:
             username = self.client.credentials.credentials[0][1]
             password = self.client.credentials.credentials[0][2]
-        return {
+        state = {
             'server_url': self.server_url,
             'username': username,
             'password': password,
+            'binary': self.binary,
+            'timeout': self.timeout,
+            'max_connections': self.max_connections,
+            'page_size': self.page_size,
         }
+        if self.cache:
+            state.update(cache_dir=self.cache.directory, cache_size=self.cache.max_size)
+        else:
+            state['cache_dir'] = None
+        return state
 
     def __setstate__(self, state):
-        self.__init__(state['server_url'], state['username'], state['password'])
-
-    def _get(self, url, media_type):
-        headers = {'Accept': 'application/vnd.sumatra.%s-v%d+json, application/json' % (media_type, API_VERSION)}
-        response, content = self.client.request(url, headers=headers)
+        self.__init__(**state)
+
+    def _get(self, url, media_type, headers=None):
+        headers = dict(headers or {})
+        if self.binary and media_type in BINARY_MEDIA_TYPES:
+            headers['Accept'] = ('application/vnd.sumatra.%s-v%d+msgpack, '
+                                 'application/vnd.sumatra.%s-v%d+json;q=0.9, '
+                                 'application/json;q=0.8') % (media_type, API_VERSION, media_type, API_VERSION)
+        else:
+            headers['Accept'] = 'application/vnd.sumatra.%s-v%d+json, application/json' % (media_type, API_VERSION)
+        try:
+            response, content = self._client().request(url, headers=headers)
+        except (socket.error, httplib2.HttpLib2Error) as err:
+            raise RecordStoreAccessError("Could not access %s\n%s" % (url, err))
         return response, content
 
+    def _get_decoded(self, url, media_type, decode):
+        """
+        Retrieve and decode the resource at the given URL. If a copy is held
+        in the cache it is revalidated with a conditional request, and reused
+        if the server reports it has not been modified.
+
+        Returns a tuple (status, value, content). *value* is None if the status
+        is not 200.
+        """
+        entry = self.cache and self.cache.get(url)
+        headers = {}
+        if entry:
+            etag, last_modified, cached_content = entry
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        response, content = self._get(url, media_type, headers)
+        if response.status == 304 and entry:
+            content = cached_content
+        elif response.status != 200:
+            return response.status, None, content
+        else:
+            etag = response.get('etag')
+            last_modified = response.get('last-modified')
+            if self.cache and (etag or last_modified):
+                self.cache.put(url, etag, last_modified, content)
+        return 200, decode(content), content
+
     def list_projects(self):
         response, content = self._get(self.server_url, 'project-list')
         if response.status != 200:
@@ -115,8 +358,8 @@ class HttpRecordStore(RecordStore):
         url = "%s%s/" % (self.server_url, project_name)
         data = serialization.encode_project_info(long_name, description)
         headers = {'Content-Type': 'application/vnd.sumatra.project-v%d+json' % API_VERSION}
-        response, content = self.client.request(url, 'PUT', data,
-                                                headers=headers)
+        response, content = self._client().request(url, 'PUT', data,
+                                                   headers=headers)
         return response, content
 
     def create_project(self, project_name, long_name='', description=''):
@@ -124,6 +367,7 @@ class HttpRecordStore(RecordStore):
         response, content = self._put_project(project_name, long_name, description)
         if response.status != 201:
             raise RecordStoreAccessError("%d\n%s" % (response.status, content))
+        self._known_projects.add(project_name)
 
     def update_project_info(self, project_name, long_name='', description=''):
         """Update a project's long name and description."""
@@ -132,9 +376,12 @@ class HttpRecordStore(RecordStore):
             raise RecordStoreAccessError("%d\n%s" % (response.status, content))
 
     def has_project(self, project_name):
+        if project_name in self._known_projects:
+            return True
         project_url = "%s%s/" % (self.server_url, project_name)
         response, content = self._get(project_url, 'project')
         if response.status == 200:
+            self._known_projects.add(project_name)
             return True
         elif response.status in (401, 404):
             return False
@@ -144,63 +391,197 @@ class HttpRecordStore(RecordStore):
     def project_info(self, project_name):
         """Return a project's long name and description."""
         project_url = "%s%s/" % (self.server_url, project_name)
-        response, content = self._get(project_url, 'project')
-        if response.status != 200:
-            raise RecordStoreAccessError("Error in accessing %s\n%s: %s" % (project_url, response.status, content))
-        data = serialization.decode_project_data(content)
+        status, data, content = self._get_decoded(project_url, 'project', serialization.decode_project_data)
+        if status != 200:
+            raise RecordStoreAccessError("Error in accessing %s\n%s: %s" % (project_url, status, content))
         return dict((k, data[k]) for k in ("name", "description"))
 
     def save(self, project_name, record):
-        if not self.has_project(project_name):
-            self.create_project(project_name)
         url = "%s%s/%s/" % (self.server_url, project_name, record.label)
         headers = {'Content-Type': 'application/vnd.sumatra.record-v%d+json' % API_VERSION}
         data = serialization.encode_record(record)
-        response, content = self.client.request(url, 'PUT', data,
-                                                headers=headers)
+        try:
+            if not self.has_project(project_name):
+                self.create_project(project_name)
+            response, content = self._client().request(url, 'PUT', data,
+                                                       headers=headers)
+        except (socket.error, httplib2.HttpLib2Error) as err:
+            raise RecordStoreAccessError("Could not access %s\n%s" % (url, err))
         if response.status not in (200, 201):
             raise RecordStoreAccessError("%d\n%s" % (response.status, content))
 
     def _get_record(self, url):
-        response, content = self._get(url, 'record')
-        if response.status != 200:
-            if response.status == 404:
+        status, record, content = self._get_decoded(url, 'record', serialization.decode_record)
+        if status != 200:
+            if status == 404:
                 raise KeyError("No record was found at %s" % url)
             else:
-                raise RecordStoreAccessError("%d\n%s" % (response.status, content))
-        return serialization.decode_record(content)
+                raise RecordStoreAccessError("%d\n%s" % (status, content))
+        return record
+
+    def _get_records(self, record_urls):
+        """Retrieve the records at the given URLs, using concurrent requests."""
+        if self.max_connections < 2 or len(record_urls) < 2:
+            return [self._get_record(record_url) for record_url in record_urls]
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_connections)
+        return self._pool.map(self._get_record, record_urls)
+
+    def _get_expanded_records(self, project_url, query, limit=None, offset=None):
+        """
+        Retrieve full records page by page, if the server supports the
+        "expand" parameter. Otherwise, return None. Once the server has been
+        found not to support it, it is not asked again.
+        """
+        if self._expand_supported is False:
+            return None
+        records = []
+        start = offset or 0
+        while limit is None or len(records) < limit:
+            page_size = self.page_size
+            if limit is not None:
+                page_size = min(page_size, limit - len(records))
+            url = project_url + "?" + urlencode(query + [("expand", "records"),
+                                                         ("offset", start),
+                                                         ("limit", page_size)])
+            status, page, content = self._get_decoded(url, 'record-list', serialization.decode_record_page)
+            if status != 200:
+                raise RecordStoreAccessError("Could not access %s\n%s: %s" % (url, status, content))
+            if page is None:
+                self._expand_supported = False
+                return None
+            self._expand_supported = True
+            records.extend(page)
+            if len(page) < page_size:
+                break
+            start += len(page)
+        return records
 
     def get(self, project_name, label):
         url = "%s%s/%s/" % (self.server_url, project_name, label)
         return self._get_record(url)
 
-    def list(self, project_name, tags=None):
+    def _get_record_if_exists(self, url):
+        try:
+            return self._get_record(url)
+        except KeyError:
+            return None
+
+    def get_many(self, project_name, labels, batch_size=BATCH_SIZE):
+        """
+        Iterate over the records with the given labels, retrieving
+        *batch_size* records at a time using concurrent requests.
+        """
+        urls = ["%s%s/%s/" % (self.server_url, project_name, label) for label in labels]
+        for start in range(0, len(urls), batch_size):
+            batch = urls[start:start + batch_size]
+            if self.max_connections < 2 or len(batch) < 2:
+                records = [self._get_record_if_exists(url) for url in batch]
+            else:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.max_connections)
+                records = self._pool.map(self._get_record_if_exists, batch)
+            for record in records:
+                if record is not None:
+                    yield record
+
+    def list(self, project_name, tags=None, since=None, until=None,
+             limit=None, offset=None, order_by=None, fields=None, where=None,
+             all_tags=None, not_tags=None):
+        if where or all_tags or not_tags:
+            # the server cannot select records by parameter values, or by tags
+            # other than "any of these tags", so ask it for a superset and filter
+            records = filter_records(self.list(project_name, tags or all_tags, since, until,
+                                               order_by=order_by),
+                                     where=where, limit=limit, offset=offset,
+                                     all_tags=all_tags, not_tags=not_tags)
+            if fields:
+                records = select_fields(records, fields)
+            return records
         project_url = "%s%s/" % (self.server_url, project_name)
+        query = []
         if tags:
-            if not hasattr(tags, "__iter__"):
-                tags = [tags]
-            project_url += "?tags=%s" % ",".join(tags)
-        response, content = self._get(project_url, 'project')
-        if response.status != 200:
-            raise RecordStoreAccessError("Could not access %s\n%s: %s" % (project_url, response.status, content))
-        record_urls = serialization.decode_project_data(content)["records"]
-        records = []
-        for record_url in record_urls:
-            records.append(self._get_record(record_url))
+            query.append(("tags", ",".join(tag_list(tags))))
+        if since is not None:
+            query.append(("since", since.strftime(TIMESTAMP_FORMAT)))
+        if until is not None:
+            query.append(("until", until.strftime(TIMESTAMP_FORMAT)))
+        if order_by:
+            query.append(("order_by", order_by))
+        records = self._get_expanded_records(project_url, query, limit, offset)
+        if records is not None:
+            if fields:
+                records = select_fields(records, fields)
+            return records
+        if offset:
+            query.append(("offset", offset))
+        if limit is not None:
+            query.append(("limit", limit))
+        if query:
+            project_url += "?" + urlencode(query)
+        status, project_data, content = self._get_decoded(project_url, 'project',
+                                                          serialization.decode_project_data)
+        if status != 200:
+            raise RecordStoreAccessError("Could not access %s\n%s: %s" % (project_url, status, content))
+        record_urls = project_data["records"]
+        if "query" in project_data:  # the server has done the filtering and paging for us
+            records = self._get_records(record_urls)
+        elif since is None and until is None and not order_by:
+            records = self._get_records(filter_records(record_urls, limit=limit, offset=offset))
+        else:
+            records = filter_records(self._get_records(record_urls),
+                                     since, until, order_by, limit, offset)
+        if fields:
+            records = select_fields(records, fields)
         return records
 
     def labels(self, project_name):
-        return [record.label for record in self.list(project_name)]  # probably inefficient
+        url = "%s%s/labels/" % (self.server_url, project_name)
+        status, labels, content = self._get_decoded(url, 'label-list', serialization.decode_label_list)
+        if status == 200:
+            if isinstance(labels, list):
+                return labels
+        elif status != 404:
+            raise RecordStoreAccessError("%d\n%s" % (status, content))
+        # the server does not provide the labels endpoint, so we extract the
+        # labels from the record URLs
+        project_url = "%s%s/" % (self.server_url, project_name)
+        status, project_data, content = self._get_decoded(project_url, 'project',
+                                                          serialization.decode_project_data)
+        if status != 200:
+            raise RecordStoreAccessError("Could not access %s\n%s: %s" % (project_url, status, content))
+        labels = []
+        for record_url in project_data["records"]:
+            if record_url.startswith(project_url):
+                labels.append(unquote(record_url[len(project_url):].rstrip("/")))
+            else:
+                labels.append(self._get_record(record_url).label)
+        return labels
+
+    def content_hashes(self, project_name, labels=None, since=None):
+        url = "%s%s/hashes/" % (self.server_url, project_name)
+        if since is not None:
+            url += "?" + urlencode({"since": since.strftime(TIMESTAMP_FORMAT + ".%f")})
+        status, hashes, content = self._get_decoded(url, 'hash-list', serialization.decode_content_hashes)
+        if status == 200:
+            if isinstance(hashes, dict):
+                if labels is not None:
+                    hashes = dict((label, hashes[label]) for label in labels if label in hashes)
+                return hashes
+        elif status != 404:
+            raise RecordStoreAccessError("%d\n%s" % (status, content))
+        # the server does not provide the hashes endpoint
+        return super(HttpRecordStore, self).content_hashes(project_name, labels)
 
     def delete(self, project_name, label):
         url = "%s%s/%s/" % (self.server_url, project_name, label)
-        response, deleted_content = self.client.request(url, 'DELETE')
+        response, deleted_content = self._client().request(url, 'DELETE')
         if response.status != 204:
             raise RecordStoreAccessError("%d\n%s" % (response.status, deleted_content))
 
     def delete_by_tag(self, project_name, tag):
         url = "%s%s/tag/%s/" % (self.server_url, project_name, tag)
-        response, n_records = self.client.request(url, 'DELETE')
+        response, n_records = self._client().request(url, 'DELETE')
         if response.status != 200:
             raise RecordStoreAccessError("%d\n%s" % (response.status, n_records))
         return int(n_records)
@@ -212,7 +593,7 @@ class HttpRecordStore(RecordStore):
     def sync(self, other, project_name):
         if not self.has_project(project_name):
             self.create_project(project_name)
-        super(HttpRecordStore, self).sync(other, project_name)
+        return super(HttpRecordStore, self).sync(other, project_name)
 
     def clear(self):
         warn("Cannot clear a remote record store directly. Contact the record store administrator")
@@ -0,0 +1,113 @@
+"""
+Selection of records by the values of their parameters, e.g. "sim.dt<0.1",
+where the names of nested parameters are joined by dots.
+
+A "where" clause is a condition, or several conditions separated by commas
+or "and", all of which must hold (separators within quoted values, e.g.
+"model='a,b'", do not count). Each condition compares a parameter with a
+value using one of the operators =, ==, !=, <, <=, > and >=. If the value is a
+number, parameter values are compared as numbers (parameters whose values are
+not numbers do not match), otherwise as text. Records which do not have the
+parameter do not match.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import re
+import operator
+from collections import namedtuple
+from sumatra.parameters import flatten
+
+Condition = namedtuple("Condition", "name operator value")
+
+OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+condition_pattern = re.compile(r"^\s*([\w.\-]+)\s*(==|!=|<=|>=|=|<|>)\s*(.*?)\s*$")
+# quoted values are matched too, so that the separators within them can be skipped
+separator_pattern = re.compile(r"""('[^']*'|"[^"]*")|,|\s+and\s+""", re.IGNORECASE)
+
+
+def as_number(value):
+    """Return `value` as a float, or None if it is not a number."""
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def split_clause(clause):
+    """Split a "where" clause at the separators which are not within quotes."""
+    texts = []
+    start = 0
+    for match in separator_pattern.finditer(clause):
+        if match.group(1) is None:
+            texts.append(clause[start:match.start()])
+            start = match.end()
+    texts.append(clause[start:])
+    return texts
+
+
+def parse_where(where):
+    """
+    Parse a "where" clause, or a list of them, into a list of Conditions.
+    Raise ValueError if a condition cannot be parsed.
+    """
+    if isinstance(where, (list, tuple)):
+        clauses = where
+    else:
+        clauses = [where]
+    conditions = []
+    for clause in clauses:
+        for text in split_clause(clause):
+            if not text.strip():
+                continue
+            match = condition_pattern.match(text)
+            if match is None:
+                raise ValueError("Invalid condition '%s'. Conditions should have the form "
+                                 "'name<value', using one of the operators %s"
+                                 % (text.strip(), ", ".join(sorted(OPERATORS))))
+            name, op, value = match.groups()
+            if len(value) > 1 and value[0] == value[-1] and value[0] in "'\"":
+                value = value[1:-1]
+            elif as_number(value) is not None:
+                value = as_number(value)
+            conditions.append(Condition(name, op, value))
+    return conditions
+
+
+def parameter_values(parameters):
+    """
+    Return a dict containing the flattened parameters of a record, or an empty
+    dict if they are not a parameter set (e.g. a command-line string).
+    """
+    if hasattr(parameters, "as_dict") or isinstance(parameters, dict):
+        return dict(flatten(parameters))
+    return {}
+
+
+def matches(record, conditions):
+    """Return True if the parameters of a record satisfy all the conditions."""
+    values = parameter_values(record.parameters)
+    for name, op, value in conditions:
+        if name not in values:
+            return False
+        if isinstance(value, float):
+            actual = as_number(values[name])
+            if actual is None:
+                return False
+        else:
+            actual = "%s" % values[name]
+        if not OPERATORS[op](actual, value):
+            return False
+    return True
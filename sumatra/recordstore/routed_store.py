@@ -0,0 +1,230 @@
+"""
+Handles storage of records in a primary record store, e.g. a shared
+PostgreSQL database, while reading them from a replica, e.g. a local SQLite
+database, so that reading records (in smtweb, "smt list", analysis scripts,
+etc.) does not load the primary store.
+
+The replica is either a mirror, which is kept up to date by copying records
+which have changed from the primary store (the default), or a replica kept
+up to date by other means, e.g. database replication.
+
+A mirror is brought up to date before records are read from it if it was last
+updated more than *max_staleness* seconds ago (0 means before every read; None
+means only when :meth:`RoutedRecordStore.refresh` is called). Updates are
+incremental: only records which have been modified since the last update, as
+given by the primary store's content hashes and modification times, are
+copied, and records deleted from the primary store are deleted from the
+mirror. Records saved or deleted through the RoutedRecordStore are also saved
+to or deleted from the mirror immediately, so they can be read back at once.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import time
+import logging
+from sumatra.recordstore.base import (RecordStore, BATCH_SIZE, latest_modification,
+                                      record_store_state, record_store_from_state)
+
+logger = logging.getLogger("Sumatra")
+
+DEFAULT_MAX_STALENESS = 60  # seconds
+
+
+class RoutedRecordStore(RecordStore):
+    """
+    Record store which writes records to *primary* and reads them from
+    *replica*. Each of these may be a RecordStore, a URI, or the state of a
+    record store as saved in a project file.
+
+    If *mirror* is True, the replica is kept up to date by the
+    RoutedRecordStore itself, and is never more than *max_staleness* seconds
+    out of date when records are read from it.
+    """
+
+    def __init__(self, primary, replica, max_staleness=DEFAULT_MAX_STALENESS, mirror=True):
+        self.primary = record_store_from_state(primary)
+        self.replica = record_store_from_state(replica)
+        self.max_staleness = max_staleness
+        self.mirror = mirror
+        self._refreshed = {}  # time of the last refresh, by project
+
+    def __str__(self):
+        return "%s (reading from %s)" % (self.primary, self.replica)
+
+    def __getstate__(self):
+        return {'primary': record_store_state(self.primary),
+                'replica': record_store_state(self.replica),
+                'max_staleness': self.max_staleness,
+                'mirror': self.mirror}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def refresh(self, project_name):
+        """
+        Bring the mirror up to date with the primary store, for a given
+        project. Return the number of records copied or deleted.
+        """
+        if not self.mirror:
+            return 0
+        watermark = self.replica._get_sync_watermark(project_name, self.primary)
+        since = watermark and watermark[1]
+        changed = self.primary.content_hashes(project_name, since=since)
+        current = self.replica.content_hashes(project_name, labels=changed)
+        primary_labels = set(self.primary.labels(project_name))
+        replica_labels = set(self.replica.labels(project_name))
+        stale = set(label for label, (record_hash, modified) in changed.items()
+                    if current.get(label, (None, None))[0] != record_hash)
+        # comparing the labels also catches records missing from the mirror for other reasons
+        stale = sorted(stale.union(primary_labels.difference(replica_labels))
+                       .intersection(primary_labels))
+        for start in range(0, len(stale), BATCH_SIZE):
+            self.replica.save_batch(project_name, list(self.primary.get_many(
+                project_name, stale[start:start + BATCH_SIZE], batch_size=BATCH_SIZE)))
+        deleted = replica_labels.difference(primary_labels)
+        if deleted:
+            self.replica.delete_many(project_name, deleted)
+        self.replica._set_sync_watermark(project_name, self.primary,
+                                         (None, latest_modification(changed, since)))
+        self._refreshed[project_name] = time.time()
+        return len(stale) + len(deleted)
+
+    def _reader(self, project_name):
+        """Return the replica, after refreshing it if it may be too stale."""
+        if self.mirror and self.max_staleness is not None:
+            refreshed = self._refreshed.get(project_name)
+            if refreshed is None or time.time() - refreshed >= self.max_staleness:
+                self.refresh(project_name)
+        return self.replica
+
+    def _write_through(self, project_name, method, *args):
+        """
+        Apply a change made to the primary store to the mirror. If this fails,
+        the mirror is refreshed before it is next read from.
+        """
+        if not self.mirror:
+            return
+        try:
+            getattr(self.replica, method)(project_name, *args)
+        except Exception as err:
+            logger.warning("Unable to update the record store mirror %s: %s", self.replica, err)
+            self._refreshed.pop(project_name, None)
+
+    # reading
+
+    def list_projects(self):
+        # a mirror only contains the projects which have been read from
+        return self.primary.list_projects() if self.mirror else self.replica.list_projects()
+
+    def has_project(self, project_name):
+        return self._reader(project_name).has_project(project_name)
+
+    def get(self, project_name, label):
+        return self._reader(project_name).get(project_name, label)
+
+    def get_many(self, project_name, labels, batch_size=BATCH_SIZE):
+        return self._reader(project_name).get_many(project_name, labels, batch_size=batch_size)
+
+    def list(self, project_name, tags=None, since=None, until=None,
+             limit=None, offset=None, order_by=None, fields=None, where=None,
+             all_tags=None, not_tags=None):
+        return self._reader(project_name).list(project_name, tags=tags, since=since, until=until,
+                                               limit=limit, offset=offset, order_by=order_by,
+                                               fields=fields, where=where, all_tags=all_tags,
+                                               not_tags=not_tags)
+
+    def labels(self, project_name):
+        return self._reader(project_name).labels(project_name)
+
+    def most_recent(self, project_name):
+        return self._reader(project_name).most_recent(project_name)
+
+    def search(self, project_name, query, limit=None):
+        return self._reader(project_name).search(project_name, query, limit=limit)
+
+    def iter_records(self, project_name, batch_size=BATCH_SIZE, tags=None):
+        return self._reader(project_name).iter_records(project_name, batch_size=batch_size, tags=tags)
+
+    def iter_rows(self, project_name, tags=None, batch_size=BATCH_SIZE):
+        return self._reader(project_name).iter_rows(project_name, tags=tags, batch_size=batch_size)
+
+    def parameter_columns(self, project_name, tags=None):
+        return self._reader(project_name).parameter_columns(project_name, tags=tags)
+
+    def content_hashes(self, project_name, labels=None, since=None):
+        return self._reader(project_name).content_hashes(project_name, labels=labels, since=since)
+
+    def output_data(self, project_name, labels):
+        return self._reader(project_name).output_data(project_name, labels)
+
+    # writing
+
+    def save(self, project_name, record):
+        self.primary.save(project_name, record)
+        self._write_through(project_name, "save", record)
+
+    def save_batch(self, project_name, records):
+        self.primary.save_batch(project_name, records)
+        self._write_through(project_name, "save_batch", records)
+
+    def delete(self, project_name, label):
+        self.primary.delete(project_name, label)
+        self._write_through(project_name, "delete_many", [label])
+
+    def delete_many(self, project_name, labels):
+        n = self.primary.delete_many(project_name, labels)
+        self._write_through(project_name, "delete_many", labels)
+        return n
+
+    def delete_by_tag(self, project_name, tag):
+        n = self.primary.delete_by_tag(project_name, tag)
+        self._write_through(project_name, "delete_by_tag", tag)
+        return n
+
+    def update(self, project_name, field, value, tags=None, dry_run=False):
+        report = self.primary.update(project_name, field, value, tags=tags, dry_run=dry_run)
+        if not dry_run:
+            self._write_through(project_name, "update", field, value, tags)
+        return report
+
+    def delete_all(self):
+        self.primary.delete_all()
+        if self.mirror:
+            self.replica.delete_all()
+        self._refreshed.clear()
+
+    def clear(self):
+        self.primary.clear()
+        if self.mirror:
+            self.replica.clear()
+        self._refreshed.clear()
+
+    def reindex(self):
+        n = self.primary.reindex()
+        if self.mirror:
+            self.replica.reindex()
+        return n
+
+    def upgrade(self, progress=None):
+        steps = self.primary.upgrade(progress=progress)
+        if self.mirror and steps is not None:
+            replica_steps = self.replica.upgrade(progress=progress)
+            if replica_steps is None:
+                return None
+            steps += replica_steps
+        return steps
+
+    # synchronization, which uses the primary store's content hashes
+
+    def sync(self, other, project_name):
+        non_synchronizable = self.primary.sync(other, project_name)
+        self._refreshed.pop(project_name, None)
+        return non_synchronizable
+
+    def _get_sync_watermark(self, project_name, other):
+        return self.primary._get_sync_watermark(project_name, other)
+
+    def _set_sync_watermark(self, project_name, other, watermark):
+        self.primary._set_sync_watermark(project_name, other, watermark)
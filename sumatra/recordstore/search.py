@@ -0,0 +1,208 @@
+"""
+Full-text search of records, over their label, reason, outcome, tags,
+captured output (stdout_stderr) and parameters, the last flattened into
+"name=value" pairs (with dotted names for nested parameters) so that
+parameter values can be searched for.
+
+A query is a sequence of words, all of which must be found in a record for it
+to match. Words may be quoted to search for a phrase (e.g. '"sim.dt=0.1"'),
+end in "*" to match any word starting with them, and be restricted to one of
+the fields using "field:word" (e.g. "tags:bursting").
+
+SearchIndex maintains an index of records in an SQLite full-text search (FTS)
+table, in the same database as the records of a DjangoRecordStore. Other
+record stores search by scanning their records.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import shlex
+from sumatra.parameters import flatten
+
+SEARCH_FIELDS = ("label", "reason", "outcome", "tags", "stdout_stderr", "parameters")
+FTS_TABLE = "django_store_recordsearch"
+
+
+def flatten_parameters(parameters):
+    """
+    Return a list of "name=value" strings for a parameter set (or dict), with
+    the names of nested parameters joined by dots.
+    """
+    if not (hasattr(parameters, "as_dict") or isinstance(parameters, dict)):
+        return [str(parameters)] if parameters else []
+    return ["%s=%s" % item for item in flatten(parameters)]
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value or u""
+
+
+def search_fields(record):
+    """Return a dict containing the text of each searchable field of a record."""
+    return {
+        "label": _text(record.label),
+        "reason": _text(record.reason),
+        "outcome": _text(record.outcome),
+        "tags": u" ".join(sorted(_text(tag) for tag in record.tags)),
+        "stdout_stderr": _text(record.stdout_stderr),
+        "parameters": u"\n".join(_text(item) for item in flatten_parameters(record.parameters)),
+    }
+
+
+def parse_query(query):
+    """
+    Split a query into (field, text, prefix) terms, where field is None if the
+    term applies to all fields and prefix is True for terms ending in "*".
+    Quoted phrases are kept together, unless the quotes are unbalanced (e.g.
+    "don't"), in which case the query is split at whitespace.
+    """
+    if not isinstance(query, bytes):  # shlex does not support unicode in Python 2
+        query = query.encode("utf-8")
+    try:
+        words = shlex.split(query)
+    except ValueError:  # no closing quotation
+        words = [word.strip(b"\"'") for word in query.split()]
+    terms = []
+    for word in words:
+        word = word.decode("utf-8")
+        field = None
+        if ":" in word:
+            name, text = word.split(":", 1)
+            if name in SEARCH_FIELDS and text:
+                field, word = name, text
+        prefix = word.endswith("*")
+        text = word.rstrip("*")
+        if text:
+            terms.append((field, text, prefix))
+    return terms
+
+
+def match_expression(query):
+    """Translate a query into an SQLite full-text search MATCH expression."""
+    expressions = []
+    for field, text, prefix in parse_query(query):
+        expression = '"%s"' % text.replace('"', '""')
+        if prefix:
+            expression += "*"
+        if field:
+            expression = "%s:%s" % (field, expression)
+        expressions.append(expression)
+    return " ".join(expressions)
+
+
+def matches(record, query):
+    """
+    Return True if a record contains all the terms of a query. This is a
+    case-insensitive substring search, used where there is no index.
+    """
+    fields = dict((name, text.lower()) for name, text in search_fields(record).items())
+    all_text = "\n".join(fields.values())
+    for field, text, prefix in parse_query(query):
+        if text.lower() not in (fields[field] if field else all_text):
+            return False
+    return True
+
+
+class SearchIndex(object):
+    """
+    A full-text index of the records in one of the databases configured for
+    DjangoRecordStore, identified by *db_label*. Records are indexed by their
+    primary key. Other database engines than SQLite are not supported, in
+    which case :attr:`supported` is False and the other methods do nothing.
+    """
+
+    def __init__(self, db_label="default"):
+        self.db_label = db_label
+
+    @property
+    def _connection(self):
+        from django.db import connections
+        return connections[self.db_label]
+
+    @property
+    def supported(self):
+        return self._connection.vendor == "sqlite"
+
+    def exists(self):
+        cursor = self._connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+    def create(self):
+        """
+        Create the index, if it does not exist, using FTS5 if this version of
+        SQLite supports it and FTS4 otherwise. Return True if it was created.
+        """
+        if not self.supported or self.exists():
+            return False
+        from django.db import DatabaseError
+        cursor = self._connection.cursor()
+        columns = ", ".join(SEARCH_FIELDS)
+        try:
+            cursor.execute('CREATE VIRTUAL TABLE "%s" USING fts5(%s)' % (FTS_TABLE, columns))
+        except DatabaseError:
+            cursor.execute('CREATE VIRTUAL TABLE "%s" USING fts4(%s)' % (FTS_TABLE, columns))
+        return True
+
+    def add(self, record_id, record):
+        """Add (or replace) the entry for a record with primary key *record_id*."""
+        if not self.supported:
+            return
+        fields = search_fields(record)
+        cursor = self._connection.cursor()
+        cursor.execute('DELETE FROM "%s" WHERE rowid = %%s' % FTS_TABLE, [record_id])
+        cursor.execute('INSERT INTO "%s" (rowid, %s) VALUES (%%s%s)' % (
+                           FTS_TABLE, ", ".join(SEARCH_FIELDS), ", %s" * len(SEARCH_FIELDS)),
+                       [record_id] + [fields[name] for name in SEARCH_FIELDS])
+
+    def add_db_record(self, db_record):
+        """Add (or replace) the entry for a record retrieved with the Django ORM."""
+        self.add(db_record.pk, db_record.to_sumatra())
+
+    def remove(self, record_ids):
+        if not self.supported:
+            return
+        cursor = self._connection.cursor()
+        record_ids = list(record_ids)
+        chunk_size = 900  # SQLite limits the number of query parameters
+        for i in range(0, len(record_ids), chunk_size):
+            chunk = record_ids[i:i + chunk_size]
+            cursor.execute('DELETE FROM "%s" WHERE rowid IN (%s)' % (FTS_TABLE, ", ".join(["%s"] * len(chunk))),
+                           chunk)
+
+    def clear(self):
+        if self.supported and self.exists():
+            self._connection.cursor().execute('DELETE FROM "%s"' % FTS_TABLE)
+
+    def rebuild(self, db_records):
+        """Replace the contents of the index by entries for the given records."""
+        if not self.supported:
+            return
+        from sumatra.recordstore.base import BATCH_SIZE
+        from sumatra.recordstore.django_store.models import to_sumatra_batch
+        self.clear()
+        batch = []
+        for db_record in db_records.iterator():
+            batch.append(db_record)
+            if len(batch) == BATCH_SIZE:
+                self._add_batch(batch, to_sumatra_batch)
+                batch = []
+        self._add_batch(batch, to_sumatra_batch)
+
+    def _add_batch(self, db_records, to_sumatra_batch):
+        for db_record, record in zip(db_records, to_sumatra_batch(db_records)):
+            self.add(db_record.pk, record)
+
+    def filter(self, db_records, query):
+        """Restrict a queryset of records to those matching a query."""
+        expression = match_expression(query)
+        if not expression:
+            return db_records
+        return db_records.extra(
+            where=['"django_store_record"."db_id" IN (SELECT rowid FROM "%s" WHERE "%s" MATCH %%s)'
+                   % (FTS_TABLE, FTS_TABLE)],
+            params=[expression])
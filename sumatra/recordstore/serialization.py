@@ -1,6 +1,12 @@
 """
 Handles serialization/deserialization of record store contents to/from JSON.
 
+Records may also be encoded in a compact binary form, using MessagePack (see
+:mod:`sumatra.recordstore.binary`). The binary form contains the same data as
+the JSON form, wrapped in an object of the form
+{"schema": <schema version>, "record": <record data>} (or "records", for a
+list of records).
+
 
 :copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
 :license: CeCILL, see LICENSE for details.
@@ -11,17 +17,68 @@ try:
 except ImportError:
     import simplejson as json
 from datetime import datetime
+from itertools import chain
+from collections import OrderedDict
+import ast
+import hashlib
+import gzip
+import threading
 from sumatra import programs, launch, datastore, versioncontrol, parameters, dependency_finder
 from sumatra.records import Record
 from ..compatibility import string_type
 from ..core import registry
-from sumatra.formatting import record2json
+from sumatra.formatting import record2json, record2dict
+from sumatra.recordstore import binary
+
+BINARY_SCHEMA_VERSION = 1
 
 
 def encode_record(record, indent=None):
     return record2json(record, indent)
 
 
+def encode_record_binary(record):
+    """Encode a Sumatra record in the compact binary format."""
+    return binary.packb({"schema": BINARY_SCHEMA_VERSION, "record": record2dict(record)})
+
+
+def encode_records_binary(records):
+    """Encode a list of Sumatra records in the compact binary format."""
+    return binary.packb({"schema": BINARY_SCHEMA_VERSION,
+                         "records": [record2dict(record) for record in records]})
+
+
+def is_binary(content):
+    """Is `content` in the binary format (rather than JSON)?"""
+    return content.lstrip()[:1] not in (b"{", b"[")
+
+
+def unpack_binary(content):
+    """
+    Decode content in the binary format, returning the enclosing object (a
+    dict with keys "schema" and "record" or "records").
+    """
+    data = binary.unpackb(content)
+    if not isinstance(data, dict) or "schema" not in data:
+        raise ValueError("Not a Sumatra binary record")
+    if data["schema"] > BINARY_SCHEMA_VERSION:
+        raise ValueError("Binary record schema version %s is not supported by this version of Sumatra "
+                         "(maximum %d)" % (data["schema"], BINARY_SCHEMA_VERSION))
+    return data
+
+
+def content_hash(record):
+    """
+    Return a SHA1 hash of the JSON encoding of a record, which does not depend
+    on the order of dictionary keys or of tags. Records with the same content
+    hash are identical; records with different hashes may still be equal
+    according to Record.__eq__().
+    """
+    data = json.loads(encode_record(record))
+    data["tags"] = sorted(data["tags"])
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def encode_project_info(long_name, description):
     """Encode a Sumatra project as JSON"""
     data = {}
@@ -54,13 +111,97 @@ def decode_project_data(content):
 # shouldn't this be called decode_project_info, for symmetry?
 
 
+def decode_label_list(content):
+    """Return the list of record labels contained in a JSON string."""
+    return json.loads(content)
+
+
 def datestring_to_datetime(s):
-    """docstring"""
+    """
+    Convert a string of the form "2014-03-26 09:42:31" (the "T" separator,
+    fractional seconds and date-only strings are also accepted) to a datetime
+    object.
+    """
+    for format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                   "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S.%f"):
+        try:
+            return datetime.strptime(s, format)
+        except ValueError:
+            pass
+    return datetime.strptime(s, "%Y-%m-%d")
+
+
+# cache of (base class, class name) -> class, filled by get_component_class()
+_component_classes = {}
+
+
+def get_component_class(base_class, class_name, module, default=None):
+    """
+    Return the subclass of `base_class` whose name is `class_name`, looking
+    first in the component registry and then for an attribute of `module`.
+    Successful lookups are cached.
+    """
+    key = (base_class, class_name)
     try:
-        timestamp = datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
-    except ValueError:
-        timestamp = datetime.strptime(s, "%Y-%m-%dT%H:%M:%S")
-    return timestamp
+        return _component_classes[key]
+    except KeyError:
+        pass
+    dispatch_table = dict((cls.__name__, cls)
+                          for cls in registry.components[base_class].values())
+    if class_name in dispatch_table:
+        cls = dispatch_table[class_name]
+    elif default is None:
+        cls = getattr(module, class_name)
+    else:
+        cls = getattr(module, class_name, None)
+        if cls is None:
+            return default  # not cached, the class may be registered later
+    _component_classes[key] = cls
+    return cls
+
+
+# cache of (class, url, upstream) -> Repository, used by build_repository(),
+# least recently used last. Creating a Repository object can involve querying
+# the version control system for the upstream repository, which is slow and
+# which we do not need to do, since the upstream information is stored with
+# the record. The cached objects are never returned, only copies of them.
+# Records are deserialized from several threads by ShardedRecordStore, hence
+# the lock.
+_repositories = OrderedDict()
+_repositories_lock = threading.Lock()
+MAX_CACHED_REPOSITORIES = 100
+
+
+def build_repository(data):
+    """Create a Repository object from a dictionary."""
+    repos_cls = get_component_class(versioncontrol.Repository, data["type"],
+                                    versioncontrol, default=versioncontrol.base.Repository)
+    upstream = data.get("upstream", None)
+    key = (repos_cls, data["url"], upstream)
+    with _repositories_lock:
+        prototype = _repositories.pop(key, None)
+        if prototype is not None:
+            _repositories[key] = prototype
+    if prototype is None:
+        prototype = repos_cls(data["url"])
+        prototype.upstream = upstream
+        with _repositories_lock:
+            _repositories.pop(key, None)
+            if len(_repositories) >= MAX_CACHED_REPOSITORIES:
+                _repositories.popitem(last=False)
+            _repositories[key] = prototype
+    # copy the attributes, since unpickling or copy.copy() would call __init__() again
+    repository = repos_cls.__new__(repos_cls)
+    repository.__dict__.update(prototype.__dict__)
+    return repository
+
+
+def literal(s):
+    """
+    Parse the string representation of a Python literal (dict, list, string,
+    number, etc.). Unlike eval(), this never executes code.
+    """
+    return ast.literal_eval(s)
 
 
 def build_record(data):
@@ -69,33 +210,24 @@ def build_record(data):
     cls = registry.components[programs.Executable].get(edata["name"], programs.Executable)
     executable = cls(edata["path"], edata["version"], edata.get("options", ""))
     executable.name = edata["name"]
-    rdata = data["repository"]
-    repos_cls = None
-    for m in versioncontrol.vcs_list:
-        if hasattr(m, rdata["type"]):
-            repos_cls = getattr(m, rdata["type"])
-            break
-    if repos_cls is None:
-        repos_cls = versioncontrol.base.Repository
-    repository = repos_cls(rdata["url"])
-    repository.upstream = rdata.get("upstream", None)
+    repository = build_repository(data["repository"])
     pdata = data["parameters"]
     if pdata["type"] == "dict":
-        parameter_set = eval(pdata["content"])
+        parameter_set = literal(pdata["content"])
         assert isinstance(parameter_set, dict)
     else:
-        parameter_set = getattr(parameters, pdata["type"])(pdata["content"])
+        parameter_set = get_component_class(parameters.ParameterSet, pdata["type"], parameters)(pdata["content"])
     ldata = data["launch_mode"]
     lm_parameters = ldata["parameters"]
     if isinstance(lm_parameters, string_type):  # prior to 0.3
-        lm_parameters = eval(lm_parameters)
-    launch_mode = getattr(launch, ldata["type"])(**keys2str(lm_parameters))
+        lm_parameters = literal(lm_parameters)
+    launch_mode = get_component_class(launch.LaunchMode, ldata["type"], launch)(**keys2str(lm_parameters))
 
     def build_data_store(ddata):
         ds_parameters = ddata["parameters"]
         if isinstance(ds_parameters, string_type):  # prior to 0.3
-            ds_parameters = eval(ds_parameters)
-        return getattr(datastore, ddata["type"])(**keys2str(ds_parameters))
+            ds_parameters = literal(ds_parameters)
+        return get_component_class(datastore.DataStore, ddata["type"], datastore)(**keys2str(ds_parameters))
     data_store = build_data_store(data["datastore"])
     if "input_datastore" in data:  # 0.4 onwards
         input_datastore = build_data_store(data["input_datastore"])
@@ -103,7 +235,7 @@ def build_record(data):
         input_datastore = datastore.FileSystemDataStore("/")
     input_data = data.get("input_data", [])
     if isinstance(input_data, string_type):  # 0.3
-        input_data = eval(input_data)
+        input_data = literal(input_data)
     if input_data:
         if isinstance(input_data[0], string_type):  # versions prior to 0.4
             input_data = [datastore.DataKey(path, digest=datastore.IGNORE_DIGEST)
@@ -127,7 +259,7 @@ def build_record(data):
             data_key = datastore.DataKey(keydata["path"], keydata["digest"], **keys2str(keydata["metadata"]))
             record.output_data.append(data_key)
     elif "data_key" in data:  # (versions prior to 0.4)
-        for path in eval(data["data_key"]):
+        for path in literal(data["data_key"]):
             data_key = datastore.DataKey(path, digest=datastore.IGNORE_DIGEST)
             record.output_data.append(data_key)
     record.duration = data["duration"]
@@ -147,10 +279,66 @@ def build_record(data):
 
 
 def decode_record(content):
-    """Create a Sumatra record from a JSON string."""
+    """Create a Sumatra record from a JSON string or from binary content."""
+    if is_binary(content):
+        return build_record(unpack_binary(content)["record"])
     return build_record(json.loads(content))
 
 
+def decode_content_hashes(content):
+    """
+    Decode a JSON object mapping record labels to [content hash, modification
+    time] pairs. Return None if the content is not an object.
+    """
+    data = json.loads(content)
+    if not isinstance(data, dict):
+        return None
+    return dict((label, (content_hash, modified and datestring_to_datetime(modified)))
+                for label, (content_hash, modified) in data.items())
+
+
+def decode_record_page(content):
+    """
+    Create multiple Sumatra records from a JSON array, or from binary content.
+    Return None if the content is not an array (e.g. if a server which does
+    not support the "expand" query parameter returns the project data instead).
+    """
+    if is_binary(content):
+        data = unpack_binary(content).get("records")
+    else:
+        data = json.loads(content)
+    if not isinstance(data, list):
+        return None
+    return [build_record(record_data) for record_data in data]
+
+
 def decode_records(content):
     """Create multiple Sumatra records from a JSON string."""
     return [build_record(data) for data in json.loads(content)]
+
+
+def read_records(fileobj):
+    """
+    Iterate over the records in a file-like object in JSON Lines format (one
+    JSON-encoded record per line). Files containing a JSON array of records,
+    as produced by older versions of Sumatra, are also accepted, but are read
+    into memory all at once.
+    """
+    first_line = fileobj.readline()
+    if first_line.lstrip().startswith("["):
+        for record in decode_records(first_line + fileobj.read()):
+            yield record
+    else:
+        for line in chain([first_line], fileobj):
+            if line.strip():
+                yield build_record(json.loads(line))
+
+
+def open_json_lines(filename, mode="r"):
+    """
+    Open a JSON Lines file, which is compressed with gzip if the filename ends
+    in ".gz".
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "b")
+    return open(filename, mode)
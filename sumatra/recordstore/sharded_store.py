@@ -0,0 +1,333 @@
+"""
+Handles storage of the records of very large projects across several record
+stores ("shards"), so that no single database file (and no single lock)
+holds all of them.
+
+Records are assigned to shards either by a hash of their label (the
+default), which spreads them evenly, or by the month of their timestamp,
+which keeps records from the same period together. With *N* shards, month
+*m* (counting from year 0) goes to shard *m* modulo *N*, so the shards are
+used in turn as time goes on.
+
+Queries which may involve every shard, such as :meth:`ShardedRecordStore.list`,
+are sent to all of them at once, from a pool of threads, and the results are
+merged by timestamp (or by the requested ordering). When sharding by month,
+:meth:`ShardedRecordStore.most_recent` only needs to consult the shard holding
+the most recent month.
+
+To change the number of shards, or how records are assigned to them, create
+a new ShardedRecordStore and synchronize it with the old one (or use
+"smt configure --store"), which copies each record to its new shard.
+
+A sharded store can be given as a URI of the form
+"shards:<label|month>:<uri>,<uri>,...", where each <uri> is the path, URL or
+URI of one shard.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import hashlib
+from datetime import datetime
+from itertools import chain
+import heapq
+from multiprocessing.pool import ThreadPool
+from sumatra.recordstore.base import (RecordStore, BATCH_SIZE, group_by_datastore,
+                                      record_store_state, record_store_from_state)
+from sumatra.compatibility import string_type
+from ..core import registry
+
+URI_SCHEME = "shards"
+SHARD_BY = ("label", "month")
+
+
+def month_index(timestamp):
+    """Return the number of months from the start of year 0 to *timestamp*."""
+    return timestamp.year * 12 + timestamp.month - 1
+
+
+def month_start(index):
+    """Return the start of the month with the given :func:`month_index`."""
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def label_hash(label):
+    """Return a hash of a record label which is the same in every process."""
+    if not isinstance(label, bytes):
+        label = label.encode("utf-8")
+    return int(hashlib.md5(label).hexdigest(), 16)
+
+
+def parse_uri(uri):
+    """Return how records are sharded and the list of shard URIs given by a sharded store URI."""
+    scheme, shard_by, shards = uri.split(":", 2)
+    assert scheme == URI_SCHEME
+    return shard_by, [shard for shard in shards.split(",") if shard]
+
+
+def _keyed_by_label(records, i):
+    for record in records:
+        yield record.label, i, record
+
+
+class ShardedRecordStore(RecordStore):
+    """
+    Record store which distributes records between several *shards*, by
+    label or by month (see *shard_by*). Each shard may be a RecordStore, a
+    URI, or the state of a record store as saved in a project file.
+    Alternatively, *shards* may be a sharded store URI, which also gives
+    *shard_by*.
+
+    Queries are sent to the shards in parallel unless *parallel* is False.
+    """
+
+    def __init__(self, shards, shard_by="label", parallel=True):
+        if isinstance(shards, string_type):
+            shard_by, shards = parse_uri(shards)
+        if shard_by not in SHARD_BY:
+            raise ValueError("Records can be sharded by %s, not by '%s'" % (" or ".join(SHARD_BY), shard_by))
+        if not shards:
+            raise ValueError("A sharded record store needs at least one shard")
+        self.shards = [record_store_from_state(shard) for shard in shards]
+        self.shard_by = shard_by
+        self.parallel = parallel
+        self._pool = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Stop the threads used to query the shards in parallel, if any."""
+        if getattr(self, "_pool", None) is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __str__(self):
+        return "%d shards by %s (%s)" % (len(self.shards), self.shard_by,
+                                         ", ".join(str(shard) for shard in self.shards))
+
+    def __getstate__(self):
+        return {'shards': [record_store_state(shard) for shard in self.shards],
+                'shard_by': self.shard_by,
+                'parallel': self.parallel}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @classmethod
+    def accepts_uri(cls, uri):
+        return uri.startswith(URI_SCHEME + ":")
+
+    def _map(self, function, items=None):
+        """Apply *function* to each shard (or each of *items*), in parallel."""
+        items = self.shards if items is None else list(items)
+        if not self.parallel or len(items) < 2:
+            return [function(item) for item in items]
+        if self._pool is None:
+            self._pool = ThreadPool(len(self.shards))
+        return self._pool.map(function, items)
+
+    def _map_groups(self, function, groups):
+        """Apply *function* to each (shard, items) pair in *groups*, in parallel."""
+        return self._map(lambda group: function(*group), groups)
+
+    def _shard_index(self, record):
+        if self.shard_by == "label":
+            return label_hash(record.label) % len(self.shards)
+        return month_index(record.timestamp) % len(self.shards)
+
+    def _group(self, project_name, labels):
+        """
+        Return a list of (shard, labels) pairs, giving the shard which
+        contains each of the given labels. Labels of records which do not
+        exist may be omitted.
+        """
+        labels = list(labels)
+        if self.shard_by == "label":
+            groups = [[] for shard in self.shards]
+            for label in labels:
+                groups[label_hash(label) % len(self.shards)].append(label)
+            return [(shard, group) for shard, group in zip(self.shards, groups) if group]
+        found = self._map(lambda shard: shard.content_hashes(project_name, labels=labels))
+        return [(shard, list(hashes)) for shard, hashes in zip(self.shards, found) if hashes]
+
+    def _find(self, project_name, label):
+        """Return the shard which contains the record with the given label."""
+        for shard, labels in self._group(project_name, [label]):
+            return shard
+        raise KeyError(label)
+
+    # reading
+
+    def list_projects(self):
+        return sorted(set(chain(*self._map(lambda shard: shard.list_projects()))))
+
+    def has_project(self, project_name):
+        return any(self._map(lambda shard: shard.has_project(project_name)))
+
+    def get(self, project_name, label):
+        return self._find(project_name, label).get(project_name, label)
+
+    def get_many(self, project_name, labels, batch_size=BATCH_SIZE):
+        results = self._map_groups(lambda shard, labels: list(shard.get_many(project_name, labels,
+                                                                              batch_size=batch_size)),
+                                   self._group(project_name, labels))
+        return chain(*results)
+
+    def list(self, project_name, tags=None, since=None, until=None,
+             limit=None, offset=None, order_by=None, fields=None, where=None,
+             all_tags=None, not_tags=None):
+        """
+        See :meth:`RecordStore.list`. Records are returned newest first
+        unless *order_by* is given.
+        """
+        order_by = order_by or "-timestamp"
+        attr = order_by.lstrip("-")
+        shard_fields = fields
+        if fields and attr not in fields:
+            shard_fields = list(fields) + [attr]
+        # each shard returns its first offset + limit records, in order
+        shard_limit = None if limit is None else (offset or 0) + limit
+        results = self._map(lambda shard: shard.list(project_name, tags=tags, since=since, until=until,
+                                                     limit=shard_limit, order_by=order_by,
+                                                     fields=shard_fields, where=where,
+                                                     all_tags=all_tags, not_tags=not_tags))
+        if fields:
+            key = lambda row: row[attr]
+        else:
+            key = lambda record: getattr(record, attr)
+        # sorting the concatenated results merges the sorted results of each shard
+        records = sorted(chain(*results), key=key, reverse=order_by.startswith("-"))
+        records = records[offset or 0:]
+        if limit is not None:
+            records = records[:limit]
+        if shard_fields is not fields:
+            for row in records:
+                del row[attr]
+        return records
+
+    def labels(self, project_name):
+        return list(chain(*self._map(lambda shard: shard.labels(project_name))))
+
+    def _newest(self, project_name, shards, since=None):
+        """Return the label and timestamp of the most recent record in *shards*, or None."""
+        newest = self._map(lambda shard: shard.list(project_name, since=since, order_by="-timestamp",
+                                                    limit=1, fields=["label", "timestamp"]),
+                           shards)
+        rows = list(chain(*newest))
+        if not rows:
+            return None
+        row = max(rows, key=lambda row: row["timestamp"])
+        return row["label"], row["timestamp"]
+
+    def most_recent(self, project_name):
+        if self.shard_by == "month":
+            # working back from the current month, the first month found to
+            # contain records holds the most recent one
+            current = month_index(datetime.now())
+            for index in range(current, current - len(self.shards), -1):
+                shard = self.shards[index % len(self.shards)]
+                newest = self._newest(project_name, [shard], since=month_start(index))
+                if newest:
+                    return newest[0]
+        # there is no newest shard, or records are more than len(shards) months old
+        newest = self._newest(project_name, self.shards)
+        if newest is None:
+            raise KeyError(project_name)
+        return newest[0]
+
+    def search(self, project_name, query, limit=None):
+        results = self._map(lambda shard: shard.search(project_name, query, limit=limit))
+        records = sorted(chain(*results), key=lambda record: record.timestamp, reverse=True)
+        return records if limit is None else records[:limit]
+
+    def iter_records(self, project_name, batch_size=BATCH_SIZE, tags=None):
+        """
+        Iterate over the records of a project, in order of label, merging
+        the records of each shard as they are retrieved.
+        """
+        iterators = [_keyed_by_label(shard.iter_records(project_name, batch_size=batch_size, tags=tags), i)
+                     for i, shard in enumerate(self.shards)]
+        for label, i, record in heapq.merge(*iterators):
+            yield record
+
+    def parameter_columns(self, project_name, tags=None):
+        columns = {}
+        for shard_columns in self._map(lambda shard: shard.parameter_columns(project_name, tags=tags)):
+            for name, numeric in shard_columns.items():
+                columns[name] = columns.get(name, True) and numeric
+        return columns
+
+    def content_hashes(self, project_name, labels=None, since=None):
+        if labels is not None and self.shard_by == "label":
+            results = self._map_groups(lambda shard, labels: shard.content_hashes(project_name, labels=labels,
+                                                                                 since=since),
+                                       self._group(project_name, labels))
+        else:
+            results = self._map(lambda shard: shard.content_hashes(project_name, labels=labels,
+                                                                   since=since))
+        hashes = {}
+        for shard_hashes in results:
+            hashes.update(shard_hashes)
+        return hashes
+
+    def output_data(self, project_name, labels):
+        results = self._map_groups(lambda shard, labels: shard.output_data(project_name, labels),
+                                   self._group(project_name, labels))
+        return group_by_datastore(chain(*results))
+
+    # writing
+
+    def save(self, project_name, record):
+        self.shards[self._shard_index(record)].save(project_name, record)
+
+    def save_batch(self, project_name, records):
+        groups = [[] for shard in self.shards]
+        for record in records:
+            groups[self._shard_index(record)].append(record)
+        self._map_groups(lambda shard, records: shard.save_batch(project_name, records),
+                         [(shard, group) for shard, group in zip(self.shards, groups) if group])
+
+    def delete(self, project_name, label):
+        if self.shard_by == "label":
+            shard = self.shards[label_hash(label) % len(self.shards)]
+        else:
+            shard = self._find(project_name, label)
+        shard.delete(project_name, label)
+
+    def delete_many(self, project_name, labels):
+        return sum(self._map_groups(lambda shard, labels: shard.delete_many(project_name, labels),
+                                    self._group(project_name, labels)))
+
+    def delete_by_tag(self, project_name, tag):
+        return sum(self._map(lambda shard: shard.delete_by_tag(project_name, tag)))
+
+    def delete_all(self):
+        self._map(lambda shard: shard.delete_all())
+
+    def clear(self):
+        self._map(lambda shard: shard.clear())
+
+    def update(self, project_name, field, value, tags=None, dry_run=False):
+        report = {}
+        for shard_report in self._map(lambda shard: shard.update(project_name, field, value,
+                                                                 tags=tags, dry_run=dry_run)):
+            for old_value, n in shard_report.items():
+                report[old_value] = report.get(old_value, 0) + n
+        return report
+
+    def reindex(self):
+        return sum(self._map(lambda shard: shard.reindex()))
+
+    def upgrade(self, progress=None):
+        steps = []
+        for shard in self.shards:
+            shard_steps = shard.upgrade(progress=progress)
+            if shard_steps is None:
+                return None
+            steps.extend(shard_steps)
+        return steps
+
+
+registry.register(ShardedRecordStore)
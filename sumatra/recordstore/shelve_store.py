@@ -9,7 +9,12 @@ shelve module.
 import os
 import shelve
 from datetime import datetime
-from sumatra.recordstore.base import RecordStore
+from sumatra.recordstore.base import (RecordStore, filter_records, select_fields,
+                                      get_field, set_field, update_report, tag_list,
+                                      group_by_datastore, BATCH_SIZE)
+from sumatra.recordstore.serialization import content_hash
+from sumatra.records import record_fingerprint, FINGERPRINT_VERSION
+from sumatra.recordstore import blobs
 from ..core import registry
 
 
@@ -20,12 +25,52 @@ def check_name(f):
     before calling the wrapped method. See http://bugs.python.org/issue1036490
     """
 
-    def wrapped(self, project_name, *args):
+    def wrapped(self, project_name, *args, **kwargs):
         project_name = str(project_name)
-        return f(self, project_name, *args)
+        return f(self, project_name, *args, **kwargs)
     return wrapped
 
 
+def index_key(project_name):
+    """
+    Return the shelf key under which the index for the given project is
+    stored. Project names may not contain ":", so this cannot clash with
+    the key under which the records themselves are stored.
+    """
+    return "%s:index" % project_name
+
+
+def select_tagged(tag_index, labels, tags=None, all_tags=None, not_tags=None):
+    """
+    Return the subset of *labels* selected by a tag query (see
+    :meth:`RecordStore.list`), using an index mapping each tag to the set of
+    labels of the records which have it.
+    """
+    selected = set(labels)
+    if tags:
+        tagged = set()
+        for tag in tag_list(tags):
+            tagged.update(tag_index.get(tag, ()))
+        selected.intersection_update(tagged)
+    for tag in tag_list(all_tags):
+        selected.intersection_update(tag_index.get(tag, ()))
+    for tag in tag_list(not_tags):
+        selected.difference_update(tag_index.get(tag, ()))
+    return selected
+
+
+def blob_key(blob_hash):
+    """Return the shelf key under which a blob is stored."""
+    return "blob:%s" % blob_hash
+
+
+class BlobReference(object):
+    """Stands in for a text field of a stored record, which is held in a blob."""
+
+    def __init__(self, blob_hash):
+        self.hash = blob_hash
+
+
 class ShelveRecordStore(RecordStore):
     """
     Handles storage of simulation/analysis records based on the Python standard
@@ -34,10 +79,16 @@ class ShelveRecordStore(RecordStore):
     The advantage of this record store is that it has no dependencies. The
     disadvantages are that it allows only local access and does not support
     the *smtweb* interface.
+
+    Long text fields (stdout_stderr, diff and the diffs of dependencies) are
+    stored once, as blobs shared between records, compressed with zlib unless
+    *compress_blobs* is False. A blob is deleted when the last record which
+    refers to it is deleted or replaced.
     """
 
-    def __init__(self, shelf_name=".smt/records"):
+    def __init__(self, shelf_name=".smt/records", compress_blobs=True):
         self._shelf_name = shelf_name
+        self.compress_blobs = compress_blobs
         self.shelf = shelve.open(shelf_name)
 
     def __del__(self):
@@ -48,72 +99,346 @@ class ShelveRecordStore(RecordStore):
         return "Record store using the shelve package (database file=%s)" % self._shelf_name
 
     def __getstate__(self):
-        return {'shelf_name': self._shelf_name}
+        return {'shelf_name': self._shelf_name, 'compress_blobs': self.compress_blobs}
 
     def __setstate__(self, state):
         self.__init__(**state)
 
     def list_projects(self):
-        return self.shelf.keys()
+        return [key for key in self.shelf.keys() if ":" not in key]
+
+    def _put_blob(self, text):
+        """
+        Store *text* as a blob, if it is long enough, and return a reference
+        to it. Otherwise return the text itself.
+        """
+        data = blobs.encode_text(text)
+        if data is None:
+            return text
+        h = blobs.blob_hash(data)
+        key = blob_key(h)
+        if key not in self.shelf:
+            self.shelf[key] = blobs.pack(data, self.compress_blobs)
+        return BlobReference(h)
+
+    def _load_blob(self, blob_hash):
+        content, compressed = self.shelf[blob_key(blob_hash)]
+        return blobs.unpack(content, compressed)
+
+    def _blob_hashes(self, stored):
+        """Return the hashes of the blobs which a stored record refers to."""
+        hashes = set()
+        for name in blobs.BLOB_FIELDS:
+            value = stored.__dict__.get(name)
+            if isinstance(value, BlobReference):
+                hashes.add(value.hash)
+        for dep in stored.__dict__.get("dependencies", []):
+            if isinstance(dep.diff, BlobReference):
+                hashes.add(dep.diff.hash)
+        return hashes
+
+    def _delete_unreferenced_blobs(self, candidates, project_name, stored_records):
+        """
+        Delete those of the blobs with hashes in *candidates* (which were
+        referred to by records which have been deleted or replaced) to which
+        no remaining record, in any project, refers. *stored_records* are the
+        remaining records of *project_name*, which may not be saved yet.
+        """
+        for name in self.list_projects():
+            if not candidates:
+                return
+            records = stored_records if name == project_name else self.shelf[name]
+            for stored in records.itervalues():
+                candidates.difference_update(self._blob_hashes(stored))
+        for blob_hash in candidates:
+            key = blob_key(blob_hash)
+            if key in self.shelf:
+                del self.shelf[key]
+
+    def _stored_copy(self, record):
+        """
+        Return a shallow copy of *record* in which long text fields are
+        replaced by references to blobs, with its fingerprint.
+        """
+        stored = object.__new__(record.__class__)
+        stored.__dict__.update(record.__dict__)
+        stored.__dict__["_fingerprint"] = record_fingerprint(record)
+        stored.__dict__["_fingerprint_version"] = FINGERPRINT_VERSION
+        loaders = stored.__dict__.pop("_loaders", {})
+        for name in blobs.BLOB_FIELDS:
+            loader = loaders.get(name)
+            if isinstance(loader, blobs.BlobLoader) and loader.load == self._load_blob:
+                stored.__dict__[name] = BlobReference(loader.hash)  # avoid loading the text
+            else:
+                stored.__dict__[name] = self._put_blob(getattr(record, name))
+        if "dependencies" in stored.__dict__:
+            dependencies = []
+            for dep in record.dependencies:
+                stored_dep = object.__new__(dep.__class__)
+                stored_dep.__dict__.update(dep.__dict__)
+                stored_dep.diff = self._put_blob(dep.diff)
+                dependencies.append(stored_dep)
+            stored.dependencies = dependencies
+        return stored
+
+    def _loaded(self, record):
+        """
+        Prepare a record retrieved from the shelf for use, by arranging for
+        the text of any blobs it refers to to be loaded when needed. A
+        fingerprint stored by an older version of Sumatra is discarded, to be
+        recalculated when needed.
+        """
+        if record.__dict__.pop("_fingerprint_version", None) != FINGERPRINT_VERSION:
+            record.__dict__.pop("_fingerprint", None)
+        for name in blobs.BLOB_FIELDS:
+            value = record.__dict__.get(name)
+            if isinstance(value, BlobReference):
+                record.set_loader(name, blobs.BlobLoader(self._load_blob, value.hash))
+        for dep in getattr(record, "dependencies", []):
+            if isinstance(dep.diff, BlobReference):
+                dep.diff = self._load_blob(dep.diff.hash)
+        return record
+
+    def _get_records(self, project_name):
+        """Return a dict containing all the records of a project."""
+        records = self.shelf[project_name]
+        for record in records.itervalues():
+            self._loaded(record)
+        return records
+
+    def _get_index(self, project_name):
+        """
+        Return the index of record timestamps, content hashes and tags for the
+        given project, building it if the shelf was created by an older version
+        of Sumatra.
+        """
+        key = index_key(project_name)
+        old_index = self.shelf[key] if key in self.shelf else {}
+        if "tags" in old_index:
+            return old_index
+        # keep the synchronization state of an index from an older version
+        old_hashes = old_index.get("hashes", {})
+        index = {"timestamps": {}, "most_recent": None, "hashes": {},
+                 "sync": old_index.get("sync", {}), "tags": {}}
+        if project_name in self.shelf:
+            for record in self._get_records(project_name).itervalues():
+                modified = old_hashes.get(record.label, (None, None))[1]
+                self._add_to_index(index, record, modified)
+            self.shelf[key] = index
+        return index
+
+    def _add_to_index(self, index, record, modified=None):
+        index["timestamps"][record.label] = record.timestamp
+        index["hashes"][record.label] = (content_hash(record), modified)
+        self._remove_tags(index, record.label)
+        for tag in record.tags:
+            index["tags"].setdefault(tag, set()).add(record.label)
+        most_recent = index["most_recent"]
+        if most_recent is None or record.timestamp >= index["timestamps"][most_recent]:
+            index["most_recent"] = record.label
+
+    def _remove_from_index(self, index, label):
+        timestamps = index["timestamps"]
+        timestamps.pop(label)
+        index["hashes"].pop(label)
+        self._remove_tags(index, label)
+        if index["most_recent"] == label:
+            if timestamps:
+                index["most_recent"] = max(timestamps, key=timestamps.get)
+            else:
+                index["most_recent"] = None
+
+    def _remove_tags(self, index, label):
+        tags = index["tags"]
+        for tag, labels in tags.items():
+            labels.discard(label)
+            if not labels:
+                del tags[tag]
 
     @check_name
     def save(self, project_name, record):
+        index = self._get_index(project_name)
         if self.shelf.has_key(project_name):
             records = self.shelf[project_name]
         else:
             records = {}
-        records[record.label] = record
+        old = records.get(record.label)
+        records[record.label] = self._stored_copy(record)
         self.shelf[project_name] = records
+        self._add_to_index(index, record, modified=datetime.now())
+        self.shelf[index_key(project_name)] = index
+        if old is not None:
+            self._delete_unreferenced_blobs(
+                self._blob_hashes(old) - self._blob_hashes(records[record.label]),
+                project_name, records)
 
     @check_name
-    def get(self, project_name, label):
-        return self.shelf[project_name][label]
+    def save_batch(self, project_name, records):
+        """Store several records, rewriting the shelf only once."""
+        index = self._get_index(project_name)
+        if self.shelf.has_key(project_name):
+            stored_records = self.shelf[project_name]
+        else:
+            stored_records = {}
+        modified = datetime.now()
+        for record in records:
+            stored_records[record.label] = self._stored_copy(record)
+            self._add_to_index(index, record, modified)
+        self.shelf[project_name] = stored_records
+        self.shelf[index_key(project_name)] = index
 
     @check_name
-    def list(self, project_name, tags=None):
+    def iter_records(self, project_name, batch_size=BATCH_SIZE, tags=None):
+        """
+        Iterate over the records of a project (with at least one of *tags*,
+        if given), in order of label. The shelf stores all of a project's
+        records together, so *batch_size* is ignored.
+        """
         if project_name in self.shelf:
+            records = self._get_records(project_name)
+            labels = records
             if tags:
-                if not hasattr(tags, "__iter__"):
-                    tags = [tags]
-                records = set()
-                for tag in tags:
-                    records = records.union([record for record in self.shelf[project_name].values() if tag in record.tags])
-                records = list(records)
+                labels = select_tagged(self._get_index(project_name)["tags"], records, tags)
+            for label in sorted(labels):
+                yield records[label]
+
+    @check_name
+    def get(self, project_name, label):
+        return self._loaded(self.shelf[project_name][label])
+
+    @check_name
+    def get_many(self, project_name, labels, batch_size=BATCH_SIZE):
+        """
+        Iterate over the records with the given labels. The shelf stores all
+        of a project's records together, so they are read only once, and
+        *batch_size* is ignored.
+        """
+        if project_name in self.shelf:
+            records = self.shelf[project_name]
+            for label in labels:
+                if label in records:
+                    yield self._loaded(records[label])
+
+    @check_name
+    def list(self, project_name, tags=None, since=None, until=None,
+             limit=None, offset=None, order_by=None, fields=None, where=None,
+             all_tags=None, not_tags=None):
+        if project_name in self.shelf:
+            stored_records = self.shelf[project_name]
+            if tags or all_tags or not_tags:
+                index = self._get_index(project_name)
+                labels = select_tagged(index["tags"], stored_records, tags, all_tags, not_tags)
             else:
-                records = self.shelf[project_name].values()
+                labels = stored_records
+            records = [self._loaded(stored_records[label]) for label in labels]
         else:
             records = []
+        records = filter_records(records, since, until, order_by, limit, offset, where)
+        if fields:
+            records = select_fields(records, fields)
         return records
 
     @check_name
     def labels(self, project_name):
         if project_name in self.shelf:
-            return self.shelf[project_name].keys()
+            return self._get_index(project_name)["timestamps"].keys()
         else:
             return []
 
+    @check_name
+    def content_hashes(self, project_name, labels=None, since=None):
+        hashes = self._get_index(project_name)["hashes"]
+        if labels is not None:
+            hashes = dict((label, hashes[label]) for label in labels if label in hashes)
+        if since is not None:
+            hashes = dict((label, (h, modified)) for label, (h, modified) in hashes.items()
+                          if modified is not None and modified > since)
+        return hashes
+
+    @check_name
+    def _get_sync_watermark(self, project_name, other):
+        return self._get_index(project_name)["sync"].get(str(other))
+
+    @check_name
+    def _set_sync_watermark(self, project_name, other, watermark):
+        index = self._get_index(project_name)
+        index["sync"][str(other)] = watermark
+        self.shelf[index_key(project_name)] = index
+
     @check_name
     def delete(self, project_name, label):
+        index = self._get_index(project_name)
         records = self.shelf[project_name]
-        records.pop(label)
+        deleted = records.pop(label)
         self.shelf[project_name] = records
+        self._remove_from_index(index, label)
+        self.shelf[index_key(project_name)] = index
+        self._delete_unreferenced_blobs(self._blob_hashes(deleted), project_name, records)
 
     @check_name
-    def delete_by_tag(self, project_name, tag):
-        for_deletion = [record for record in self.shelf[project_name].values() if tag in record.tags]
-        for record in for_deletion:
-            self.delete(project_name, record.label)
+    def update(self, project_name, field, value, tags=None, dry_run=False):
+        """
+        Modify the records for a given project, in a single pass over the
+        shelf. See :meth:`RecordStore.update`.
+        """
+        if project_name not in self.shelf:
+            return {}
+        records = self._get_records(project_name)
+        if tags and not hasattr(tags, "__iter__"):
+            tags = [tags]
+        # records may share objects (e.g. data stores), so find the old values
+        # before modifying anything
+        changes = [(record, get_field(record, field))
+                   for record in records.itervalues()
+                   if not tags or record.tags.intersection(tags)]
+        changes = [(record, old_value) for record, old_value in changes if old_value != value]
+        if changes and not dry_run:
+            index = self._get_index(project_name)
+            modified = datetime.now()
+            for record, old_value in changes:
+                set_field(record, field, value)
+                self._add_to_index(index, record, modified)
+            self.shelf[project_name] = dict((label, self._stored_copy(record))
+                                            for label, record in records.items())
+            self.shelf[index_key(project_name)] = index
+        return update_report(old_value for record, old_value in changes)
+
+    @check_name
+    def delete_many(self, project_name, labels):
+        """Delete several records, rewriting the shelf only once."""
+        if project_name not in self.shelf:
+            return 0
+        records = self.shelf[project_name]
+        for_deletion = set(labels).intersection(records)
+        if for_deletion:
+            index = self._get_index(project_name)
+            blob_hashes = set()
+            for label in for_deletion:
+                blob_hashes.update(self._blob_hashes(records.pop(label)))
+                self._remove_from_index(index, label)
+            self.shelf[project_name] = records
+            self.shelf[index_key(project_name)] = index
+            self._delete_unreferenced_blobs(blob_hashes, project_name, records)
         return len(for_deletion)
 
+    @check_name
+    def output_data(self, project_name, labels):
+        if project_name not in self.shelf:
+            return []
+        records = self.shelf[project_name]
+        return group_by_datastore((records[label].datastore, records[label].output_data)
+                                  for label in labels if label in records)
+
+    @check_name
+    def delete_by_tag(self, project_name, tag):
+        """Delete the records with the given tag, found using the tag index."""
+        return self.delete_many(project_name, self._get_index(project_name)["tags"].get(tag, ()))
+
     @check_name
     def most_recent(self, project_name):
-        most_recent = None
-        most_recent_timestamp = datetime.min
-        for record in self.shelf[project_name].itervalues():
-            if record.timestamp > most_recent_timestamp:
-                most_recent_timestamp = record.timestamp
-                most_recent = record.label
-        return most_recent
+        if project_name not in self.shelf:
+            raise KeyError(project_name)
+        return self._get_index(project_name)["most_recent"]
 
     def clear(self):
         os.remove(self._shelf_name)
@@ -0,0 +1,140 @@
+"""
+A spool directory into which records can be dropped by many processes at once
+(e.g. the jobs of a large parameter sweep on a cluster), without taking any
+database locks, to be added to a record store later by a single process.
+
+Each record is written to a temporary file, which is then renamed, so a record
+appears in the spool either complete or not at all. Ingestion is protected by
+a lock file, so that only one process at a time moves records from the spool
+into the record store; processes which find the lock taken simply leave their
+records for the current holder to pick up.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import os
+import errno
+import tempfile
+import uuid
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from sumatra.recordstore import serialization
+from sumatra.recordstore.base import BATCH_SIZE
+
+SUFFIX = ".json"
+
+
+class RecordSpool(object):
+    """A directory of records waiting to be added to a record store."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._decoded = {}  # path -> record, since spooled files never change
+
+    def __str__(self):
+        return "spool (%s)" % self.directory
+
+    def _project_directory(self, project_name):
+        path = os.path.join(self.directory, project_name)
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        return path
+
+    def put(self, project_name, record):
+        """
+        Add a record to the spool and return the path of the file it was
+        written to. This can safely be called by many processes at once.
+        """
+        directory = self._project_directory(project_name)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "w") as fp:
+            fp.write(serialization.encode_record(record))
+            fp.flush()
+            os.fsync(fp.fileno())
+        # the timestamp prefix means records are ingested in the order they were run
+        filename = "%s_%s%s" % (record.timestamp.strftime("%Y%m%d-%H%M%S-%f"),
+                                uuid.uuid4().hex, SUFFIX)
+        path = os.path.join(directory, filename)
+        os.rename(tmp_path, path)
+        return path
+
+    def pending(self, project_name):
+        """Return the paths of the spooled records for a project, oldest first."""
+        directory = os.path.join(self.directory, project_name)
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, filename)
+                for filename in sorted(os.listdir(directory))
+                if filename.endswith(SUFFIX) and not filename.startswith(".")]
+
+    def records(self, project_name):
+        """
+        Iterate over the spooled records for a project, oldest first. Each
+        file is decoded only once, however often this is called.
+        """
+        paths = self.pending(project_name)
+        for path in set(self._decoded).difference(paths):
+            if os.path.dirname(path) == os.path.join(self.directory, project_name):
+                del self._decoded[path]  # ingested since the last call
+        for path in paths:
+            if path not in self._decoded:
+                try:
+                    with open(path) as fp:
+                        content = fp.read()
+                except IOError as err:  # ingested by another process in the meantime
+                    if err.errno == errno.ENOENT:
+                        continue
+                    raise
+                self._decoded[path] = serialization.decode_record(content)
+            yield self._decoded[path]
+
+    def _lock(self, project_name):
+        """
+        Try to take the ingestion lock for a project without waiting. Return
+        the open lock file, or None if another process holds the lock.
+        """
+        lock_file = open(os.path.join(self._project_directory(project_name), ".lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                lock_file.close()
+                if err.errno in (errno.EACCES, errno.EAGAIN):
+                    return None
+                raise
+        return lock_file
+
+    def ingest(self, project_name, record_store):
+        """
+        Save the spooled records for a project to `record_store` and remove
+        them from the spool. Return the number of records saved, which is zero
+        if another process is already ingesting them.
+        """
+        n = 0
+        while self.pending(project_name):
+            lock_file = self._lock(project_name)
+            if lock_file is None:
+                break
+            try:
+                paths = self.pending(project_name)
+                for start in range(0, len(paths), BATCH_SIZE):
+                    batch = paths[start:start + BATCH_SIZE]
+                    records = []
+                    for path in batch:
+                        with open(path) as fp:
+                            records.append(serialization.decode_record(fp.read()))
+                    record_store.save_batch(project_name, records)
+                    for path in batch:
+                        os.remove(path)
+                    n += len(batch)
+            finally:
+                lock_file.close()  # releases the lock
+            # records spooled while we held the lock are picked up by the next loop
+        return n
@@ -0,0 +1,310 @@
+"""
+Read-only snapshots of a project's records, for fast analysis.
+
+A snapshot stores, for each record, its label, timestamp, duration, the total
+size of its output data, its tags and the values of its numerical parameters
+(with dotted names for nested parameters), as a NumPy structured array with
+one field per column, in a ``.npy`` file. :class:`RecordTable` maps the file
+into memory without copying or deserializing it, and selects records with
+vectorized operations on the columns, e.g.::
+
+    >>> table = project.record_table()
+    >>> fast = table.select(where="sim.dt<0.1", tags="bursting")
+    >>> fast.labels, fast["duration"].mean()
+
+Snapshots are updated incrementally: only records which have been saved (or
+deleted) since the previous update, according to the record store's content
+hashes and modification times, are read from the record store.
+
+NumPy is needed to use this module.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import os
+import json
+import tempfile
+from datetime import datetime
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+from sumatra.core import TIMESTAMP_FORMAT
+from sumatra.compatibility import string_type
+from sumatra.recordstore.base import latest_modification, tag_list
+from sumatra.recordstore.query import parse_where, parameter_values, as_number, OPERATORS
+
+PARAMETER_PREFIX = "parameters."
+TAG_PREFIX = "tags."
+FIXED_FIELDS = ("label", "timestamp", "duration", "output_size", "content_hash")
+
+
+def _field_name(name):
+    # NumPy field names must be native strings
+    if not isinstance(name, str):
+        name = name.encode("utf-8")
+    return name
+
+
+def _require_numpy():
+    if not have_numpy:
+        raise ImportError("Record snapshots require NumPy, which is not installed.")
+
+
+def snapshot_row(record, record_hash=None):
+    """Return a dict containing the values stored in a snapshot for a record."""
+    row = {
+        "label": record.label,
+        "timestamp": record.timestamp,
+        "duration": record.duration,
+        "output_size": sum(key.metadata.get("size") or 0 for key in record.output_data),
+        "content_hash": record_hash or "",
+    }
+    for name, value in parameter_values(record.parameters).items():
+        number = as_number(value)
+        if number is not None:
+            row[PARAMETER_PREFIX + name] = number
+    for tag in record.tags:
+        row[TAG_PREFIX + tag] = True
+    return row
+
+
+def _dtype(names, label_length):
+    fields = [("label", "U%d" % max(label_length, 1)),
+              ("timestamp", "M8[us]"),
+              ("duration", "f8"),
+              ("output_size", "i8"),
+              ("content_hash", "S40")]
+    for name in sorted(names):
+        if name.startswith(PARAMETER_PREFIX):
+            fields.append((_field_name(name), "f8"))
+        else:
+            fields.append((_field_name(name), "?"))
+    return numpy.dtype(fields)
+
+
+def _missing_value(dtype):
+    if dtype.kind == "f":
+        return numpy.nan
+    elif dtype.kind == "b":
+        return False
+    return None
+
+
+def _merge(arrays, rows):
+    """
+    Combine structured arrays from earlier snapshots with new rows into a
+    single array with the union of their columns, sorted by timestamp.
+    """
+    names = set()
+    label_length = 1
+    for array in arrays:
+        names.update(name for name in array.dtype.names if name not in FIXED_FIELDS)
+        label_length = max(label_length, array.dtype["label"].itemsize // 4)
+    for row in rows:
+        names.update(name for name in row if name not in FIXED_FIELDS)
+        label_length = max(label_length, len(row["label"]))
+    dtype = _dtype(names, label_length)
+    merged = numpy.zeros(sum(len(array) for array in arrays) + len(rows), dtype=dtype)
+    start = 0
+    for array in arrays:
+        stop = start + len(array)
+        for name in dtype.names:
+            if name in array.dtype.names:
+                merged[name][start:stop] = array[name]
+            else:
+                merged[name][start:stop] = _missing_value(dtype[name])
+        start = stop
+    if rows:
+        new = merged[start:]
+        for name in dtype.names:
+            missing = _missing_value(dtype[name])
+            values = [row.get(name, missing) for row in rows]
+            if name == "timestamp":
+                values = numpy.array(values, dtype="M8[us]")
+            elif name == "duration":
+                values = [numpy.nan if value is None else value for value in values]
+            new[name] = values
+    return merged[numpy.argsort(merged["timestamp"], kind="mergesort")]
+
+
+class RecordTable(object):
+    """
+    A read-only table of records, with one column per field of a snapshot.
+    Columns are NumPy arrays, which are views of the (memory-mapped) snapshot
+    file rather than copies.
+
+    ``table[name]`` returns a column: "label", "timestamp", "duration",
+    "output_size", or the name of a numerical parameter, e.g. "sim.dt"
+    (NaN for records without it). ``table[mask]``, with a boolean array or
+    a slice, returns a table containing only the selected records.
+    """
+
+    def __init__(self, data):
+        _require_numpy()
+        self.data = data
+
+    @classmethod
+    def load(cls, path):
+        """Map the snapshot file at *path* into memory."""
+        _require_numpy()
+        try:
+            data = numpy.load(path, mmap_mode="r")
+        except ValueError:  # an empty array cannot be memory-mapped
+            data = numpy.load(path)
+        return cls(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "<RecordTable: %d records, %d parameters, %d tags>" % (
+            len(self), len(self.parameter_names), len(self.tags))
+
+    def _names(self, prefix):
+        return [name[len(prefix):].decode("utf-8") for name in self.data.dtype.names
+                if name.startswith(prefix)]
+
+    @property
+    def parameter_names(self):
+        return self._names(PARAMETER_PREFIX)
+
+    @property
+    def tags(self):
+        return self._names(TAG_PREFIX)
+
+    @property
+    def labels(self):
+        return self.data["label"]
+
+    def column(self, name):
+        if name in FIXED_FIELDS:
+            return self.data[name]
+        field = _field_name(PARAMETER_PREFIX + name)
+        if field not in self.data.dtype.names:
+            raise KeyError(name)
+        return self.data[field]
+
+    def has_tag(self, tag):
+        """Return a boolean array which is True for the records with *tag*."""
+        field = _field_name(TAG_PREFIX + tag)
+        if field in self.data.dtype.names:
+            return self.data[field]
+        return numpy.zeros(len(self), dtype=bool)
+
+    def __getitem__(self, key):
+        if isinstance(key, string_type):
+            return self.column(key)
+        return RecordTable(self.data[key])
+
+    def mask(self, where=None, tags=None, all_tags=None, not_tags=None,
+             since=None, until=None):
+        """
+        Return a boolean array selecting the records which satisfy the
+        arguments, which have the same meaning as for
+        :meth:`RecordStore.list`. Only numerical conditions on parameters are
+        supported in *where*.
+        """
+        selected = numpy.ones(len(self), dtype=bool)
+        if where:
+            for name, op, value in parse_where(where):
+                if not isinstance(value, float):
+                    raise ValueError("Record tables contain only numerical parameters: "
+                                     "cannot select records by %s %s '%s'" % (name, op, value))
+                try:
+                    column = self.column(name)
+                except KeyError:
+                    return numpy.zeros(len(self), dtype=bool)
+                # records without the parameter (NaN) never match
+                selected &= ~numpy.isnan(column) & OPERATORS[op](column, value)
+        if tags:
+            any_tag = numpy.zeros(len(self), dtype=bool)
+            for tag in tag_list(tags):
+                any_tag |= self.has_tag(tag)
+            selected &= any_tag
+        for tag in tag_list(all_tags):
+            selected &= self.has_tag(tag)
+        for tag in tag_list(not_tags):
+            selected &= ~self.has_tag(tag)
+        if since is not None:
+            selected &= self.data["timestamp"] >= numpy.datetime64(since, "us")
+        if until is not None:
+            selected &= self.data["timestamp"] <= numpy.datetime64(until, "us")
+        return selected
+
+    def select(self, **kwargs):
+        """Return a table containing the records selected by :meth:`mask`."""
+        return self[self.mask(**kwargs)]
+
+
+class Snapshot(object):
+    """
+    The snapshot of a project's records stored in the file at *path*, with
+    a small JSON file alongside recording when it was last updated.
+    """
+
+    def __init__(self, path):
+        _require_numpy()
+        self.path = path
+        self.state_path = path + ".json"
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        return RecordTable.load(self.path)
+
+    def _read_state(self):
+        if not (self.exists() and os.path.exists(self.state_path)):
+            return None
+        with open(self.state_path) as fp:
+            state = json.load(fp)
+        if state.get("watermark"):
+            state["watermark"] = datetime.strptime(state["watermark"], TIMESTAMP_FORMAT + ".%f")
+        return state
+
+    def _replace(self, path, write):
+        """Write a file next to *path*, then rename it, so readers never see part of it."""
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+        with os.fdopen(fd, "wb") as fp:
+            write(fp)
+        os.rename(tmp_path, path)
+
+    def update(self, record_store, project_name, rebuild=False):
+        """
+        Bring the snapshot up to date with the records of a project, reading
+        only the records which have changed since the last update, unless
+        *rebuild* is True. Return the number of records read.
+        """
+        state = None if rebuild else self._read_state()
+        if state is None or state.get("project") != project_name:
+            old, watermark = None, None
+        else:
+            old, watermark = numpy.load(self.path), state["watermark"]
+        hashes = record_store.content_hashes(project_name, since=watermark)
+        labels = set(record_store.labels(project_name))
+        kept = []
+        if old is not None and len(old):
+            old_labels = old["label"]
+            old_hashes = old["content_hash"]
+            keep = numpy.array([label in labels and (label not in hashes or
+                                                     hashes[label][0] == old_hashes[i].decode("ascii"))
+                                for i, label in enumerate(old_labels)], dtype=bool)
+            kept = [old[keep]]
+            labels.difference_update(old_labels[keep])
+        rows = [snapshot_row(record, hashes.get(record.label, (None, None))[0])
+                for record in record_store.get_many(project_name, sorted(labels))]
+        merged = _merge(kept, rows)
+        self._replace(self.path, lambda fp: numpy.save(fp, merged))
+        watermark = latest_modification(hashes, watermark)
+        state = {"project": project_name,
+                 "watermark": watermark and watermark.strftime(TIMESTAMP_FORMAT + ".%f"),
+                 "updated": datetime.now().strftime(TIMESTAMP_FORMAT)}
+        self._replace(self.state_path, lambda fp: json.dump(state, fp))
+        return len(rows)
@@ -0,0 +1,156 @@
+"""
+Export of a project's records as a table, with one row per record and one
+column per record field or (flattened) parameter, e.g. "parameters.sim.dt",
+to a pandas DataFrame, a CSV file or a Parquet file.
+
+Rows are read from the record store in batches (see
+:meth:`RecordStore.iter_rows`) and written out as they are read, so memory use
+does not grow with the number of records (except for DataFrames, which hold
+the whole table). The columns are determined before the first batch is read,
+using :meth:`RecordStore.parameter_columns`.
+
+Creating DataFrames requires pandas, and writing Parquet files requires
+pyarrow.
+
+
+:copyright: Copyright 2006-2014 by the Sumatra team, see doc/authors.txt
+:license: CeCILL, see LICENSE for details.
+"""
+
+import csv
+try:
+    import pandas
+    have_pandas = True
+except ImportError:
+    have_pandas = False
+try:
+    import pyarrow
+    import pyarrow.parquet
+    have_pyarrow = True
+except ImportError:
+    have_pyarrow = False
+from sumatra.recordstore.base import BATCH_SIZE, TABLE_FIELDS, PARAMETER_PREFIX
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+
+def table_columns(record_store, project_name, columns=None, tags=None):
+    """
+    Return a list of column names and a dict mapping each name to True if the
+    column contains numbers.
+
+    *columns* may contain the names of record fields (see TABLE_FIELDS),
+    parameter names (with or without the "parameters." prefix) and
+    "parameters", which stands for all of the parameters. By default, all
+    the fields and parameters are included.
+    """
+    parameters = record_store.parameter_columns(project_name, tags=tags)
+    if columns is None:
+        columns = list(TABLE_FIELDS) + ["parameters"]
+    names = []
+    for column in columns:
+        if column == "parameters":
+            names.extend(sorted(parameters))
+        elif column in TABLE_FIELDS or column.startswith(PARAMETER_PREFIX):
+            names.append(column)
+        elif PARAMETER_PREFIX + column in parameters:
+            names.append(PARAMETER_PREFIX + column)
+        else:
+            raise ValueError("Unknown column '%s'. Columns should be one of %s, or a parameter "
+                             "name" % (column, ", ".join(TABLE_FIELDS + ("parameters",))))
+    numeric = dict((name, parameters.get(name, name == "duration")) for name in names)
+    return names, numeric
+
+
+def iter_dataframes(record_store, project_name, columns=None, tags=None,
+                    batch_size=BATCH_SIZE):
+    """Iterate over the records of a project as DataFrames of *batch_size* rows."""
+    if not have_pandas:
+        raise ImportError("Creating DataFrames requires pandas, which is not installed.")
+    names, numeric = table_columns(record_store, project_name, columns, tags)
+    for batch in record_store.iter_rows(project_name, tags=tags, batch_size=batch_size):
+        yield pandas.DataFrame.from_records(batch, columns=names)
+
+
+def to_dataframe(record_store, project_name, columns=None, tags=None,
+                 batch_size=BATCH_SIZE):
+    """Return a DataFrame containing the records of a project."""
+    frames = list(iter_dataframes(record_store, project_name, columns, tags, batch_size))
+    if not frames:
+        names, numeric = table_columns(record_store, project_name, columns, tags)
+        return pandas.DataFrame(columns=names)
+    return pandas.concat(frames, ignore_index=True)
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):  # unicode, in Python 2
+        value = u"%s" % value
+        if str is bytes:
+            value = value.encode("utf-8")
+    return value
+
+
+def write_csv(fileobj, record_store, project_name, columns=None, tags=None,
+              batch_size=BATCH_SIZE, progress=None):
+    """
+    Write the records of a project to a file-like object in CSV format, with
+    a header line containing the column names. If given, *progress* is
+    called with the number of records written so far. Return the number of
+    records written.
+    """
+    names, numeric = table_columns(record_store, project_name, columns, tags)
+    writer = csv.writer(fileobj)
+    writer.writerow(names)
+    n = 0
+    for batch in record_store.iter_rows(project_name, tags=tags, batch_size=batch_size):
+        writer.writerows([_csv_value(row.get(name)) for name in names] for row in batch)
+        n += len(batch)
+        if progress:
+            progress(n)
+    return n
+
+
+def _arrow_type(name, numeric):
+    if name == "timestamp":
+        return pyarrow.timestamp("us")
+    elif numeric:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def _arrow_value(value, numeric):
+    if value is None or numeric or not isinstance(value, float):
+        return value
+    return u"%s" % value  # a number in a column which also contains text
+
+
+def write_parquet(path, record_store, project_name, columns=None, tags=None,
+                  batch_size=BATCH_SIZE, progress=None):
+    """
+    Write the records of a project to a Parquet file, with one row group per
+    batch of records. If given, *progress* is called with the number of
+    records written so far. Return the number of records written.
+    """
+    if not have_pyarrow:
+        raise ImportError("Writing Parquet files requires pyarrow, which is not installed.")
+    names, numeric = table_columns(record_store, project_name, columns, tags)
+    types = [_arrow_type(name, numeric[name]) for name in names]
+    schema = pyarrow.schema([pyarrow.field(name, type) for name, type in zip(names, types)])
+    n = 0
+    writer = pyarrow.parquet.ParquetWriter(path, schema)
+    try:
+        for batch in record_store.iter_rows(project_name, tags=tags, batch_size=batch_size):
+            arrays = [pyarrow.array([_arrow_value(row.get(name), numeric[name]) for row in batch],
+                                    type=type)
+                      for name, type in zip(names, types)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            n += len(batch)
+            if progress:
+                progress(n)
+    finally:
+        writer.close()
+    return n
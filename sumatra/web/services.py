@@ -12,6 +12,7 @@ from django.db.models import Q
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from sumatra.projects import load_project
 from sumatra.recordstore.django_store import models
+from sumatra.recordstore.search import SearchIndex, parse_query
 from time import strptime
 import datetime
 import os
@@ -59,6 +60,22 @@ class RecordForm(SearchForm):
                   'main_file', 'timestamp')
 
 
+def fulltext_search(records, inquiry):
+    '''
+    Restrict a queryset of records to those matching a full-text search
+    inquiry, using the search index if the database has one, and otherwise
+    looking for each word in the fields listed in Record.params_search.
+    '''
+    index = SearchIndex(records.db)
+    if index.supported:
+        return index.filter(records, inquiry)
+    for field, text, prefix in parse_query(inquiry):
+        fields = [field] if field in models.Record.params_search else models.Record.params_search
+        records = records.filter(reduce(lambda x, y: x | y,
+                                        [Q(**{"%s__icontains" % name: text}) for name in fields]))
+    return records
+
+
 class DefaultTemplate(object):
 
     '''
@@ -194,6 +211,37 @@ class AjaxTemplate(DefaultTemplate):
                                '1 month': 31, '2 months': 31 * 2, '6 months': 31 * 6, '1 year': 365}
 
 
+    def filter_search(self, request_data):
+        '''
+        Restrict the list of records to those matching either the full-text
+        inquiry (the #search_subnav input) or the fields of the search form.
+        '''
+        if request_data.get('fulltext_inquiry'):
+            self.sim_list = fulltext_search(self.sim_list, request_data['fulltext_inquiry'])
+            return
+        for key, val in request_data.items():
+            if key in ('label', 'tags', 'reason', 'main_file') and val:
+                words = [word.strip() for word in val.split(',')]
+                self.sim_list = self.sim_list.filter(
+                    reduce(lambda x, y: x | y, [Q(**{"%s__icontains" % key: word}) for word in words]))
+            elif isinstance(val, datetime.datetime) or isinstance(val, datetime.date):
+                self.sim_list = self.sim_list.filter(timestamp__year=val.year,
+                                                     timestamp__month=val.month,
+                                                     timestamp__day=val.day)
+            elif isinstance(val, models.Executable):
+                self.sim_list = self.sim_list.filter(executable__path=val.path)
+            elif isinstance(val, models.Repository):
+                self.sim_list = self.sim_list.filter(repository__url=val.url)
+        if self.tags:
+            self.sim_list = self.sim_list.filter(tag_index__name=self.tags)
+        if getattr(self, 'date_base', False) and self.date_interval in self.dict_dates:
+            date_from = strptime(self.date_base, "%m/%d/%Y")
+            base = datetime.date(date_from.tm_year, date_from.tm_mon, date_from.tm_mday)
+            nb_days = datetime.timedelta(days=self.dict_dates[self.date_interval])
+            self.sim_list = self.sim_list.filter(
+                timestamp__gte=datetime.datetime.combine(base - nb_days, datetime.time()),
+                timestamp__lte=datetime.datetime.combine(base + nb_days, datetime.time(23, 59)))
+
     def save_settings(self):
         global_conf_file = os.path.expanduser(os.path.join("~", ".smtrc"))
         with open(global_conf_file, 'w') as fp:
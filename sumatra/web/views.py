@@ -18,6 +18,8 @@ except ImportError:  # older versions of Django
     MonthArchiveView = object
 from services import DefaultTemplate, DataTemplate, AjaxTemplate, ProjectUpdateForm, RecordUpdateForm, TagUpdateForm, unescape
 from sumatra.recordstore.django_store.models import Project, Tag, Record
+from sumatra.recordstore.search import SearchIndex
+from sumatra.recordstore.django_store import delete_records as delete_db_records, output_data
 
 from sumatra.projects import load_project
 import sumatra.recordstore.django_store.models as models
@@ -120,7 +122,7 @@ def record_detail(request, project, label):
         record = Record.objects.get(label=label, project__id=project)
     if request.method == 'POST':
         if request.POST.has_key('delete'):  # in this version the page record_detail doesn't have delete option
-            record.delete()
+            delete_db_records(Record.objects.filter(pk=record.pk), record._state.db)
             return HttpResponseRedirect('..')
         elif request.POST.has_key('show_args'):  # user clicks the link <parameters> in record_list.html
             parameter_set = record.parameters.to_sumatra()
@@ -145,6 +147,7 @@ def record_detail(request, project, label):
             form = RecordUpdateForm(request.POST, instance=record)
             if form.is_valid():
                 form.save()
+                SearchIndex(record._state.db).add_db_record(record)
     else:
         form = RecordUpdateForm(instance=record)
     # data_store = get_data_store(record.datastore.type, eval(record.datastore.parameters)) doesn't get used?
@@ -183,6 +186,7 @@ def set_tags(request, project):
             form = TagUpdateForm(request.POST, instance=record)
             if form.is_valid():
                 form.save()
+                SearchIndex(record._state.db).add_db_record(record)
         return HttpResponseRedirect('.')
 
 
@@ -193,13 +197,10 @@ def delete_records(request, project):
         # Convert strings returned from Javascript function into Python bools
         delete_data = {'false': False, 'true': True}[delete_data]
     records = Record.objects.filter(label__in=records_to_delete, project__id=project)
-    if records:
-        for record in records:
-            if delete_data == True:
-                datastore = record.datastore.to_sumatra()
-                datastore.delete(*[data_key.to_sumatra()
-                                   for data_key in record.output_data.all()])
-            record.delete()
+    if delete_data == True:
+        for datastore, keys in output_data(records):
+            datastore.delete(*keys)
+    delete_db_records(records, records.db)
     return HttpResponse('OK')
 
 
@@ -347,7 +348,7 @@ def show_diff(request, project, label, package=''):
                                                  'project_name': project,
                                                  'package': package,
                                                  'parent_version': dependency.version,
-                                                 'diff': dependency.diff})
+                                                 'diff': dependency.get_diff()})
 
 
 class Timeline(MonthArchiveView):
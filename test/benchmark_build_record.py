@@ -0,0 +1,53 @@
+"""
+Measure the throughput of record deserialization (JSON text -> Record object),
+using the example records in test/unittests scaled up to a larger number of
+records.
+
+Usage: python benchmark_build_record.py [-n NUMBER_OF_RECORDS]
+
+The repository URL of the example records is replaced by a local path, so that
+the timings are not dominated by Mercurial trying to contact a remote server.
+"""
+
+from __future__ import print_function
+import os
+import time
+import json
+from argparse import ArgumentParser
+from sumatra.recordstore import serialization
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unittests")
+FIXTURES = ["example_0.3.json", "example_0.4.json", "example_0.5.json", "example_0.6.json"]
+
+
+def generate_lines(n):
+    templates = []
+    for filename in FIXTURES:
+        with open(os.path.join(FIXTURE_DIR, filename)) as fp:
+            data = json.load(fp)
+        data["repository"]["url"] = "/tmp/MyProject"
+        templates.append(data)
+    lines = []
+    for i in range(n):
+        data = templates[i % len(templates)]
+        data["label"] = "record%06d" % i
+        lines.append(json.dumps(data))
+    return lines
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", "--records", type=int, default=100000,
+                        help="number of records to decode (default 100000)")
+    args = parser.parse_args()
+    lines = generate_lines(args.records)
+    start = time.time()
+    for line in lines:
+        serialization.decode_record(line)
+    elapsed = time.time() - start
+    print("Decoded %d records in %.2f s (%.0f records/s)" % (args.records, elapsed,
+                                                             args.records / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -104,7 +104,7 @@ test_steps = [
     ),
     ("Export Sumatra records as JSON.",
      "smt export",
-     assert_file_exists, ".smt/records_export.json"),
+     assert_file_exists, ".smt/records_export.jsonl"),
 ]
 
 
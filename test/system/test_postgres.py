@@ -83,7 +83,9 @@ test_steps = [
      build_command("smt init --store=postgres://docker:docker@{}/sumatra_test -m main.py -e python MyProject", "url")),
      #"smt init -m main.py -e python MyProject"),
     ("Show project configuration", "smt info"),  # TODO: add assert
-    ("Run a computation", "smt run")
+    ("Run a computation", "smt run"),
+    ("Run a second computation, with the schema already up to date", "smt run"),
+    ("List the records", "smt list"),
 ]
 
 
@@ -8,6 +8,7 @@ except ImportError:
     import unittest
 import os
 import hashlib
+from datetime import datetime
 from sumatra import commands, launch, datastore
 
 originals = []  # use for storing originals of mocked objects
@@ -50,8 +51,12 @@ class MockRecordStore(object):
         return []
     def sync_all(self, other):
         return []
-    def update(self, project, field, value):
+    def update(self, project, field, value, tags=None, dry_run=False):
         self.updated = (field, value)
+        self.dry_run = dry_run
+        return {"/old/data/path": 3}
+    def upgrade(self, progress=None):
+        return ["Add a column"]
 
 
 class MockRepository(object):
@@ -110,16 +115,26 @@ class MockProject(object):
         self.launch_args.update(parameters=parameters,
                                 input_data=input_data,
                                 script_args=script_args)
-    def format_records(self, format='text', mode='short', tags=None, reverse=False):
-        self.format_args = {"tags": tags, "mode": mode, "format": format, "reverse": reverse}
+    def format_records(self, format='text', mode='short', tags=None, reverse=False,
+                       since=None, until=None, limit=None, where=None, all_tags=None, not_tags=None):
+        self.format_args = {"tags": tags, "mode": mode, "format": format, "reverse": reverse,
+                            "since": since, "until": until, "limit": limit, "where": where,
+                            "all_tags": all_tags, "not_tags": not_tags}
     def delete_record(self, label, delete_data=False):
         if "nota" in label:
             raise KeyError  # or just emit a warning?
         else:
             self._records_deleted.append(label)
+    def delete_records(self, labels, delete_data=False):
+        deleted = [label for label in labels if "nota" not in label]
+        self._records_deleted.extend(deleted)
+        return len(deleted)
     def delete_by_tag(self, tag, delete_data=False):
         self._records_deleted.append("records_tagged_with_%s" % tag)
-    def export(self): self.exported = True
+    def export(self, compress=False, progress=None): self.exported = True
+    def export_table(self, format="csv", filename=None, columns=None, tags=None, progress=None):
+        self.exported_table = (format, filename, columns, tags)
+        return filename or "records_export.%s" % format
     def most_recent(self):
         return MockRecord("most_recent")
     def add_comment(self, label, comment, replace=False):
@@ -138,6 +153,9 @@ class MockProject(object):
         return False
     def show_diff(self, label1, label2, **kwargs):
         return "diff"
+    def show_diff_matrix(self, labels=None, tags=None, **kwargs):
+        self.diff_matrix_args = (labels, tags)
+        return "diff matrix"
     def repeat(self, original_label, new_label=None):
         return (new_label or "repeated", original_label)
     def change_record_store(self, new_store):
@@ -295,6 +313,17 @@ class ConfigureCommandTests(unittest.TestCase):
     def test_with_an_arg(self):
         self.assertRaises(SystemExit, commands.configure, ["foo"])
 
+    def test_replica(self):
+        commands.configure(["--replica", "/path/to/replica", "--max-staleness", "10"])
+        store = self.prj.record_store
+        self.assertEqual((store.primary.path, store.replica.path), ("default", "/path/to/replica"))
+        self.assertEqual((store.max_staleness, store.mirror), (10, True))
+        commands.configure(["--replicated"])
+        self.assertEqual((self.prj.record_store.replica.path, self.prj.record_store.mirror),
+                         ("/path/to/replica", False))
+        commands.configure(["--replica", "none"])
+        self.assertEqual(self.prj.record_store.path, "default")
+
     def test_set_executable_no_options(self):
         commands.configure(["-e", "python"])
         assert self.prj.saved
@@ -579,6 +608,23 @@ class ListCommandTests(unittest.TestCase):
         commands.list([])
         # need some assertion about self.prj.format_args
 
+    def test_with_limit_and_since(self):
+        commands.list(["--limit", "5", "--since", "2014-03-26", "--until", "2014-03-27"])
+        self.assertEqual(self.prj.format_args["limit"], 5)
+        self.assertEqual(self.prj.format_args["since"], datetime(2014, 3, 26))
+        self.assertEqual(self.prj.format_args["until"], datetime(2014, 3, 27, 23, 59, 59, 999999))
+
+    def test_with_where(self):
+        commands.list(["--where", "sim.dt<0.1", "-w", "n_cells>=1000"])
+        self.assertEqual(self.prj.format_args["where"], ["sim.dt<0.1", "n_cells>=1000"])
+        self.assertRaises(SystemExit, commands.list, ["--where", "sim.dt"])
+
+    def test_with_tag_queries(self):
+        commands.list(["foo", "--all-tags", "bar", "baz", "--not-tag", "old", "--not-tag", "bad"])
+        self.assertEqual(self.prj.format_args["tags"], ["foo"])
+        self.assertEqual(self.prj.format_args["all_tags"], ["bar", "baz"])
+        self.assertEqual(self.prj.format_args["not_tags"], ["old", "bad"])
+
 
 class DeleteCommandTests(unittest.TestCase):
 
@@ -689,6 +735,20 @@ class DiffCommandTests(unittest.TestCase):
     def test_with_two_args(self):
         commands.diff(["label1", "label2"])
 
+    def test_with_three_args(self):
+        self.assertRaises(SystemExit, commands.diff, ["label1", "label2", "label3"])
+
+    def test_matrix(self):
+        commands.diff(["--matrix", "label1", "label2", "label3"])
+        self.assertEqual(self.prj.diff_matrix_args, (["label1", "label2", "label3"], None))
+        commands.diff(["-m"])
+        self.assertEqual(self.prj.diff_matrix_args, (None, None))
+        commands.diff(["-m", "-t", "foo", "bar"])
+        self.assertEqual(self.prj.diff_matrix_args, (None, ["foo", "bar"]))
+
+    def test_tag_without_matrix(self):
+        self.assertRaises(SystemExit, commands.diff, ["-t", "foo", "bar"])
+
 
 class HelpCommandTests(unittest.TestCase):
 
@@ -714,6 +774,12 @@ class UpgradeCommandTests(unittest.TestCase):
     #def test_project_upgraded(self):
     #    self.fail()  # need to mock shutil, open
 
+    def test_record_store_upgraded_in_place(self):
+        self.prj.sumatra_version = "0.5"
+        commands.upgrade([])
+        self.assertEqual(self.prj.sumatra_version, commands.sumatra.__version__)
+        assert self.prj.saved
+
     def test_with_args(self):
         self.assertRaises(SystemExit, commands.upgrade, ['foo'])
 
@@ -731,6 +797,17 @@ class ExportCommandTests(unittest.TestCase):
     def test_with_args(self):
         self.assertRaises(SystemExit, commands.export, ['foo'])
 
+    def test_table_format(self):
+        commands.export(['--format', 'csv', '-c', 'label', 'sim.dt', '--tag', 'foo'])
+        self.assertEqual(self.prj.exported_table, ('csv', None, ['label', 'sim.dt'], 'foo'))
+        assert not self.prj.exported
+
+    def test_options_not_supported_by_format(self):
+        self.assertRaises(SystemExit, commands.export, ['--format', 'csv', '--gzip'])
+        self.assertRaises(SystemExit, commands.export, ['--output', 'records.csv'])
+        self.assertRaises(SystemExit, commands.export, ['--format', 'json', '--tag', 'foo'])
+        assert not self.prj.exported
+
 
 class SyncCommandTests(unittest.TestCase):
 
@@ -757,6 +834,12 @@ class MigrateCommandTests(unittest.TestCase):
     def test_change_output_datastore(self):
         commands.migrate(["--datapath", "/new/data/path"])
         self.assertEqual(self.prj.record_store.updated, ("datastore.root", "/new/data/path"))
+        self.assertFalse(self.prj.record_store.dry_run)
+
+    def test_dry_run(self):
+        commands.migrate(["--datapath", "/new/data/path", "--dry-run"])
+        self.assertEqual(self.prj.record_store.updated, ("datastore.root", "/new/data/path"))
+        self.assertTrue(self.prj.record_store.dry_run)
 
 
 class ArgumentParsingTests(unittest.TestCase):
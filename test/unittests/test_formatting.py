@@ -12,7 +12,7 @@ from xml.etree import ElementTree
 
 from sumatra.records import Record
 from sumatra.formatting import (Formatter, TextFormatter, HTMLFormatter,
-                                TextDiffFormatter, get_formatter,
+                                TextDiffFormatter, TextDiffMatrixFormatter, get_formatter,
                                 ShellFormatter, LaTeXFormatter)
 from sumatra.core import run, TIMESTAMP_FORMAT
 from sumatra.programs import get_executable
@@ -104,6 +104,18 @@ class MockRecordDifference(object):
     script_arguments_differ = True
 
 
+class MockDifferenceMatrix(object):
+    labels = ["A", "B", "C"]
+    FLAGS = (("C", "code"), ("P", "parameters"))
+    classes = [["A", "B"], ["C"]]
+    def __len__(self):
+        return 3
+    def differences(self, label1, label2):
+        if "C" in (label1, label2) and label1 != label2:
+            return "CP"
+        return ""
+
+
 class MockProject(object):
     name = "ExampleProject"
     description = "This is an example project."
@@ -239,11 +251,27 @@ class TestTextDiffFormatter(unittest.TestCase):
         txt = self.df.long()
 
 
+class TestTextDiffMatrixFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.df = TextDiffMatrixFormatter(MockDifferenceMatrix())
+
+    def test__short(self):
+        lines = self.df.short().split("\n")
+        self.assertEqual(lines[0], "  | A  B  C ")
+        self.assertEqual(lines[3], "C | CP CP - ")
+
+    def test__long(self):
+        txt = self.df.long()
+        assert "3 records in 2 groups" in txt
+        assert "  1: A B\n" in txt
+
+
 
 class TestModuleFunctions(unittest.TestCase):
 
     def test__get_formatter__should_return_Formatter_subclass(self):
-        for format in 'text', 'html', 'textdiff':
+        for format in 'text', 'html', 'textdiff', 'textdiffmatrix':
             assert issubclass(get_formatter(format), Formatter)
 
 
@@ -6,9 +6,11 @@ from __future__ import with_statement
 import datetime
 import shutil
 import os, sys
+import sqlite3
 import unittest
 import sumatra.projects
 from sumatra.projects import Project, load_project
+from sumatra.recordstore.base import RecordStoreAccessError
 
 
 class MockDiffFormatter(object):
@@ -142,15 +144,21 @@ class MockRecordStore(object):
     def save(self, project_name, record):
         pass
     def get(self, project_name, label):
-        if label != "none_existent":
+        if label not in ("none_existent", "spooled"):
             return MockRecord(label=label*2)
         else:
             raise Exception()
-    def list(self, project_name, tags=None):
+    def list(self, project_name, tags=None, **kwargs):
         return [self.get(project_name, 'foo_label'),
                 self.get(project_name, 'bar_label')]
     def delete(self, project_name, label):
         self.deleted = label
+    def delete_many(self, project_name, labels):
+        self.deleted = labels
+        return len(labels)
+    def output_data(self, project_name, labels):
+        self.data_requested = labels
+        return [(MockDatastore(), [])]
     def delete_by_tag(self, project_name, tag):
         return "".join(reversed(tag))
     def most_recent(self, project):
@@ -159,6 +167,37 @@ class MockRecordStore(object):
         return {}
 
 
+class MockBusyRecordStore(MockRecordStore):
+    def __init__(self, failures, error=sqlite3.OperationalError):
+        self.failures = failures
+        self.error = error
+        self.saved = []
+    def save(self, project_name, record):
+        if self.failures > 0:
+            self.failures -= 1
+            raise self.error("database is locked")
+        self.saved.append(record.label)
+    def save_batch(self, project_name, records):
+        for record in records:
+            self.save(project_name, record)
+
+
+class MockSpool(object):
+    spooled = []
+    def __init__(self, directory):
+        self.directory = directory
+    def put(self, project_name, record):
+        self.spooled.append(record)
+        return os.path.join(self.directory, record.label)
+    def records(self, project_name):
+        return iter(self.spooled)
+    def ingest(self, project_name, record_store):
+        record_store.save_batch(project_name, self.spooled)
+        n = len(self.spooled)
+        del self.spooled[:]
+        return n
+
+
 class TestProject(unittest.TestCase):
 
     def tearDown(self):
@@ -256,6 +295,13 @@ class TestProject(unittest.TestCase):
         proj.delete_record("foo")
         self.assertEqual(proj.record_store.deleted, "foo")
 
+    def test__delete_records__calls_delete_many_on_the_record_store(self):
+        proj = Project("test_project",
+                       record_store=MockRecordStore())
+        self.assertEqual(proj.delete_records(["foo", "bar"], delete_data=True), 2)
+        self.assertEqual(proj.record_store.deleted, ["foo", "bar"])
+        self.assertEqual(proj.record_store.data_requested, ["foo", "bar"])
+
     def test__delete_by_tag__calls_delete_by_tag_on_the_record_store(self):
         proj = Project("test_project",
                        record_store=MockRecordStore())
@@ -292,6 +338,75 @@ class TestProject(unittest.TestCase):
         proj.delete_record("record2")
         self.assertEqual(proj._most_recent, "last")  # should really be "record1", but we are not testing RecordStore here
 
+    def test__add_record__should_spool_record_if_store_is_busy(self):
+        orig_spool = sumatra.projects.RecordSpool
+        orig_delay = sumatra.projects.RETRY_BASE_DELAY
+        sumatra.projects.RecordSpool = MockSpool
+        sumatra.projects.RETRY_BASE_DELAY = 0.0
+        try:
+            store = MockBusyRecordStore(failures=sumatra.projects.MAX_SAVE_ATTEMPTS)
+            proj = Project("test_project", record_store=store)
+            proj.add_record(MockRecord("record1"))
+            self.assertEqual(store.saved, [])
+            self.assertEqual([r.label for r in MockSpool.spooled], ["record1"])
+            self.assertEqual(proj._most_recent, "record1")
+            proj.add_record(MockRecord("record2"))  # succeeds, and adds the spooled record
+            self.assertEqual(store.saved, ["record2", "record1"])
+            self.assertEqual(MockSpool.spooled, [])
+            self.assertEqual(proj._most_recent, "record2")
+        finally:
+            sumatra.projects.RecordSpool = orig_spool
+            sumatra.projects.RETRY_BASE_DELAY = orig_delay
+            del MockSpool.spooled[:]
+
+    def test__add_record__should_spool_record_without_retrying_if_store_is_unreachable(self):
+        orig_spool = sumatra.projects.RecordSpool
+        sumatra.projects.RecordSpool = MockSpool
+        try:
+            store = MockBusyRecordStore(failures=1, error=RecordStoreAccessError)
+            proj = Project("test_project", record_store=store)
+            proj.add_record(MockRecord("record1"))
+            self.assertEqual([r.label for r in MockSpool.spooled], ["record1"])
+            self.assertEqual(proj.flush(), 1)
+            self.assertEqual(store.saved, ["record1"])
+        finally:
+            sumatra.projects.RecordSpool = orig_spool
+            del MockSpool.spooled[:]
+
+    def test__add_record__should_not_spool_record_if_store_raises_other_database_errors(self):
+        import django.db.utils
+        orig_spool = sumatra.projects.RecordSpool
+        sumatra.projects.RecordSpool = MockSpool
+        try:
+            store = MockBusyRecordStore(failures=1, error=django.db.utils.IntegrityError)
+            proj = Project("test_project", record_store=store)
+            self.assertRaises(django.db.utils.IntegrityError, proj.add_record, MockRecord("record1"))
+            self.assertEqual(MockSpool.spooled, [])
+        finally:
+            sumatra.projects.RecordSpool = orig_spool
+            del MockSpool.spooled[:]
+
+    def test__find_records__should_include_spooled_records(self):
+        orig_spool = sumatra.projects.RecordSpool
+        sumatra.projects.RecordSpool = MockSpool
+        try:
+            store = MockRecordStore()
+            proj = Project("test_project", record_store=store)
+            spooled = MockRecord("spooled")
+            spooled.timestamp = datetime.datetime(2043, 01, 23)
+            MockSpool.spooled.append(spooled)
+            self.assertEqual([r.label for r in proj.find_records()],
+                             ["spooled", "foo_labelfoo_label", "bar_labelbar_label"])
+            self.assertEqual([r.label for r in proj.find_records(limit=2, offset=1)],
+                             ["foo_labelfoo_label", "bar_labelbar_label"])
+            self.assertEqual([r.label for r in proj.find_records(tags="bar")],
+                             ["foo_labelfoo_label", "bar_labelbar_label"])
+            self.assertEqual(proj.get_record("spooled"), spooled)
+            self.assertEqual(proj.get_record("foo").label, "foofoo")
+        finally:
+            sumatra.projects.RecordSpool = orig_spool
+            del MockSpool.spooled[:]
+
     def test__backup(self):
         def fake_copytree(source, target):
             pass
@@ -5,7 +5,8 @@ Unit tests for the sumatra.records module
 import unittest
 import time
 import os
-from sumatra.records import Record, RecordDifference, check_file_under_version_control
+from sumatra.records import (Record, RecordDifference, check_file_under_version_control,
+                             record_fingerprint, compare_many)
 from contextlib import contextmanager
 
 
@@ -20,6 +21,9 @@ def patch(module, func_name, replacement):
 
 
 class MockExecutable(object):
+    path = "/usr/bin/mock"
+    name = "mock"
+    options = ""
     def __init__(self, version="1"):
         self.version = version
     def __eq__(self, other):
@@ -30,6 +34,7 @@ class MockExecutable(object):
         return filename
     
 class MockRepository(object):
+    url = "http://hg.example.com/mock"
     def __eq__(self, other):
         return True
     def __ne__(self, other):
@@ -68,10 +73,20 @@ class MockDataStore(object):
         pass
 
 class MockDependency(object):
+    path = "/usr/lib/mock"
+    version = "1.0"
+    diff = ""
     def __init__(self, name):
         self.name = name
 
 
+class MockDataKey(object):
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+        self.metadata = {"mimetype": "text/plain"}
+
+
 class MockWorkingCopy(object):
     def __init__(self, path):
         self.path = path
@@ -91,6 +106,65 @@ class TestRecord(unittest.TestCase):
                     999, MockLaunchMode(), MockDataStore(), {"a": 3}, label="A")
         r1.run(with_label='parameters')
 
+    def test_lazy_attributes(self):
+        import pickle
+        r1 = Record(MockExecutable("1"), MockRepository(), "test.py",
+                    999, MockLaunchMode(), MockDataStore(), {"a": 3}, label="A", diff="abc")
+        calls = []
+        r1.set_loader("diff", lambda: calls.append(1) or "def")
+        self.assertNotEqual(r1.get_loader("diff"), None)
+        self.assertEqual(calls, [])
+        self.assertEqual(r1.diff, "def")
+        self.assertEqual(r1.diff, "def")
+        self.assertEqual(calls, [1])
+        self.assertEqual(r1.get_loader("diff"), None)
+        r1.set_loader("stdout_stderr", lambda: "some output")
+        r2 = pickle.loads(pickle.dumps(r1))
+        self.assertEqual(r2.stdout_stderr, "some output")
+        self.assertEqual(r2.get_loader("stdout_stderr"), None)
+
+class TestRecordFingerprint(unittest.TestCase):
+
+    def make_record(self, label, parameters={"a": 2}, version="1"):
+        record = Record(MockExecutable(version), MockRepository(), "test.py",
+                        999, MockLaunchMode(), MockDataStore(), dict(parameters), label=label)
+        record.dependencies = [MockDependency("foo")]
+        return record
+
+    def test_equal_records_have_the_same_fingerprint(self):
+        r1 = self.make_record("A")
+        r2 = self.make_record("B", {"a": 2, "sumatra_label": "B"})
+        r2.tags.add("foo")
+        self.assertEqual(r1.fingerprint, r2.fingerprint)
+        self.assertEqual(r2.parameters, {"a": 2, "sumatra_label": "B"})  # not modified
+        self.assertNotEqual(r1.fingerprint, self.make_record("C", {"a": 3}).fingerprint)
+        self.assertNotEqual(r1.fingerprint, self.make_record("D", version="2").fingerprint)
+
+    def test_equality_only_compares_records_in_detail_if_fingerprints_differ(self):
+        r1, r2, r3 = self.make_record("A"), self.make_record("B"), self.make_record("C", {"a": 3})
+        with patch(RecordDifference, "__nonzero__", lambda self: self.fail()):
+            self.assertEqual(r1, r2)
+        self.assertNotEqual(r1, r3)
+
+    def test_stored_fingerprint_is_used(self):
+        r1, r2 = self.make_record("A"), self.make_record("B", {"a": 3})
+        r2.fingerprint = record_fingerprint(r1)
+        self.assertEqual(r1, r2)
+        r2.fingerprint = None
+        self.assertNotEqual(r1, r2)
+
+    def test_values_of_different_types_have_different_fingerprints(self):
+        def fingerprint(value):
+            return self.make_record("A", {"a": value}).fingerprint
+        self.assertNotEqual(fingerprint(1), fingerprint("1"))
+        self.assertNotEqual(fingerprint(1), fingerprint(1.0))
+        self.assertNotEqual(fingerprint(1), fingerprint(True))
+        self.assertNotEqual(fingerprint((1, 2)), fingerprint([1, 2]))
+        self.assertNotEqual(fingerprint(["a,b"]), fingerprint(["a", "b"]))
+        self.assertEqual(fingerprint("x"), fingerprint(u"x"))
+        self.assertEqual(fingerprint({"x": 1, "y": set([2, 3])}), fingerprint({"y": set([3, 2]), "x": 1}))
+
+
 class TestHelperFunctions(unittest.TestCase):
     
     def test__main_file_and_cwd_in_wc_root(self):
@@ -191,6 +265,51 @@ class TestRecordDifference(unittest.TestCase):
         diff = RecordDifference(r1, r2)        
         self.assertEqual(repr(diff), "RecordDifference(A, B):XCP")
 
+    def test_ignore_patterns_are_not_shared(self):
+        r1 = Record(MockExecutable(), MockRepository(), "test.py",
+                    999, MockLaunchMode(), MockDataStore())
+        diff = RecordDifference(r1, r1, ignore_filenames=[r"\.tmp"])
+        self.assertEqual(diff.ignore_filenames, [r'\.log', r'^log', r"\.tmp"])
+        self.assertEqual(RecordDifference.ignore_filenames, [r'\.log', r'^log'])
+
+
+class TestDifferenceMatrix(unittest.TestCase):
+
+    def setUp(self):
+        dependencies = [MockDependency("foo")]
+        def make_record(label, parameters={"a": 2}, version="1", output_data=("1.dat",)):
+            record = Record(MockExecutable(version), MockRepository(), "test.py",
+                            999, MockLaunchMode(), MockDataStore(), dict(parameters), label=label)
+            record.dependencies = dependencies
+            record.output_data = [MockDataKey(path, path + "digest") for path in output_data]
+            return record
+        self.records = [make_record("A"),
+                        make_record("B", {"a": 2, "sumatra_label": "B"}),
+                        make_record("C", {"a": 3}),
+                        make_record("D", version="2"),
+                        make_record("E", output_data=("1.dat", "2.dat")),
+                        make_record("F", output_data=("1.dat", "run.log")),
+                        make_record("G", {"a": 3})]
+
+    def test_differences_are_those_given_by_RecordDifference(self):
+        matrix = compare_many(self.records)
+        self.assertEqual(matrix.labels, list("ABCDEFG"))
+        for r1 in self.records:
+            for r2 in self.records:
+                diff = RecordDifference(r1, r2)
+                self.assertEqual(matrix.differences(r1.label, r2.label),
+                                 repr(diff).split(":")[1])
+        self.assertEqual(matrix.differences("A", "E"), "")
+        self.assertEqual(matrix.differences("E", "A"), "D")
+        self.assertEqual(matrix.differences("C", "D"), "XP")
+
+    def test_classes(self):
+        self.assertEqual(compare_many(self.records).classes,
+                         [["A", "B", "F"], ["C", "G"], ["D"], ["E"]])
+        self.assertEqual(compare_many(self.records, ignore_filenames=[r"^2"]).classes,
+                         [["A", "B", "E", "F"], ["C", "G"], ["D"]])
+        self.assertEqual(compare_many([]).classes, [])
+
 
 if __name__ == '__main__':
     unittest.main()